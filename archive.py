@@ -0,0 +1,104 @@
+"""
+Yearly archive databases for closed years (config.ARCHIVE_DIR, SQLite only).
+
+Transactions of the years before the last ARCHIVE_KEEP_YEARS move from the main database to one
+file per year, next to it in ARCHIVE_DIR. The files are ATTACHed read-only to every connection
+(utils.attach_archives) and read through utils.tier_models, so reports, lists and snapshots still
+see the whole history while the main database and its indexes only grow with the recent years.
+The monthly rollup stays in the main database, so reports over whole months never open an archive.
+"""
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+import sqlite3
+
+import config
+from utils import Transazione, archive_path, archived_years, db, is_sqlite
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 300  # seconds between two looks for new archives, in workers that don't archive
+
+
+def closed_years(cutoff):
+    # Years with transactions still in the main database, before cutoff
+    with contextlib.closing(sqlite3.connect(db.obj.database)) as conn:
+        query = "SELECT DISTINCT substr(date, 1, 4) FROM transazioni WHERE date < ?"
+        return sorted(int(year) for (year,) in conn.execute(query, (f"{cutoff}-01-01",)))
+
+
+def archive_year(year):
+    # Two transactions, copy then delete: a crash in between leaves the rows in both databases,
+    # and archiving the year again (INSERT OR IGNORE by id) only completes the delete
+    columns = ", ".join(field.column_name for field in Transazione._meta.sorted_fields)
+    start, end = f"{year}-01-01", f"{year}-12-31"
+    os.makedirs(config.ARCHIVE_DIR, exist_ok=True)
+    with contextlib.closing(sqlite3.connect(db.obj.database, timeout=30)) as conn:
+        conn.execute("ATTACH DATABASE ? AS archivio", (archive_path(year),))
+        with conn:
+            # Same columns, no foreign key (categorie stays in the main database)
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS archivio.transazioni AS SELECT {columns} FROM main.transazioni WHERE 0"
+            )
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS archivio.transazioni_id ON transazioni (id)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS archivio.transazione_user_id_date_importo "
+                "ON transazioni (user_id, date, importo)"
+            )
+            moved = conn.execute(
+                f"INSERT OR IGNORE INTO archivio.transazioni ({columns}) "
+                f"SELECT {columns} FROM main.transazioni WHERE date >= ? AND date <= ?",
+                (start, end),
+            ).rowcount
+        with conn:
+            deleted = conn.execute("DELETE FROM main.transazioni WHERE date >= ? AND date <= ?", (start, end)).rowcount
+        conn.execute("DETACH DATABASE archivio")
+    return moved, deleted
+
+
+def archive_closed_years(today=None):
+    today = today or datetime.date.today()
+    if not config.ARCHIVE_DIR or not is_sqlite():
+        return []
+    years = closed_years(today.year - config.ARCHIVE_KEEP_YEARS)
+    for year in years:
+        moved, deleted = archive_year(year)
+        logger.info(f"Archivio {year}: {moved} transazioni archiviate, {deleted} tolte dal database principale.")
+    if years:
+        archived_years(refresh=True)
+        # The freed pages go back to the filesystem; ids are INTEGER PRIMARY KEYs, so rowids
+        # (and the FTS5 index pointing at them) survive the VACUUM
+        with contextlib.closing(sqlite3.connect(db.obj.database, timeout=30)) as conn:
+            conn.execute("VACUUM")
+    return years
+
+
+async def archive_job(context):
+    try:
+        await asyncio.to_thread(archive_closed_years)
+    except sqlite3.Error as e:
+        # Retried at the next run, archive_year can be repeated
+        logger.error(f"Archiviazione fallita: {e!r}")
+
+
+async def refresh_job(context):
+    # Archives made by another worker
+    archived_years(refresh=True)
+
+
+def schedule_archive(job_queue, shard=None):
+    if not config.ARCHIVE_DIR:
+        return
+    if job_queue is None:
+        logger.warning("JobQueue non disponibile, installa python-telegram-bot[job-queue] per l'archiviazione.")
+        return
+    if shard is not None and shard[0] != 0 and not config.SHARD_DATABASES:
+        # Sharded workers sharing one database: the first one archives it, the others attach the new
+        # archive files when they show up
+        job_queue.run_repeating(refresh_job, interval=REFRESH_INTERVAL, name="archive_refresh")
+        return
+    # At start (it also completes an archiving interrupted by a crash), then on the first of the month
+    job_queue.run_once(archive_job, when=0, name="archive")
+    job_queue.run_monthly(archive_job, when=datetime.time(3, 0), day=1, name="archive")
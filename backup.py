@@ -0,0 +1,161 @@
+"""
+Online backups of the SQLite database (config.BACKUP_DIR).
+
+    python backup.py [backup]
+    python backup.py verify [file]
+    python backup.py restore [file]
+
+A daily job copies the live database with SQLite's backup API, PAGES_PER_STEP pages at a time
+with a pause between the steps, from a read transaction of its own: in WAL mode readers don't
+block writers, so saves go on while the copy is made, and the copy is a consistent snapshot.
+The copy is checked (PRAGMA integrity_check), gzipped and the oldest backups beyond BACKUP_KEEP
+are removed. Restores are done with the bot stopped, and only from a backup that passes verify.
+Archive files (archive.py) are not included, they only change when the archive job runs.
+"""
+import asyncio
+import contextlib
+import datetime
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import config
+from utils import db, is_sqlite
+
+logger = logging.getLogger(__name__)
+
+PAGES_PER_STEP = 256  # 1 MB with the default 4 KB pages
+STEP_SLEEP = 0.005  # seconds between two steps
+
+
+def database_name():
+    return os.path.splitext(os.path.basename(db.obj.database))[0]
+
+
+def backups():
+    # Oldest first, the timestamp in the name sorts them
+    return sorted(glob.glob(os.path.join(config.BACKUP_DIR, f"{database_name()}-*.db.gz")))
+
+
+def copy_database(source, target):
+    with contextlib.closing(sqlite3.connect(source, timeout=30)) as src, contextlib.closing(
+        sqlite3.connect(target)
+    ) as dst:
+        # Started before the first step, so every step reads the same snapshot: a write from another
+        # connection would otherwise restart the copy from the first page
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=PAGES_PER_STEP, sleep=STEP_SLEEP)
+        src.rollback()
+
+
+def check(path):
+    # (ok, details) of an uncompressed database file
+    with contextlib.closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        try:
+            integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            return False, str(e)
+        if integrity != "ok":
+            return False, integrity
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = {"transazioni", "categorie"} - tables
+        if missing:
+            return False, f"tabelle mancanti: {', '.join(sorted(missing))}"
+        details = f"{conn.execute('SELECT COUNT(*) FROM transazioni').fetchone()[0]} transazioni"
+        if "migrazioni" in tables:
+            details += f", migrazione {conn.execute('SELECT MAX(version) FROM migrazioni').fetchone()[0]}"
+    return True, details
+
+
+def backup():
+    # Returns (path, seconds, details)
+    start = time.perf_counter()
+    os.makedirs(config.BACKUP_DIR, exist_ok=True)
+    name = f"{database_name()}-{datetime.datetime.now():%Y%m%d-%H%M%S}.db.gz"
+    path = os.path.join(config.BACKUP_DIR, name)
+    with tempfile.TemporaryDirectory(dir=config.BACKUP_DIR) as tmp:
+        copy = os.path.join(tmp, "copy.db")
+        copy_database(db.obj.database, copy)
+        ok, details = check(copy)
+        if not ok:
+            raise sqlite3.DatabaseError(f"Backup non valido: {details}")
+        with open(copy, "rb") as f, gzip.open(os.path.join(tmp, name), "wb", compresslevel=6) as out:
+            shutil.copyfileobj(f, out)
+        os.replace(os.path.join(tmp, name), path)
+    for old in backups()[: -config.BACKUP_KEEP]:
+        os.remove(old)
+    return path, time.perf_counter() - start, details
+
+
+def verify(path):
+    # Restores path to a temporary file and checks it, the live database isn't touched
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "restore.db")
+        with gzip.open(path, "rb") as f, open(copy, "wb") as out:
+            shutil.copyfileobj(f, out)
+        return check(copy)
+
+
+def restore(path):
+    # With the bot stopped: the current database is kept as <db>.before-restore
+    ok, details = verify(path)
+    if not ok:
+        raise sqlite3.DatabaseError(f"Backup non valido, database non toccato: {details}")
+    target = db.obj.database
+    restored = f"{target}.restore"
+    with gzip.open(path, "rb") as f, open(restored, "wb") as out:
+        shutil.copyfileobj(f, out)
+    if os.path.exists(target):
+        # Checkpoints the WAL into the file being set aside
+        with contextlib.closing(sqlite3.connect(target)) as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        os.replace(target, f"{target}.before-restore")
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(restored, target)
+    return details
+
+
+async def backup_job(context):
+    try:
+        path, seconds, details = await asyncio.to_thread(backup)
+        logger.info(f"Backup {path}: {details}, {seconds:.1f}s.")
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Backup fallito: {e!r}")
+
+
+def schedule_backup(job_queue, shard=None):
+    if not config.BACKUP_DIR or not is_sqlite():
+        return
+    if shard is not None and shard[0] != 0 and not config.SHARD_DATABASES:
+        # Sharded workers sharing one database: the first one backs it up
+        return
+    if job_queue is None:
+        logger.warning("JobQueue non disponibile, installa python-telegram-bot[job-queue] per i backup.")
+        return
+    hour, minute = (int(x) for x in config.BACKUP_TIME.split(":"))
+    job_queue.run_daily(backup_job, time=datetime.time(hour, minute), name="backup")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    what = sys.argv[1] if len(sys.argv) > 1 else "backup"
+    if what == "backup":
+        path, seconds, details = backup()
+        print(f"{path}: {details}, {seconds:.1f}s")
+    else:
+        path = sys.argv[2] if len(sys.argv) > 2 else backups()[-1]
+        if what == "verify":
+            ok, details = verify(path)
+            print(f"{path}: {'ok' if ok else 'NON VALIDO'} ({details})")
+            sys.exit(0 if ok else 1)
+        elif what == "restore":
+            print(f"{path} ripristinato: {restore(path)}")
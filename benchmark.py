@@ -0,0 +1,469 @@
+"""
+Micro benchmarks for the report pipeline.
+
+    python benchmark.py figures [repeat]
+    python benchmark.py renderers [repeat]
+    python benchmark.py ingest [rows]
+    python benchmark.py ranges [years]
+    python benchmark.py currencies [years]
+    python benchmark.py backup [rows]
+    python benchmark.py user_data [users]
+"""
+import bisect
+import csv
+import datetime
+import functools
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import peewee
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.subplots import make_subplots
+
+import config
+import utils
+from utils import (
+    BAR_COLORS,
+    BAR_PATTERNS,
+    figure_by_cat,
+    figure_by_month,
+    figure_by_month_and_category,
+)
+
+CATEGORIES = ["🍔 Cibo", "📨 Bollette", "📱 Telefono", "🏠 Casa", "🕹️ Svago", "🚗 Auto", "⛽ Benzina", "💰 Altro"]
+MONTHS = ["2023-07", "2023-08", "2023-09", "2023-10"]
+
+
+def sample_reports():
+    by_month_by_cat = [
+        (month, {cat: random.randint(100, 50000) for cat in random.sample(CATEGORIES, 6)}) for month in MONTHS
+    ]
+    by_cat = {}
+    for _, categories in by_month_by_cat:
+        for cat, spending in categories.items():
+            by_cat[cat] = by_cat.get(cat, 0) + spending
+    by_cat = sorted(by_cat.items(), key=lambda x: x[1], reverse=True)
+    by_month = [(month, sum(categories.values())) for month, categories in by_month_by_cat]
+    return by_cat, by_month, by_month_by_cat
+
+
+# Reference implementations: how figures were built before the precomputed layouts,
+# a validated Figure per report and one annotation (or trace) per bar.
+
+
+def legacy_figure_by_cat(data):
+    fig = go.Figure(
+        data=[
+            go.Bar(
+                y=[c.upper() for c, _ in data], x=[s for _, s in data], orientation="h", marker_color=BAR_COLORS
+            )
+        ]
+    )
+    for category, spending in data:
+        fig.add_annotation(
+            dict(
+                font=dict(color="black", size=14),
+                x=spending,
+                y=category.upper(),
+                showarrow=False,
+                text=str(spending) + " EUR",
+                xanchor="left",
+                yanchor="middle",
+            )
+        )
+    fig.update_layout(title={"text": "SPENDING BY CATEGORY"}, width=800, height=500, template="simple_white")
+    return fig
+
+
+def legacy_figure_by_month(data):
+    fig = go.Figure(data=[go.Bar(x=[m for m, _ in data], y=[s for _, s in data], marker_color=BAR_COLORS)])
+    for month, spending in data:
+        fig.add_annotation(
+            dict(
+                font=dict(color="black", size=14),
+                x=month,
+                y=spending,
+                showarrow=False,
+                text=str(spending) + " EUR",
+                xanchor="center",
+                yanchor="bottom",
+            )
+        )
+    fig.update_layout(title={"text": "SPENDING BY MONTH"}, width=800, height=500, template="simple_white")
+    return fig
+
+
+def legacy_figure_by_month_and_category(data):
+    fig = make_subplots(rows=2, cols=2, subplot_titles=[month for month, _ in data])
+    for i, (_, categories) in enumerate(data):
+        for j, (cat, spending) in enumerate(categories.items()):
+            fig.add_trace(
+                go.Bar(
+                    x=[spending],
+                    y=[cat.upper()],
+                    marker_color=BAR_COLORS[j % len(BAR_COLORS)],
+                    marker_pattern={"shape": BAR_PATTERNS[j % len(BAR_PATTERNS)]},
+                    orientation="h",
+                    showlegend=False,
+                ),
+                row=i // 2 + 1,
+                col=i % 2 + 1,
+            )
+            fig.add_annotation(
+                dict(x=spending, y=cat.upper(), showarrow=False, text=str(spending) + " EUR", xanchor="left"),
+                row=i // 2 + 1,
+                col=i % 2 + 1,
+            )
+    fig.update_layout(height=1000, width=900, template="simple_white", showlegend=False)
+    return fig
+
+
+def timeit(func, *args, repeat=20):
+    func(*args)  # warm up caches
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_figures(repeat=20):
+    by_cat, by_month, by_month_by_cat = sample_reports()
+    cases = [
+        ("by_cat", legacy_figure_by_cat, figure_by_cat, by_cat),
+        ("by_month", legacy_figure_by_month, figure_by_month, by_month),
+        ("by_month_and_category", legacy_figure_by_month_and_category, figure_by_month_and_category, by_month_by_cat),
+    ]
+
+    print(f"{'figure':<24}{'legacy build':>14}{'build':>10}{'legacy render':>15}{'render':>10}")
+    for name, legacy, current, data in cases:
+        legacy_ms = timeit(legacy, data, repeat=repeat)
+        current_ms = timeit(current, data, "EUR", repeat=repeat)
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".jpg") as out:
+                legacy_render = timeit(lambda: pio.write_image(legacy(data), out.name), repeat=3)
+                render = timeit(lambda: pio.write_image(current(data, "EUR"), out.name, validate=False), repeat=3)
+            renders = f"{legacy_render:>13.1f}ms{render:>8.1f}ms"
+        except (RuntimeError, ValueError) as e:
+            renders = f"  (kaleido not available: {str(e).strip().splitlines()[0]})"
+        print(f"{name:<24}{legacy_ms:>12.2f}ms{current_ms:>8.2f}ms{renders}")
+
+
+def create_tables():
+    # Fresh database: CATEGORIES get the ids 1..len(CATEGORIES) used by the generated rows
+    utils.db.create_tables([utils.Transazione, utils.Categoria, utils.Riepilogo])
+    utils.Categoria.insert_many([{"user_id": 0, "name": name} for name in CATEGORIES]).execute()
+
+
+def bench_ingest(rows=2000):
+    # Sustained ingest: one transaction per saved row vs the write-behind batches
+    import ingest
+
+    data = [
+        {
+            "timestamp": 1700000000 + i,
+            "date": "2023-11-14",
+            "user_id": 1000 + i % 50,
+            "importo": random.randint(100, 50000),
+            "descrizione": "spesa",
+            "categoria_id": random.randint(1, len(CATEGORIES)),
+        }
+        for i in range(rows)
+    ]
+    print(f"{'mode':<14}{'rows/s':>10}")
+    for mode in ("per-row", "write-behind"):
+        with tempfile.TemporaryDirectory() as tmp:
+            utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+            create_tables()
+            start = time.perf_counter()
+            if mode == "per-row":
+                for row in data:
+                    with utils.unit_of_work():
+                        utils.Transazione.create(**row)
+                        utils.Categoria.update(times_used=utils.Categoria.times_used + 1).where(
+                            utils.Categoria.id == row["categoria_id"]
+                        ).execute()
+                        utils.add_to_rollup(row)
+            else:
+                for batch in range(0, rows, config.WRITE_BEHIND_MAX_ROWS):
+                    ingest.write_rows(data[batch : batch + config.WRITE_BEHIND_MAX_ROWS])
+            elapsed = time.perf_counter() - start
+            utils.db.close()
+        print(f"{mode:<14}{rows / elapsed:>10.0f}")
+
+
+def raw_analyze(user_id, start_date, end_date):
+    # Reference: the whole range summed from transazioni, as before the monthly rollup
+    return list(
+        utils.Transazione.select(
+            utils.Transazione.date, utils.Transazione.categoria, peewee.fn.SUM(utils.Transazione.importo)
+        )
+        .where(
+            utils.Transazione.user_id == user_id,
+            utils.Transazione.date >= start_date,
+            utils.Transazione.date <= end_date,
+        )
+        .group_by(utils.Transazione.date, utils.Transazione.categoria)
+        .tuples()
+    )
+
+
+def bench_ranges(years=5, per_day=4, repeat=20):
+    import ingest
+
+    # One user with `years` of history, plus other users sharing the table
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=d) for d in range(years * 365)]
+    data = [
+        {
+            "timestamp": 1700000000 + i,
+            "date": day.isoformat(),
+            "user_id": user_id,
+            "importo": random.randint(100, 50000),
+            "descrizione": "spesa",
+            "categoria_id": random.randint(1, len(CATEGORIES)),
+        }
+        for user_id in (1, 2, 3)
+        for i, day in enumerate(day for day in days for _ in range(per_day))
+    ]
+    periods = [(label, start, end) for label, start, end in utils.report_presets(today)]
+    periods.append((f"{years} anni", today.replace(year=today.year - years), today))
+    print(f"{len(data)} transazioni, {len(data) // 3} per utente")
+    print(f"{'period':<16}{'raw':>10}{'rollup':>10}{'snapshot':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+        create_tables()
+        ingest.write_rows(data)
+        for label, start, end in periods:
+            raw = timeit(raw_analyze, 1, start, end, repeat=repeat)
+            config.SNAPSHOTS = False
+            rollup = timeit(utils.analyze_transactions, 1, start, end, repeat=repeat)
+            config.SNAPSHOTS = True
+            snapshot = timeit(utils.analyze_transactions, 1, start, end, repeat=repeat)
+            print(f"{label:<16}{raw:>8.2f}ms{rollup:>8.2f}ms{snapshot:>8.2f}ms")
+        utils.db.close()
+
+
+def write_rates(path, start, end):
+    # ECB format, one row per weekday
+    with open(path, "w") as f:
+        f.write("Date,USD,GBP,JPY,\n")
+        day = end
+        while day >= start:
+            if day.weekday() < 5:
+                wave = (day.toordinal() % 90) / 90
+                f.write(f"{day},{1.05 + 0.1 * wave:.4f},{0.85 + 0.03 * wave:.4f},{150 + 20 * wave:.2f},\n")
+            day -= datetime.timedelta(days=1)
+
+
+@functools.lru_cache(maxsize=None)
+def reference_rates(path):
+    rates = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            rates[datetime.date.fromisoformat(row["Date"])] = {k: float(v) for k, v in row.items() if k and k != "Date"}
+    return rates, sorted(rates)
+
+
+def per_row_analyze(user_id, start_date, end_date, valuta="EUR"):
+    # Reference: every transaction read back and converted in Python with the rate of its day
+    rates, days = reference_rates(config.EXCHANGE_RATES_FILE)
+    totals = {}
+    query = utils.Transazione.select().where(
+        utils.Transazione.user_id == user_id,
+        utils.Transazione.date >= start_date,
+        utils.Transazione.date <= end_date,
+    )
+    for t in query:
+        importo = t.importo
+        if t.valuta and t.valuta != valuta:
+            day = days[max(bisect.bisect_right(days, t.date) - 1, 0)]
+            day_rates = {config.EXCHANGE_RATES_BASE: 1.0, **rates[day]}
+            importo = round(importo * day_rates[valuta] / day_rates[t.valuta])
+        key = (t.date.strftime("%Y-%m"), t.categoria_id)
+        totals[key] = totals.get(key, 0) + importo
+    return totals
+
+
+def bench_currencies(years=3, per_day=4, repeat=5):
+    # Reports of a user with a quarter of the expenses in USD, GBP or JPY
+    import ingest
+
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=d) for d in range(years * 365)]
+    data = [
+        {
+            "timestamp": 1700000000 + i,
+            "date": day.isoformat(),
+            "user_id": 1,
+            "importo": random.randint(100, 50000),
+            "descrizione": "spesa",
+            "categoria_id": random.randint(1, len(CATEGORIES)),
+            "valuta": random.choice(["EUR", "EUR", "EUR", "EUR", "EUR", "EUR", "USD", "GBP"]),
+        }
+        for i, day in enumerate(day for day in days for _ in range(per_day))
+    ]
+    periods = [(label, start, end) for label, start, end in utils.report_presets(today)]
+    periods.append((f"{years} anni", today.replace(year=today.year - years), today))
+    print(f"{len(data)} transazioni")
+    print(f"{'period':<16}{'per-row':>10}{'rollup':>10}{'snapshot':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        config.EXCHANGE_RATES_FILE = f"{tmp}/eurofxref-hist.csv"
+        write_rates(config.EXCHANGE_RATES_FILE, days[-1], today)
+        utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+        create_tables()
+        ingest.write_rows(data)
+        for label, start, end in periods:
+            per_row = timeit(per_row_analyze, 1, start, end, repeat=repeat)
+            config.SNAPSHOTS = False
+            rollup = timeit(utils.analyze_transactions, 1, start, end, repeat=repeat)
+            config.SNAPSHOTS = True
+            snapshot = timeit(utils.analyze_transactions, 1, start, end, repeat=repeat)
+            print(f"{label:<16}{per_row:>8.2f}ms{rollup:>8.2f}ms{snapshot:>8.2f}ms")
+        utils.db.close()
+
+
+def timed_saves(count, rows):
+    # Milliseconds of each save, the same transaction as save_transaction without write-behind
+    latencies = []
+    for row in rows[:count]:
+        start = time.perf_counter()
+        with utils.unit_of_work():
+            utils.Transazione.create(**row)
+            utils.Categoria.update(times_used=utils.Categoria.times_used + 1).where(
+                utils.Categoria.id == row["categoria_id"]
+            ).execute()
+            utils.add_to_rollup(row)
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.001)
+    return latencies
+
+
+def bench_backup(rows=200000, saves=500):
+    # Save latency with no backup running and while backup.backup() copies the database
+    import backup
+    import ingest
+
+    def sample(n, offset=0):
+        return [
+            {
+                "timestamp": 1700000000 + offset + i,
+                "date": "2023-11-14",
+                "user_id": 1000 + i % 500,
+                "importo": random.randint(100, 50000),
+                "descrizione": random.choice(["spesa conad", "benzina", "kebab da ciccio", "bolletta luce"]),
+                "categoria_id": random.randint(1, len(CATEGORIES)),
+            }
+            for i in range(n)
+        ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+        config.BACKUP_DIR = f"{tmp}/backup"
+        create_tables()
+        for batch in range(0, rows, 10000):
+            ingest.write_rows(sample(min(10000, rows - batch), offset=batch))
+        print(f"{rows} transazioni, {utils.db.execute_sql('PRAGMA page_count').fetchone()[0]} pagine")
+
+        print(f"{'':<10}{'p50':>10}{'p95':>10}{'max':>10}")
+        idle = timed_saves(saves, sample(saves, offset=rows))
+        result = {}
+        copy = threading.Thread(target=lambda: result.update(zip(("path", "seconds", "details"), backup.backup())))
+        copy.start()
+        during = []
+        while copy.is_alive():
+            during += timed_saves(50, sample(50, offset=rows * 2 + len(during)))
+        copy.join()
+        for label, latencies in (("idle", idle), ("backup", during)):
+            cuts = statistics.quantiles(latencies, n=100)
+            print(f"{label:<10}{cuts[49]:>8.2f}ms{cuts[94]:>8.2f}ms{max(latencies):>8.2f}ms")
+        print(f"backup: {result['seconds']:.1f}s, {result['details']}, {len(during)} salvataggi nel frattempo")
+        ok, details = backup.verify(result["path"])
+        print(f"verify: {'ok' if ok else 'NON VALIDO'} ({details})")
+        utils.db.close()
+
+
+def _render_worker(renderer, repeat):
+    # Runs in a fresh process, so RSS only accounts for the chosen renderer
+    config.CHART_RENDERER = renderer
+    by_cat, by_month, by_month_by_cat = sample_reports()
+    charts = [
+        ("by_cat", utils.plotly_by_cat, by_cat),
+        ("by_month", utils.plotly_by_month, by_month),
+        ("by_month_and_category", utils.plotly_by_month_and_category, by_month_by_cat),
+    ]
+    with tempfile.NamedTemporaryFile(suffix=".jpg") as out:
+        for name, func, data in charts:
+            start = time.perf_counter()
+            func(data, "EUR", out.name)  # includes renderer start-up
+            first = (time.perf_counter() - start) * 1000
+            ms = timeit(func, data, "EUR", out.name, repeat=repeat)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024
+            print(f"{renderer:<12}{name:<24}{first:>9.1f}ms{ms:>9.1f}ms{rss:>8}MB{children:>8}MB", flush=True)
+
+
+def bench_user_data(users=100000):
+    # Bytes per user of context.user_data (a defaultdict(dict) of PTB) in the states a user can be in
+    def legacy(user_id):
+        # Before PendingTransaction: a dict per pending transaction, never removed (only emptied)
+        transaction = {"importo": 1250, "categoria": None, "descrizione": f"spesa {user_id}"}
+        transaction.update(timestamp=1700000000 + user_id, data=datetime.date.today())
+        return {"transazione_corrente": transaction, "valuta": "EUR", "report": "testo", "digest": "mensile"}
+
+    def pending(user_id):
+        transaction = utils.PendingTransaction(1250, None, f"spesa {user_id}", 1700000000 + user_id, datetime.date.today())
+        return {"transazione_corrente": transaction, "valuta": "EUR", "report": "testo", "digest": "mensile"}
+
+    def saved(user_id):
+        return {"valuta": "EUR", "report": "testo", "digest": "mensile"}
+
+    print(f"{'user_data':<24}{'bytes/user':>12}")
+    for name, build in (("dict (legacy)", legacy), ("PendingTransaction", pending), ("after save", saved)):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        user_data = {user_id: build(user_id) for user_id in range(users)}
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del user_data
+        print(f"{name:<24}{size / users:>12.0f}")
+    print(f"{'evicted':<24}{0:>12}")
+
+
+def bench_renderers(repeat=5):
+    print(f"{'renderer':<12}{'chart':<24}{'first':>11}{'avg':>11}{'rss':>10}{'child rss':>10}")
+    for renderer in ("matplotlib", "kaleido"):
+        proc = subprocess.run(
+            [sys.executable, __file__, "_render", renderer, str(repeat)], capture_output=True, text=True
+        )
+        if proc.returncode:
+            print(f"{renderer:<12}failed: {proc.stderr.strip().splitlines()[-1]}")
+        else:
+            print(proc.stdout, end="")
+
+
+if __name__ == "__main__":
+    what = sys.argv[1] if len(sys.argv) > 1 else "figures"
+    if what == "figures":
+        bench_figures(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "renderers":
+        bench_renderers(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "ingest":
+        bench_ingest(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "ranges":
+        bench_ranges(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "currencies":
+        bench_currencies(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "backup":
+        bench_backup(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "user_data":
+        bench_user_data(*[int(arg) for arg in sys.argv[2:3]])
+    elif what == "_render":
+        _render_worker(sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,105 @@
+"""
+Monthly budgets per category (Categorie > Budget) and the overspend check on save.
+
+Re-summing the month on every save would add a scan to the hottest write path, so the totals per
+(user, month, category) are kept running instead: in the database by the monthly rollup, which
+every save already updates (add_to_rollup, refresh_rollup), and in memory here, in the user's
+currency, loaded from the rollup the first time a user's month is needed and then incremented by
+record on every save. The check is a couple of dict lookups; users without budgets don't even
+load the totals. Changes that can't be replayed (merged categories, another currency) drop the
+user's totals, which are loaded again on the next save, write-behind rows not flushed yet included.
+A save warns when it takes a category over its budget, not at every save once it's over.
+"""
+import collections
+import logging
+
+import config
+import exchange
+import ingest
+from utils import Budget, month_totals
+
+logger = logging.getLogger(__name__)
+
+# user_id -> {"budgets": {category id: cents}, "spent": {"YYYY-MM": Counter of cents by category id}},
+# least recently used first
+_users = collections.OrderedDict()
+
+
+def _entry(user_id):
+    entry = _users.get(user_id)
+    if entry is None:
+        query = Budget.select(Budget.categoria_id, Budget.importo).where(Budget.user_id == user_id).tuples()
+        entry = _users[user_id] = {"budgets": dict(query), "spent": {}}
+        while len(_users) > config.BUDGET_CACHE_SIZE:
+            _users.popitem(last=False)
+    else:
+        _users.move_to_end(user_id)
+    return entry
+
+
+def budgets(user_id):
+    return _entry(user_id)["budgets"]
+
+
+def _amounts(rows, valuta):
+    # The rows' amounts in the user's currency (valuta, the setting)
+    return exchange.convert(
+        [row["importo"] for row in rows],
+        [row.get("valuta") or "" for row in rows],
+        [row["date"] for row in rows],
+        exchange.report_currency(valuta),
+    )
+
+
+def spent(user_id, month, valuta):
+    # Running totals of a month, in the user's currency (valuta, the setting)
+    entry = _entry(user_id)
+    if month not in entry["spent"]:
+        totals = month_totals(user_id, month, valuta)
+        # Saved, but still in the write-behind buffer (ingest.py)
+        rows = [row for row in ingest.pending(user_id) if str(row["date"])[:7] == month]
+        if rows:
+            for row, importo in zip(rows, _amounts(rows, valuta)):
+                totals[row["categoria_id"] or 0] += int(importo)
+        entry["spent"][month] = totals
+    return entry["spent"][month]
+
+
+def set_budget(user_id, categoria_id, importo):
+    # importo in cents, 0 removes the budget
+    if importo > 0:
+        Budget.insert(user_id=user_id, categoria_id=categoria_id, importo=importo).on_conflict(
+            conflict_target=[Budget.user_id, Budget.categoria_id], update={Budget.importo: importo}
+        ).execute()
+    else:
+        Budget.delete().where(Budget.user_id == user_id, Budget.categoria_id == categoria_id).execute()
+    # A user's first budget: totals weren't kept until now
+    invalidate(user_id)
+
+
+def invalidate(user_id):
+    _users.pop(user_id, None)
+
+
+def record(rows, valuta):
+    # Rows of one user about to be saved, called before they are written (so they aren't counted
+    # twice when the totals are loaded): adds them to the running totals and returns
+    # [(category id, spent, budget)] of the categories these rows took over budget
+    user_id = rows[0]["user_id"]
+    entry = _entry(user_id)
+    if not entry["budgets"]:
+        return []
+    before = {}  # (month, category id) -> total before these rows
+    for row, importo in zip(rows, _amounts(rows, valuta)):
+        month = str(row["date"])[:7]
+        categoria_id = row["categoria_id"] or 0
+        totals = spent(user_id, month, valuta)
+        before.setdefault((month, categoria_id), totals[categoria_id])
+        totals[categoria_id] += int(importo)
+    over = []
+    for (month, categoria_id), previous in sorted(before.items()):
+        limit = entry["budgets"].get(categoria_id)
+        total = entry["spent"][month][categoria_id]
+        if limit and previous <= limit < total:
+            over.append((categoria_id, total, limit))
+    return over
@@ -1,2 +1,39 @@
 TOKEN = ''
-DEFAULT_CURRENCY = 'EUR'
\ No newline at end of file
+DEFAULT_CURRENCY = 'EUR'
+CHART_RENDERER = 'kaleido'  # 'kaleido' or 'matplotlib'
+DEFAULT_REPORT_MODE = 'testo'  # 'testo' (unicode bars) or 'grafico' (images)
+REPORT_CACHE_SIZE = 5000  # (user, period) reports kept in memory
+PRERENDER_TIME = '04:00'  # daily pre-aggregation/pre-rendering of reports, None to disable
+PRERENDER_ACTIVE_DAYS = 60  # users with transactions in the last N days
+PRERENDER_CONCURRENCY = 2
+SHARD_WORKERS = 4  # sharding.py: worker processes behind the webhook receiver
+SHARD_DATABASES = False  # one SQLite file per worker instead of db/sqlite.db
+WEBHOOK_URL = ''
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = ''
+DB_BACKEND = 'sqlite'  # 'sqlite' or 'postgres' (needs psycopg2)
+DB_OPTIONS = {}  # sqlite: {'path': 'db/sqlite.db'}; postgres: {'database': 'salvaspese', 'user': ..., 'password': ..., 'host': ...}
+TEST_DB_OPTIONS = {}  # a throwaway PostgreSQL database for the tests, which run on SQLite only without it
+WRITE_BEHIND = False  # acknowledge saves from an append-only log, write them to the db in batches
+WRITE_BEHIND_INTERVAL_MS = 500
+WRITE_BEHIND_MAX_ROWS = 200
+WRITE_BEHIND_FSYNC = False  # fsync the log on every save (survives power loss, not just crashes)
+SNAPSHOTS = True  # reports from in-memory columnar snapshots (NumPy) instead of database queries
+SNAPSHOT_CACHE_SIZE = 2000  # users whose snapshot is kept in memory
+SNAPSHOT_DIR = None  # e.g. 'db/snapshots': snapshots are saved there and memory-mapped when loaded
+BUDGET_CACHE_SIZE = 10000  # users whose budgets and running totals are kept in memory
+SLOW_QUERY_MS = 100  # queries slower than this are logged with their plan
+ADMIN_IDS = []  # Telegram user ids allowed to use /stats, /backup (and /backup verifica), /profile and /memoria
+SEARCH_PAGE_SIZE = 10  # /cerca results per page
+DUPLICATE_WINDOW = 600  # seconds in which the same amount, description and date is only saved again on confirm, 0: off
+ARCHIVE_DIR = None  # e.g. 'db/archivio': closed years are moved to one read-only SQLite file per year (SQLite only)
+ARCHIVE_KEEP_YEARS = 1  # closed years kept in the main database besides the current one
+BACKUP_DIR = None  # e.g. 'db/backup': daily online backups of the SQLite database, gzipped
+BACKUP_TIME = '03:30'
+BACKUP_KEEP = 7  # backups kept, the oldest are removed
+DIGEST_TIME = '09:00'  # weekly (Mondays) and monthly (1st) spending digests, None to disable
+DIGEST_DEFAULT = 'no'  # 'settimanale', 'mensile' or 'no' for users who didn't choose (digests are opt-in)
+DIGEST_RATE = 25  # digest messages per second, all chats together (Telegram allows about 30)
+USER_DATA_IDLE = 3600  # seconds without updates before a user's in-memory state is dropped, None to keep it
+EXCHANGE_RATES_FILE = None  # e.g. 'db/eurofxref-hist.csv': daily rates in the ECB format, for expenses in other currencies
+EXCHANGE_RATES_BASE = 'EUR'  # the currency the rates of the file are quoted against
@@ -0,0 +1,138 @@
+"""
+Live diagnostics for the admin commands /profile and /memoria.
+
+/profile [seconds] samples the stacks of every thread (sys._current_frames) every SAMPLE_INTERVAL
+for a few seconds, in a thread of its own so the bot keeps serving updates, and sends back the
+collapsed stacks ("thread;file:function;... count", the input of flamegraph.pl and speedscope)
+with a summary of the time spent in the handlers of main.py.
+
+/memoria starts tracemalloc and takes a baseline snapshot; each following /memoria lists the
+lines that allocated the most since the baseline, /memoria stop stops tracing (it slows down
+every allocation while it runs).
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+SAMPLE_INTERVAL = 0.005  # seconds between two samples
+MAX_SECONDS = 300
+TOP = 15  # lines in the summaries
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLERS_FILE = "main.py"
+EVENT_LOOP = "asyncio/base_events.py:run_forever"
+EVENT_LOOP_CALLBACK = "asyncio/events.py:_run"
+
+_profiling = threading.Lock()  # one profile at a time
+_baseline = None  # tracemalloc snapshot
+
+
+def frame_label(frame):
+    code = frame.f_code
+    directory, name = os.path.split(code.co_filename)
+    if directory == PROJECT_DIR:
+        return f"{name}:{code.co_name}"
+    # Library frames keep their package, so plotly/utils.py doesn't pass for utils.py
+    return f"{os.path.basename(directory)}/{name}:{code.co_name}"
+
+
+def is_project_frame(label):
+    return "/" not in label.split(":")[0]
+
+
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    # (Counter of collapsed stacks, root first, of all the threads but this one, samples, seconds)
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    start = time.monotonic()
+    deadline = start + seconds
+    samples = 0
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(labels))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples, time.monotonic() - start
+
+
+def collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def handler_summary(stacks, samples, elapsed):
+    # Time in each handler of main.py (its frames anywhere in the stack) and the functions at the
+    # top of the stacks that went through the bot's code, worker threads included (charts, ingest);
+    # the rest is mostly the event loop and idle threads waiting
+    handlers = collections.Counter()
+    leaves = collections.Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        if EVENT_LOOP in frames:
+            # In the event loop thread only what runs in a callback counts, not the entry point
+            # (main.py:main) waiting in select
+            if EVENT_LOOP_CALLBACK not in frames:
+                continue
+            frames = frames[len(frames) - frames[::-1].index(EVENT_LOOP_CALLBACK) :]
+        if not any(is_project_frame(frame) for frame in frames):
+            continue
+        for handler in {frame for frame in frames if frame.startswith(f"{HANDLERS_FILE}:")}:
+            handlers[handler] += count
+        leaves[frames[-1]] += count
+    lines = [f"{samples} campioni in {elapsed:.0f}s, {sum(leaves.values())} stack nel codice del bot."]
+    if handlers:
+        lines += ["", "Gestori:"]
+        lines += [f"{count / samples:6.1%} {handler}" for handler, count in handlers.most_common(TOP)]
+    if leaves:
+        lines += ["", "In cima allo stack:"]
+        lines += [f"{count / samples:6.1%} {leaf}" for leaf, count in leaves.most_common(TOP)]
+    return "\n".join(lines)
+
+
+def is_profiling():
+    return _profiling.locked()
+
+
+def profile(seconds):
+    # Returns (collapsed stacks, summary), or None if another profile is running
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        stacks, samples, elapsed = sample_stacks(min(seconds, MAX_SECONDS))
+    finally:
+        _profiling.release()
+    return collapsed(stacks), handler_summary(stacks, samples, elapsed)
+
+
+def memory_diff(stop=False):
+    # Text for /memoria: starts tracing, compares to the baseline or stops
+    global _baseline
+    if stop:
+        tracemalloc.stop()
+        _baseline = None
+        return "Tracciamento della memoria fermato."
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _baseline = tracemalloc.take_snapshot()
+        return "Tracciamento della memoria avviato, ripeti /memoria più tardi per le differenze."
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    )
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Memoria tracciata: {current / 1024 / 1024:.1f} MB (picco {peak / 1024 / 1024:.1f} MB)", ""]
+    for stat in snapshot.compare_to(_baseline, "lineno")[:TOP]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size_diff / 1024:+9.1f} KB {stat.count_diff:+7d} {os.path.basename(frame.filename)}:{frame.lineno}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,220 @@
+"""
+Weekly and monthly spending digests pushed to the users who chose them (config.DIGEST_TIME).
+
+Every Monday the users who chose "settimanale" get last week's totals, on the first of the month
+those who chose "mensile" get last month's (setting3); the others get DIGEST_DEFAULT, "no" unless
+configured otherwise, so digests are opt-in. Digests are computed DIGEST_BATCH users at a time with
+one grouped query per batch, rendered as text and sent through a token bucket limiter: DIGEST_RATE
+messages per second overall, one per second per chat, and a pause of the whole fan-out when
+Telegram answers with RetryAfter.
+"""
+import asyncio
+import collections
+import datetime
+import html
+import logging
+import time
+
+import peewee
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+import config
+import exchange
+from utils import (
+    Categoria,
+    Riepilogo,
+    Setting,
+    Transazione,
+    format_importo,
+    in_unit_of_work,
+    month_range,
+    previous_month,
+    tier_models,
+)
+
+logger = logging.getLogger(__name__)
+
+DIGEST_BATCH = 500  # users per query and per round of sends
+MAX_ATTEMPTS = 3  # sends of one message, RetryAfter included
+CHOICES = ["settimanale", "mensile", "no"]  # setting3, in the order the settings button cycles them
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Nobody gets a token for the next `seconds`
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RateLimiter:
+    def __init__(self, rate, chat_rate=1.0):
+        self.bucket = TokenBucket(rate, burst=rate)
+        self.chat_rate = chat_rate
+        self.chats = {}
+        # Sends waiting for a token, so a big batch doesn't keep thousands of requests in flight
+        self.in_flight = asyncio.Semaphore(max(1, int(rate)))
+        self.stats = collections.Counter()
+
+    async def send(self, bot, chat_id, text):
+        chat = self.chats.setdefault(chat_id, TokenBucket(self.chat_rate, burst=1))
+        async with self.in_flight:
+            for _ in range(MAX_ATTEMPTS):
+                await chat.acquire()
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+                    self.stats["inviati"] += 1
+                    return True
+                except RetryAfter as e:
+                    # Flood control is per bot: everybody waits, not just this chat
+                    delay = e.retry_after
+                    delay = delay.total_seconds() if isinstance(delay, datetime.timedelta) else delay
+                    self.stats["retry_after"] += 1
+                    self.bucket.pause(delay)
+                except Forbidden:
+                    # The user blocked the bot
+                    self.stats["bloccati"] += 1
+                    return False
+                except TelegramError as e:
+                    logger.warning(f"Digest a {chat_id} non inviato: {e!r}")
+                    self.stats["errori"] += 1
+                    return False
+            self.stats["errori"] += 1
+            return False
+
+
+def digest_period(kind, today):
+    if kind == "settimanale":
+        # The week (Monday to Sunday) before today's
+        start = today - datetime.timedelta(days=today.weekday() + 7)
+        return start, start + datetime.timedelta(days=6)
+    return month_range(previous_month(today))
+
+
+def digest_users(kind, start_date, end_date, shard=None):
+    # Users with transactions in the period (from the rollup, which is small) who chose this digest
+    months = {start_date.strftime("%Y-%m"), end_date.strftime("%Y-%m")}
+    query = Riepilogo.select(Riepilogo.user_id).where(Riepilogo.month.in_(months)).distinct().tuples()
+    user_ids = {user_id for (user_id,) in query}
+    choices = dict(Setting.select(Setting.user_id, Setting.setting3).where(Setting.setting3.is_null(False)).tuples())
+    user_ids = [user_id for user_id in sorted(user_ids) if choices.get(user_id, config.DIGEST_DEFAULT) == kind]
+    if shard:
+        from sharding import shard_for
+
+        index, workers = shard
+        user_ids = [user_id for user_id in user_ids if shard_for(user_id, workers) == index]
+    return user_ids
+
+
+def daily_totals(model, user_ids, start_date, end_date):
+    # (user_id, category id or 0, currency or "", date, cents) rows
+    categoria = peewee.fn.COALESCE(model.categoria, 0)
+    valuta = peewee.fn.COALESCE(model.valuta, "")
+    return (
+        model.select(model.user_id, categoria, valuta, model.date, peewee.fn.SUM(model.importo))
+        .where(model.user_id.in_(user_ids), model.date >= start_date, model.date <= end_date)
+        .group_by(model.user_id, categoria, valuta, model.date)
+        .tuples()
+    )
+
+
+def build_digests(user_ids, kind, start_date, end_date):
+    # [(user_id, text)] for a batch of users, from one grouped query (one more for the users with
+    # expenses in other currencies in a monthly digest)
+    valute = dict(Setting.select(Setting.user_id, Setting.setting1).where(Setting.user_id.in_(user_ids)).tuples())
+    targets = {user_id: exchange.report_currency(valute.get(user_id, config.DEFAULT_CURRENCY)) for user_id in user_ids}
+    if kind == "settimanale":
+        rows = list(daily_totals(Transazione, user_ids, start_date, end_date))
+        title = f"📬 La tua settimana ({start_date:%d/%m} - {end_date:%d/%m})"
+    else:
+        # Whole month: the rollup already has the totals, by currency
+        rows = []
+        foreign = set()
+        for user_id, categoria_id, valuta, importo in (
+            Riepilogo.select(Riepilogo.user_id, Riepilogo.categoria_id, Riepilogo.valuta, Riepilogo.importo)
+            .where(Riepilogo.user_id.in_(user_ids), Riepilogo.month == start_date.strftime("%Y-%m"))
+            .tuples()
+        ):
+            if valuta in ("", targets[user_id]):
+                rows.append((user_id, categoria_id, valuta, start_date, importo))
+            else:
+                foreign.add((user_id, valuta))
+        if foreign:
+            # Amounts in other currencies are converted with the rate of their day
+            foreign_users = {user_id for user_id, _ in foreign}
+            for model in tier_models(start_date, end_date):
+                days = daily_totals(model, foreign_users, start_date, end_date)
+                rows += [row for row in days if (row[0], row[2]) in foreign]
+        title = f"📬 Il tuo mese ({start_date:%m/%Y})"
+    totals = collections.defaultdict(collections.Counter)
+    # One vectorized conversion per report currency
+    for target in set(targets.values()):
+        selected = [row for row in rows if targets[row[0]] == target]
+        if not selected:
+            continue
+        users, categorie, currencies, dates, importi = zip(*selected)
+        for user_id, categoria_id, importo in zip(
+            users, categorie, exchange.convert(importi, currencies, dates, target)
+        ):
+            totals[user_id][categoria_id] += int(importo)
+    ids = {categoria_id for categories in totals.values() for categoria_id in categories if categoria_id}
+    names = dict(Categoria.select(Categoria.id, Categoria.name).where(Categoria.id.in_(ids)).tuples()) if ids else {}
+    digests = []
+    for user_id, categories in totals.items():
+        valuta = valute.get(user_id, config.DEFAULT_CURRENCY) or ""
+        lines = [title, "", f"Totale: <b>{format_importo(sum(categories.values()))} {valuta}</b>", ""]
+        for categoria_id, importo in categories.most_common(3):
+            lines.append(f"{html.escape(names.get(categoria_id, 'Nessuna'))}: {format_importo(importo)} {valuta}")
+        lines += ["", "Per non riceverlo più: /menu, Impostazioni."]
+        digests.append((user_id, "\n".join(lines)))
+    return digests
+
+
+async def send_digests(bot, kind, today=None, shard=None):
+    today = today or datetime.date.today()
+    start_date, end_date = digest_period(kind, today)
+    limiter = RateLimiter(config.DIGEST_RATE)
+    # Queries in worker threads, each with a unit of work returning its (pooled) connection
+    user_ids = await asyncio.to_thread(in_unit_of_work, digest_users, kind, start_date, end_date, shard)
+    for batch in range(0, len(user_ids), DIGEST_BATCH):
+        batch_ids = user_ids[batch : batch + DIGEST_BATCH]
+        digests = await asyncio.to_thread(in_unit_of_work, build_digests, batch_ids, kind, start_date, end_date)
+        await asyncio.gather(*[limiter.send(bot, user_id, text) for user_id, text in digests])
+    logger.info(f"Digest {kind}: {len(user_ids)} utenti, {dict(limiter.stats)}.")
+    return limiter.stats
+
+
+async def digest_job(context):
+    today = datetime.date.today()
+    kinds = (["settimanale"] if today.weekday() == 0 else []) + (["mensile"] if today.day == 1 else [])
+    for kind in kinds:
+        await send_digests(context.bot, kind, today, shard=context.job.data)
+
+
+def schedule_digest(job_queue, shard=None):
+    if not config.DIGEST_TIME:
+        return
+    if job_queue is None:
+        logger.warning("JobQueue non disponibile, installa python-telegram-bot[job-queue] per i riepiloghi.")
+        return
+    hour, minute = (int(x) for x in config.DIGEST_TIME.split(":"))
+    job_queue.run_daily(digest_job, time=datetime.time(hour, minute), data=shard, name="digest")
@@ -0,0 +1,130 @@
+"""
+Exchange rates for transactions in foreign currencies (config.EXCHANGE_RATES_FILE).
+
+The rates come from a local CSV in the format of the ECB historical file (eurofxref-hist.csv):
+a Date column, then one column per currency with its units per 1 EXCHANGE_RATES_BASE, "N/A" where
+there's no rate. The file is loaded once (again only when it changes) into a NumPy table by date,
+with the gaps filled by the previous day's rate, so reports convert whole columns of amounts with
+one lookup per row instead of a Python loop. Days without rates (weekends, holidays) use the last
+rate known, days before the first row the first one.
+"""
+import csv
+import logging
+import os
+import threading
+
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# What users can type or pick in the settings besides ISO codes
+SYMBOLS = {"€": "EUR", "$": "USD", "£": "GBP", "¥": "JPY"}
+
+_table = None  # (mtime, RateTable)
+_lock = threading.Lock()
+
+
+class RateTable:
+    def __init__(self, days, currencies, rates):
+        self.days = days  # sorted datetime64[D]
+        self.columns = {currency: i for i, currency in enumerate(currencies)}
+        self.rates = rates  # float64 (days, currencies), units per 1 base currency
+
+    def __contains__(self, currency):
+        return currency in self.columns
+
+
+def read_rates(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        rows = [row for row in reader if row and row[0].strip()]
+    # The ECB file ends every line with a comma
+    currencies = [name for name in header[1:] if name]
+    days = np.array([row[0].strip() for row in rows], "datetime64[D]")
+    rates = np.full((len(rows), len(currencies) + 1), np.nan)
+    rates[:, 0] = 1.0
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row[1 : len(currencies) + 1], 1):
+            value = value.strip()
+            if value and value != "N/A":
+                rates[i, j] = float(value)
+    order = np.argsort(days)
+    days, rates = days[order], rates[order]
+    # Forward fill: each missing rate takes the one of the last day that had it
+    known = np.where(np.isnan(rates), 0, np.arange(len(days))[:, None])
+    np.maximum.accumulate(known, axis=0, out=known)
+    rates = rates[known, np.arange(rates.shape[1])]
+    # and the days before a currency's first rate take that rate
+    first = np.argmax(~np.isnan(rates), axis=0)
+    rates = np.where(np.isnan(rates), rates[first, np.arange(rates.shape[1])], rates)
+    # Currencies without any rate are left out
+    columns = ~np.isnan(rates).all(axis=0)
+    currencies = [currency for currency, kept in zip([config.EXCHANGE_RATES_BASE] + currencies, columns) if kept]
+    return RateTable(days, currencies, rates[:, columns])
+
+
+def table():
+    # The RateTable of EXCHANGE_RATES_FILE, None without one
+    global _table
+    if not config.EXCHANGE_RATES_FILE:
+        return None
+    try:
+        mtime = os.stat(config.EXCHANGE_RATES_FILE).st_mtime
+    except OSError as e:
+        logger.error(f"Cambi non disponibili: {e!r}")
+        return None
+    with _lock:
+        if _table is None or _table[0] != mtime:
+            _table = (mtime, read_rates(config.EXCHANGE_RATES_FILE))
+            logger.info(f"Cambi caricati: {len(_table[1].days)} giorni, {len(_table[1].columns)} valute.")
+        return _table[1]
+
+
+def iso(valuta):
+    # "€" -> "EUR", "usd" -> "USD"; None for what isn't a currency
+    if not valuta:
+        return None
+    valuta = SYMBOLS.get(valuta, valuta.upper())
+    return valuta if len(valuta) == 3 and valuta.isalpha() else None
+
+
+def report_currency(valuta):
+    # Currency of a user's reports, from the setting (a symbol, a code or None)
+    return iso(valuta) or iso(config.DEFAULT_CURRENCY) or config.EXCHANGE_RATES_BASE
+
+
+def known(currency):
+    rates = table()
+    return currency == config.EXCHANGE_RATES_BASE or (rates is not None and currency in rates)
+
+
+def convert(amounts, currencies, dates, to):
+    # Cents in `to` of amounts in currencies (ISO codes, "" or b"" for the user's own) on dates,
+    # as an int64 array; all arrays of the same length
+    amounts = np.asarray(amounts, dtype=np.int64)
+    currencies = np.asarray(currencies)
+    if currencies.dtype == object:
+        # Column values from the database, NULL for the user's own currency
+        currencies = np.array([currency or "" for currency in currencies], dtype="U3")
+    # Snapshots keep the codes as bytes, compared as they are
+    empty, target = (b"", to.encode()) if currencies.dtype.kind == "S" else ("", to)
+    foreign = (currencies != empty) & (currencies != target)
+    if not foreign.any():
+        return amounts
+    rates = table()
+    codes, inverse = np.unique(currencies[foreign].astype("U3"), return_inverse=True)
+    missing = [code for code in [*codes, to] if rates is None or code not in rates]
+    if missing:
+        # Rows saved before the rates file changed, or a report currency without rates
+        logger.warning(f"Cambi mancanti per {', '.join(missing)}, importi non convertiti.")
+        return amounts
+    days = np.asarray(dates, dtype="datetime64[D]")[foreign]
+    rows = np.maximum(np.searchsorted(rates.days, days, side="right") - 1, 0)
+    columns = np.array([rates.columns[code] for code in codes])[inverse]
+    factors = rates.rates[rows, rates.columns[to]] / rates.rates[rows, columns]
+    converted = amounts.copy()
+    converted[foreign] = np.rint(amounts[foreign] * factors).astype(np.int64)
+    return converted
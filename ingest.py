@@ -0,0 +1,207 @@
+"""
+Write-behind ingestion of new transactions (config.WRITE_BEHIND).
+
+Saved transactions are acknowledged as soon as they are appended to an on-disk log and to an
+in-memory buffer; a job writes the buffer to `transazioni` every WRITE_BEHIND_INTERVAL_MS (or as
+soon as WRITE_BEHIND_MAX_ROWS are pending) with batched inserts in a single transaction.
+Logs that were not flushed (crash, kill) are replayed on startup.
+"""
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+import time
+
+import peewee
+
+import config
+import reports
+import snapshots
+from utils import Categoria, Transazione, category_id, db, refresh_rollup, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100  # rows per INSERT, well below SQLite's bound parameters limit
+
+buffer = None
+
+
+def insert_rows(rows):
+    # Batched inserts, one times_used update per category and the rollup, in the caller's
+    # transaction (save_batch: the update's one) or in one of their own
+    with db.atomic():
+        for batch in peewee.chunked(rows, BATCH_SIZE):
+            Transazione.insert_many(batch).execute()
+        used = collections.Counter(row["categoria_id"] for row in rows if row["categoria_id"])
+        for categoria_id, count in used.items():
+            Categoria.update(times_used=Categoria.times_used + count).where(Categoria.id == categoria_id).execute()
+        refresh_rollup({(row["user_id"], str(row["date"])[:7]) for row in rows})
+
+
+def write_rows(rows):
+    # Outside updates (flushes in a worker thread, replay at startup): a connection and a transaction
+    # of their own, which unit_of_work closes (pooled connections go back to the pool)
+    with unit_of_work():
+        insert_rows(rows)
+    # After the commit, so a snapshot rebuilt meanwhile can't miss these rows
+    for user_id in {row["user_id"] for row in rows}:
+        snapshots.invalidate(user_id)
+
+
+def read_log(path):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # Torn last line of a crashed write, the transaction was never acknowledged
+                logger.warning(f"Riga non valida in {path}, ignorata.")
+                continue
+            # Logged before transactions had a currency: insert_many needs the same keys in every row
+            row.setdefault("valuta", None)
+            rows.append(row)
+    return rows
+
+
+def log_key(row):
+    return row["user_id"], row["timestamp"], str(row["date"]), row["importo"], row["descrizione"]
+
+
+def not_written(rows):
+    # A crash between a flush's commit and the removal of its segment leaves rows that are already
+    # in the table. Ids are assigned on insert, so they are recognised by their content instead:
+    # as many of each (user, timestamp, date, amount, description) as the table already has are dropped.
+    pending = collections.Counter(log_key(row) for row in rows)
+    written = collections.Counter()
+    for user_id, date, importo in {(row["user_id"], row["date"], row["importo"]) for row in rows}:
+        # (user_id, date, importo) index lookups
+        query = Transazione.select().where(
+            Transazione.user_id == user_id, Transazione.date == date, Transazione.importo == importo
+        )
+        written.update(key for key in (log_key(t.__data__) for t in query) if key in pending)
+    kept = []
+    for row in rows:
+        if written[log_key(row)]:
+            written[log_key(row)] -= 1
+        else:
+            kept.append(row)
+    return kept
+
+
+def replay(path):
+    segments = sorted(glob.glob(f"{path}.*")) + ([path] if os.path.exists(path) else [])
+    rows = [row for segment in segments for row in read_log(segment)]
+    for row in rows:
+        if "categoria" in row:
+            # Logged before categories had ids
+            row["categoria_id"] = category_id(row["user_id"], row.pop("categoria"))
+    rows = not_written(rows)
+    if rows:
+        write_rows(rows)
+    for segment in segments:
+        os.remove(segment)
+    return len(rows)
+
+
+class WriteBehindBuffer:
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.flushing = []  # rows of the flush in progress, until they are committed
+        self.lock = asyncio.Lock()
+        self._log = open(path, "a", encoding="utf-8")
+
+    def append(self, row):
+        # Returns True when the buffer should be flushed right away
+        self._log.write(json.dumps(row) + "\n")
+        self._log.flush()
+        if config.WRITE_BEHIND_FSYNC:
+            os.fsync(self._log.fileno())
+        self.rows.append(row)
+        return len(self.rows) >= config.WRITE_BEHIND_MAX_ROWS
+
+    def _rotate(self):
+        # Pending rows move to a numbered segment, new rows go to a fresh log
+        rows, self.rows = self.rows, []
+        self._log.close()
+        segment = f"{self.path}.{time.time_ns()}"
+        os.replace(self.path, segment)
+        self._log = open(self.path, "a", encoding="utf-8")
+        return rows, segment
+
+    async def flush(self):
+        async with self.lock:
+            if not self.rows:
+                return 0
+            rows, segment = self._rotate()
+            self.flushing = rows
+            await asyncio.to_thread(self._write, rows)
+            # Only now the rows are durable in the database
+            os.remove(segment)
+            for user_id in {row["user_id"] for row in rows}:
+                reports.invalidate(user_id)
+            return len(rows)
+
+    def _write(self, rows):
+        write_rows(rows)
+        # In the table from now on
+        self.flushing = []
+
+    def pending(self, user_id):
+        # Rows of user_id acknowledged but maybe not in the table yet
+        return [row for row in self.flushing + self.rows if row["user_id"] == user_id]
+
+    def close(self):
+        self._log.close()
+
+
+def log_path(shard=None):
+    return f"db/ingest-{shard[0]}.log" if shard else "db/ingest.log"
+
+
+def add(row, application):
+    if buffer.append(row):
+        application.create_task(buffer.flush())
+
+
+def add_many(rows, application):
+    if any([buffer.append(row) for row in rows]):
+        application.create_task(buffer.flush())
+
+
+def pending(user_id):
+    return buffer.pending(user_id) if buffer else []
+
+
+async def flush_job(context):
+    try:
+        await buffer.flush()
+    except peewee.PeeweeException as e:
+        # Rows stay in their log segment and are replayed at the next start
+        logger.error(f"Write-behind: flush fallito: {e!r}")
+
+
+def start(application):
+    global buffer
+    if not config.WRITE_BEHIND:
+        return
+    path = log_path(application.bot_data.get("shard"))
+    replayed = replay(path)
+    if replayed:
+        logger.info(f"Write-behind: {replayed} transazioni recuperate da {path}.")
+    buffer = WriteBehindBuffer(path)
+    if application.job_queue is None:
+        logger.warning("JobQueue non disponibile, le transazioni vengono scritte solo a buffer pieno.")
+        return
+    application.job_queue.run_repeating(flush_job, interval=config.WRITE_BEHIND_INTERVAL_MS / 1000, name="ingest")
+
+
+async def stop(application):
+    global buffer
+    if buffer:
+        await buffer.flush()
+        buffer.close()
+        buffer = None
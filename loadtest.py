@@ -0,0 +1,430 @@
+"""
+Offline load testing against a stub Telegram API.
+
+    python loadtest.py shards [users] [sessions] [workers ...]
+    python loadtest.py flow [users] [sessions] [latency_ms]
+    python loadtest.py digest [users] [rate] [flood_limit]
+
+The storage and flow checks that must pass are tests (tests/test_storage.py), on the same stubs.
+"""
+import asyncio
+import collections
+import datetime
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+import config
+import sharding
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Salvaspese", "username": "salvaspese_bot"}
+CATEGORIES = ["🍔 Cibo", "📨 Bollette", "🏠 Casa", "🕹️ Svago", "⛽ Benzina"]  # among the default ones
+DESCRIPTIONS = ["kebab da ciccio", "spesa conad", "benzina", "bolletta luce", "cinema", "pizza", "farmacia"]
+
+_message_ids = itertools.count(1)
+
+
+def stub_message(params):
+    return {
+        "message_id": params.get("message_id") or next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": params.get("chat_id", 0), "type": "private"},
+        "from": BOT_USER,
+        "text": params.get("text") or params.get("caption") or "",
+    }
+
+
+def stub_result(endpoint, params):
+    if endpoint == "getMe":
+        return BOT_USER
+    if endpoint == "sendMediaGroup":
+        return [stub_message(params) for _ in params.get("media", [])]
+    if endpoint.startswith(("send", "edit")):
+        return stub_message(params)
+    return True
+
+
+class StubRequest(BaseRequest):
+    """Answers every Bot API call locally, optionally after `latency` seconds.
+
+    With a flood_limit, more than flood_limit messages sent within a second get a 429 (RetryAfter)
+    like Telegram's flood control.
+    """
+
+    def __init__(self, latency=0.0, flood_limit=0):
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.sent = collections.deque()  # times of the last second's sendMessage
+        self.calls = collections.Counter()
+        self.texts = []  # of the messages sent and edited, in order
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.flood_limit and endpoint == "sendMessage":
+            now = time.monotonic()
+            while self.sent and self.sent[0] < now - 1:
+                self.sent.popleft()
+            if len(self.sent) >= self.flood_limit:
+                self.calls["429"] += 1
+                error = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1"}
+                return 429, json.dumps({**error, "parameters": {"retry_after": 1}}).encode()
+            self.sent.append(now)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if endpoint in ("sendMessage", "editMessageText"):
+            self.texts.append(params["text"])
+        return 200, json.dumps({"ok": True, "result": stub_result(endpoint, params)}).encode()
+
+
+def stub_builder(latency=0.0):
+    builder = ApplicationBuilder()
+    builder.token("123456:stub")
+    builder.request(StubRequest(latency))
+    builder.get_updates_request(StubRequest(latency))
+    builder.updater(None)
+    return builder
+
+
+def user_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Utente {user_id}"}
+
+
+def text_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_json(user_id),
+            "text": text,
+        },
+    }
+
+
+def command_update(update_id, user_id, command):
+    # command: "menu", or with arguments "profile 5"
+    update = text_update(update_id, user_id, f"/{command}")
+    # Without the entity CommandHandler doesn't see a command
+    update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0]) + 1}]
+    return update
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_json(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "La tua transazione",
+            },
+        },
+    }
+
+
+def expense_session(update_ids, user_id):
+    amount = f"{random.randint(1, 200)}.{random.randint(0, 99):02d}"
+    return [
+        text_update(next(update_ids), user_id, f"{amount} {random.choice(DESCRIPTIONS)}"),
+        callback_update(next(update_ids), user_id, "salva_transazione"),
+    ]
+
+
+def edit_session(update_ids, user_id):
+    # Description and amount changed by hand before saving
+    amount = f"{random.randint(1, 200)}.{random.randint(0, 99):02d}"
+    return [
+        text_update(next(update_ids), user_id, f"{amount} {random.choice(DESCRIPTIONS)}"),
+        callback_update(next(update_ids), user_id, "cambia_descrizione"),
+        text_update(next(update_ids), user_id, random.choice(DESCRIPTIONS)),
+        callback_update(next(update_ids), user_id, "cambia_importo"),
+        text_update(next(update_ids), user_id, f"{random.randint(1, 200)},{random.randint(0, 99):02d}"),
+        callback_update(next(update_ids), user_id, "salva_transazione"),
+    ]
+
+
+def category_session(update_ids, user_id):
+    # "cambia_data" is the callback of the "Cambia categoria" button
+    amount = f"{random.randint(1, 200)}.{random.randint(0, 99):02d}"
+    return [
+        text_update(next(update_ids), user_id, f"{amount} {random.choice(DESCRIPTIONS)}"),
+        callback_update(next(update_ids), user_id, "cambia_data"),
+        callback_update(next(update_ids), user_id, f"cat_{random.choice(CATEGORIES)}"),
+        callback_update(next(update_ids), user_id, "salva_transazione"),
+    ]
+
+
+def batch_session(update_ids, user_id):
+    # Several expenses in one message, saved together
+    lines = [
+        f"{random.randint(1, 200)}.{random.randint(0, 99):02d} {random.choice(DESCRIPTIONS)}"
+        for _ in range(random.randint(2, 5))
+    ]
+    return [
+        text_update(next(update_ids), user_id, "\n".join(lines)),
+        callback_update(next(update_ids), user_id, "batch_salva"),
+    ]
+
+
+def report_session(update_ids, user_id):
+    from utils import report_presets
+
+    _, start_date, end_date = random.choice(report_presets())
+    return [
+        command_update(next(update_ids), user_id, "menu"),
+        callback_update(next(update_ids), user_id, "goto_reports"),
+        callback_update(next(update_ids), user_id, f"reports_{start_date}_{end_date}"),
+    ]
+
+
+def custom_report_session(update_ids, user_id):
+    # The "📅 Personalizzato" range, typed as a year
+    return [
+        command_update(next(update_ids), user_id, "menu"),
+        callback_update(next(update_ids), user_id, "goto_reports"),
+        callback_update(next(update_ids), user_id, "reports_personalizzato"),
+        text_update(next(update_ids), user_id, str(datetime.date.today().year)),
+    ]
+
+
+# (session, weight) of the simulated users' sessions in bench_flow
+SCENARIOS = [(expense_session, 6), (edit_session, 2), (category_session, 1), (report_session, 1)]
+
+
+def mixed_session(update_ids, user_id):
+    session = random.choices([scenario for scenario, _ in SCENARIOS], [weight for _, weight in SCENARIOS])[0]
+    return session(update_ids, user_id)
+
+
+def synthetic_updates(users, sessions, session=expense_session):
+    # Users interleaved, each user's own updates in order
+    update_ids = itertools.count(1)
+    user_ids = [100000 + i for i in range(users)]
+    for _ in range(sessions):
+        for user_id in user_ids:
+            yield from session(update_ids, user_id)
+
+
+async def replay(updates, builder=None, latencies=None, on_build=None):
+    # latencies: list collecting each update's end-to-end milliseconds
+    import main
+
+    application = main.build_application(builder or stub_builder())
+    if on_build:
+        on_build(application)
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        for data in updates:
+            # Same path as the Application's own update fetcher, through the update processor
+            start = time.perf_counter()
+            update = Update.de_json(data, application.bot)
+            await application.update_processor.process_update(update, application.process_update(update))
+            if latencies is not None:
+                latencies.append((time.perf_counter() - start) * 1000)
+        await application.stop()
+        await main.post_shutdown(application)
+    return application
+
+
+def timed(callback, timings):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            timings[callback.__name__].append((time.perf_counter() - start) * 1000)
+
+    return wrapper
+
+
+def instrument_handlers(application, timings):
+    # Wraps every handler's callback, conversation states included, to time it by name
+    from telegram.ext import ConversationHandler
+
+    handlers = [handler for group in application.handlers.values() for handler in group]
+    for handler in list(handlers):
+        if isinstance(handler, ConversationHandler):
+            handlers += handler.entry_points + handler.fallbacks
+            handlers += [state_handler for state in handler.states.values() for state_handler in state]
+    for handler in handlers:
+        if not isinstance(handler, ConversationHandler):
+            handler.callback = timed(handler.callback, timings)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return values * 3
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def bench_flow(users=2000, sessions=3, latency_ms=0):
+    # End to end through the ConversationHandler: mixed sessions (SCENARIOS) of many users,
+    # interleaved, against the stub Telegram API (each call answered after latency_ms)
+    import main  # noqa: F401 (configures logging)
+    import utils
+    from sessions import evict_idle
+
+    logging.getLogger().setLevel(logging.WARNING)
+    updates = list(synthetic_updates(users, sessions, session=mixed_session))
+    timings = collections.defaultdict(list)  # handler name -> milliseconds
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        application = asyncio.run(
+            replay(
+                updates,
+                stub_builder(latency_ms / 1000),
+                latencies,
+                on_build=lambda application: instrument_handlers(application, timings),
+            )
+        )
+        elapsed = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        saved = utils.Transazione.select().count()
+        utils.db.close()
+
+    calls = application.bot.request.calls
+    print(
+        f"{len(updates)} update, {users} utenti, {saved} transazioni salvate, "
+        f"{sum(calls.values())} chiamate API in {elapsed:.1f}s: {len(updates) / elapsed:.0f} update/s"
+    )
+    users_data = len(application.user_data)
+    evict_idle(application, 0)
+    print(
+        f"memoria: picco RSS +{(rss_after - rss_before) / 1024:.1f}MB, {users_data} user_data, "
+        f"{len(application.user_data)} dopo lo sweep degli inattivi"
+    )
+    print(f"{'handler':<36}{'calls':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = sorted(timings.items(), key=lambda item: -sum(item[1]))
+    for name, values in [("(update)", latencies)] + rows:
+        p50, p95, p99 = percentiles(values)
+        print(f"{name:<36}{len(values):>8}{p50:>8.2f}ms{p95:>8.2f}ms{p99:>8.2f}ms{max(values):>8.2f}ms")
+
+
+def bench_digest(users=1000, rate=100, flood_limit=0):
+    # Monthly then weekly digests of `users` users through digest.send_digests, against the stub
+    # Telegram API answering 429 beyond flood_limit messages per second
+    from telegram import Bot
+
+    import digest
+    import ingest
+    import utils
+
+    config.DIGEST_RATE = rate
+    today = datetime.date.today()
+    monday = today - datetime.timedelta(days=today.weekday())
+    week = digest.digest_period("settimanale", monday)
+    month = digest.digest_period("mensile", today.replace(day=1))
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.init_db("sqlite", path=f"{tmp}/sqlite.db")
+        utils.db.create_tables([utils.Transazione, utils.Categoria, utils.Setting, utils.Riepilogo])
+        utils.Categoria.insert_many([{"user_id": 0, "name": name} for name in CATEGORIES]).execute()
+        rows = []
+        for user_id in range(1000, 1000 + users):
+            for start, end in (week, month):
+                for _ in range(5):
+                    date = start + datetime.timedelta(days=random.randint(0, (end - start).days))
+                    rows.append(
+                        {
+                            "timestamp": int(time.time()),
+                            "date": date,
+                            "user_id": user_id,
+                            "importo": random.randint(100, 50000),
+                            "descrizione": random.choice(DESCRIPTIONS),
+                            "categoria_id": random.choice([None, *range(1, len(CATEGORIES) + 1)]),
+                        }
+                    )
+        ingest.write_rows(rows)
+        # One user in ten wants the weekly digest, one in twenty none, the others the monthly one
+        choices = {user_id: "mensile" for user_id in range(1000, 1000 + users)}
+        choices.update({user_id: ["settimanale", "no"][user_id % 2] for user_id in range(1000, 1000 + users, 10)})
+        utils.Setting.insert_many([{"user_id": u, "setting3": c} for u, c in choices.items()]).execute()
+
+        async def run():
+            bot = Bot("123456:stub", request=StubRequest(flood_limit=flood_limit))
+            async with bot:
+                for kind, day in (("mensile", today.replace(day=1)), ("settimanale", monday)):
+                    start = time.perf_counter()
+                    stats = await digest.send_digests(bot, kind, day)
+                    elapsed = time.perf_counter() - start
+                    print(f"{kind:<12} {dict(stats)} in {elapsed:.1f}s: {stats['inviati'] / elapsed:.0f} messaggi/s")
+            print(f"chiamate API: {dict(bot.request.calls)}")
+
+        asyncio.run(run())
+        utils.db.close()
+
+
+def bench_shards(users=200, sessions=5, worker_counts=(1, 2, 4)):
+    updates = list(synthetic_updates(users, sessions))
+    print(f"{len(updates)} update, {users} utenti")
+    print(f"{'workers':>8}{'seconds':>10}{'updates/s':>12}")
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            events = multiprocessing.get_context("spawn").Queue()
+            queues, processes = sharding.start_workers(
+                workers,
+                databases=[f"{tmp}/sqlite-{index}.db" for index in range(workers)],
+                events=events,
+                builder_factory=stub_builder,
+                log_level=logging.WARNING,
+            )
+            for _ in range(workers):
+                events.get()  # ready
+
+            start = time.perf_counter()
+            for data in updates:
+                sharding.route(queues, data)
+            for q in queues:
+                q.put(None)
+            processed = sum(events.get()[2] for _ in range(workers))
+            elapsed = time.perf_counter() - start
+            for process in processes:
+                process.join()
+        print(f"{workers:>8}{elapsed:>10.2f}{processed / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    what = sys.argv[1] if len(sys.argv) > 1 else "shards"
+    if what == "shards":
+        args = [int(arg) for arg in sys.argv[2:]]
+        bench_shards(*args[:2], *([tuple(args[2:])] if args[2:] else []))
+    elif what == "flow":
+        bench_flow(*[int(arg) for arg in sys.argv[2:5]])
+    elif what == "digest":
+        bench_digest(*[int(arg) for arg in sys.argv[2:5]])
@@ -1,6 +1,9 @@
+import asyncio
 import datetime
+import html
 import logging
-import tempfile
+import os
+import sqlite3
 import time
 from warnings import filterwarnings
 
@@ -18,22 +21,59 @@ from telegram.ext import (
 )
 from telegram.warnings import PTBUserWarning
 
+import archive
+import backup
+import budget
 import config
+import diagnostics
+import digest
+import exchange
+import ingest
+import outbox
+import reports
+import sessions
+import snapshots
 from utils import (
+    Budget,
     Categoria,
+    PendingTransaction,
     Setting,
     Transazione,
-    analyze_transactions,
+    Riepilogo,
+    UnitOfWork,
+    add_category,
+    add_to_rollup,
+    archived_years,
+    batch_table,
+    category_id,
+    category_name,
+    category_names,
     current_transaction,
     elenco_transazioni,
+    find_duplicate,
+    forget_user,
+    format_importo,
     get_categories,
     is_first_word_number,
     load_user_settings,
     make_editing_keyboard,
-    plotly_by_cat,
-    plotly_by_month,
-    plotly_by_month_and_category,
+    parse_batch,
+    parse_entry,
+    parse_importo,
+    parse_period,
+    previous_month,
+    query_report,
+    remember_transactions,
+    report_presets,
+    rollback_update,
+    run_migrations,
+    save_user_setting,
+    search_transactions,
+    set_categories,
+    text_report,
+    transactions_table,
     try_categorize,
+    try_categorize_many,
 )
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
@@ -48,76 +88,144 @@ logger = logging.getLogger(__name__)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     logger.info("User %s started the conversation.", user.first_name)
-    user_id = update.effective_user.id
-    load_user_settings(context, user_id)
 
-    if not is_first_word_number(update.message.text):
+    if not is_first_word_number(update.message.text, context.user_data["valuta"]):
         logger.info("Not a number, ending.")
         return ConversationHandler.END
 
-    testo = update.message.text.split()
-    importo, categoria, descrizione = None, None, None
+    if len(update.message.text.strip().splitlines()) > 1:
+        return await start_batch(update, context)
+
+    # "12.50 pranzo", or in another currency "12.50 USD pranzo", "$12.50 pranzo"
+    importo, valuta, descrizione = parse_entry(update.message.text, context.user_data["valuta"])
+    categoria = None
     timestamp = int(time.time())
     data = datetime.date.today()
 
-    if len(testo) >= 2:
-        importo, descrizione = testo[0], " ".join(testo[1:])
+    if descrizione:
         categoria = try_categorize(update.effective_user.id, descrizione.lower())
-        context.user_data["transazione_corrente"] = {
-            "importo": float(importo),
-            "categoria": categoria,
-            "descrizione": descrizione,
-            "timestamp": timestamp,
-            "data": data,
-        }
-    else:
-        importo = testo[0]
-        context.user_data["transazione_corrente"] = {
-            "importo": importo,
-            "categoria": None,
-            "descrizione": None,
-            "timestamp": timestamp,
-            "data": data,
-        }
+    context.user_data["transazione_corrente"] = PendingTransaction(
+        importo, categoria, descrizione, timestamp, data, valuta
+    )
     transazione = current_transaction(context)
 
     reply_markup = make_editing_keyboard()
 
     # Send message with text and appended InlineKeyboard
-    await update.message.reply_html(f"La tua transazione:\n\n{transazione}", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, f"La tua transazione:\n\n{transazione}", reply_markup=reply_markup)
     return "SHOW"
 
 
+async def start_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: start_batch.")
+    user_id = update.effective_user.id
+    entries, invalid = parse_batch(update.message.text, context.user_data["valuta"])
+
+    timestamp = int(time.time())
+    data = datetime.date.today()
+    categorie = try_categorize_many(user_id, [(descrizione or "").lower() for _, _, descrizione in entries])
+    context.user_data["batch_corrente"] = [
+        PendingTransaction(importo, categoria if descrizione else None, descrizione, timestamp, data, valuta)
+        for (importo, valuta, descrizione), categoria in zip(entries, categorie)
+    ]
+
+    table = batch_table(context.user_data["batch_corrente"], context.user_data["valuta"])
+    ignorate = "\n\nRighe ignorate:\n" + html.escape("\n".join(invalid)) if invalid else ""
+    reply_markup = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton("❌ Annulla", callback_data="batch_annulla"),
+                InlineKeyboardButton(f"✅ Salva {len(entries)}", callback_data="batch_salva"),
+            ]
+        ]
+    )
+    await outbox.send(
+        update.effective_chat,
+        f'Le tue transazioni:\n\n<pre><code class="text">{table}</code></pre>{ignorate}',
+        reply_markup=reply_markup,
+    )
+    return "BATCH"
+
+
+async def save_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: save_batch.")
+    query = update.callback_query
+    await outbox.answer(query)
+
+    user_id = int(update.effective_user.id)
+    batch = context.user_data.pop("batch_corrente", [])
+    valuta = exchange.report_currency(context.user_data["valuta"])
+    rows = [
+        {
+            "timestamp": entry.timestamp,
+            "date": entry.data.strftime("%Y-%m-%d"),
+            "user_id": user_id,
+            "importo": entry.importo,
+            "descrizione": entry.descrizione,
+            "categoria_id": category_id(user_id, entry.categoria),
+            "valuta": entry.valuta or valuta,
+        }
+        for entry in batch
+    ]
+    # Before the rows are written, see budget.record
+    over = budget.record(rows, context.user_data["valuta"]) if rows else []
+    if ingest.buffer:
+        ingest.add_many(rows, context.application)
+    else:
+        # In the update's transaction: a single insert_many and one times_used update per category
+        ingest.insert_rows(rows)
+        for row in rows:
+            snapshots.append(row)
+    remember_transactions(rows)
+    logger.info(f"{len(rows)} transazioni salvate.")
+    reports.invalidate(user_id)
+
+    avvisi = budget_warnings(user_id, over, context.user_data["valuta"])
+    await outbox.edit(query.message, text=f"{len(rows)} transazioni salvate!\n\n{query.message.text_html}{avvisi}")
+    return ConversationHandler.END
+
+
+async def annulla_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: annulla_batch.")
+    query = update.callback_query
+    await outbox.answer(query)
+
+    context.user_data.pop("batch_corrente", None)
+
+    await outbox.delete(query.message)
+    return ConversationHandler.END
+
+
 async def show_transazione(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: show_transazione.")
     query = update.callback_query
     if query:
-        await query.answer()
+        await outbox.answer(query)
 
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
     if query:
-        await query.edit_message_text(
+        await outbox.edit(
+            query.message,
             text=f"{transazione}\n\nCosa vuoi fare?",
             reply_markup=reply_markup,
-            parse_mode="HTML",
         )
     else:
-        await update.message.reply_html(text=f"{transazione}\n\nCosa vuoi fare?", reply_markup=reply_markup)
+        await outbox.send(update.effective_chat, text=f"{transazione}\n\nCosa vuoi fare?", reply_markup=reply_markup)
     return "SHOW"
 
 
 async def cambia_descrizione(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_descrizione.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"{transazione}\n\nInserisci una nuova descrizione:",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "EDIT_DESC"
 
@@ -125,17 +233,17 @@ async def cambia_descrizione(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def cambia_descrizione_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_descrizione_actual.")
     nuova_descrizione = update.message.text
-    context.user_data["transazione_corrente"]["descrizione"] = nuova_descrizione
+    context.user_data["transazione_corrente"].descrizione = nuova_descrizione
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await update.message.reply_html(text=f"Descrizione cambiata!\n\n{transazione}", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text=f"Descrizione cambiata!\n\n{transazione}", reply_markup=reply_markup)
     return "SHOW"
 
 
 async def cambia_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_categoria.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
     user_id = int(update.effective_user.id)
 
     categorie = get_categories(user_id)  # (cat.name, cat.times_used)
@@ -149,10 +257,10 @@ async def cambia_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(categorie_x2)
 
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"{transazione}\n\nInserisci una nuova categoria:",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "EDIT_CAT"
 
@@ -160,28 +268,28 @@ async def cambia_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cambia_categoria_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_categoria_actual.")
     nuova_categoria = update.message.text
-    context.user_data["transazione_corrente"]["categoria"] = nuova_categoria
+    context.user_data["transazione_corrente"].categoria = nuova_categoria
 
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await update.message.reply_html(text=f"Categoria cambiata!\n\n{transazione}", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text=f"Categoria cambiata!\n\n{transazione}", reply_markup=reply_markup)
     return "SHOW"
 
 
 async def cambia_categoria_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_categoria_buttons.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     nuova_categoria = query.data.split("_")[1]
-    context.user_data["transazione_corrente"]["categoria"] = nuova_categoria
+    context.user_data["transazione_corrente"].categoria = nuova_categoria
 
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"Categoria cambiata!\n\n{transazione}",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "SHOW"
 
@@ -189,7 +297,7 @@ async def cambia_categoria_buttons(update: Update, context: ContextTypes.DEFAULT
 async def cambia_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_data.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     oggi = datetime.datetime.now().strftime("%Y-%m-%d")
     ieri = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
@@ -206,10 +314,10 @@ async def cambia_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"{transazione}\n\nSeleziona una nuova data:",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "EDIT_DATA"
 
@@ -217,47 +325,47 @@ async def cambia_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cambia_data_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_data_actual.")
     data = datetime.date.fromisoformat(update.message.text)
-    context.user_data["transazione_corrente"]["data"] = data
+    context.user_data["transazione_corrente"].data = data
 
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await update.message.reply_html(text=f"Data cambiata!\n\n{transazione}", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text=f"Data cambiata!\n\n{transazione}", reply_markup=reply_markup)
     return "SHOW"
 
 
 async def cambia_data_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_data_buttons.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     if query.data == "data_custom":
         reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
-        await query.edit_message_text(
+        await outbox.edit(
+            query.message,
             text="Inserisci una data nel formato YYYY-MM-DD:",
             reply_markup=reply_markup,
-            parse_mode="HTML",
         )
         return "EDIT_DATA"
 
     nuova_data_str = query.data.split("_")[1]
     try:
         nuova_data_datetime = datetime.datetime.strptime(nuova_data_str, "%Y-%m-%d")
-        context.user_data["transazione_corrente"]["data"] = nuova_data_datetime
+        context.user_data["transazione_corrente"].data = nuova_data_datetime
     except ValueError:
         reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
-        await query.edit_message_text(
+        await outbox.edit(
+            query.message,
             text="Data non valida, inserisci una data nel formato YYYY-MM-DD:",
             reply_markup=reply_markup,
-            parse_mode="HTML",
         )
         return "EDIT_DATA"
 
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"Data cambiata!\n\n{transazione}",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "SHOW"
 
@@ -265,14 +373,14 @@ async def cambia_data_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def cambia_importo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_importo.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
     transazione = current_transaction(context)
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"{transazione}\n\nInserisci un nuovo importo:",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "EDIT_IMPORTO"
 
@@ -280,65 +388,110 @@ async def cambia_importo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cambia_importo_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: cambia_importo_actual.")
     nuovo_importo = update.message.text
-    context.user_data["transazione_corrente"]["importo"] = float(nuovo_importo)
+    try:
+        # "12.50", or "12.50 USD" to change the currency too
+        importo, valuta, _ = parse_entry(nuovo_importo, context.user_data["valuta"])
+        context.user_data["transazione_corrente"].importo = importo
+        context.user_data["transazione_corrente"].valuta = valuta
+    except ValueError:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
+        await outbox.send(
+            update.effective_chat, text="Importo non valido, inserisci un nuovo importo:", reply_markup=reply_markup
+        )
+        return "EDIT_IMPORTO"
     reply_markup = make_editing_keyboard()
     transazione = current_transaction(context)
-    await update.message.reply_html(text=f"Importo cambiato!\n\n{transazione}", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text=f"Importo cambiato!\n\n{transazione}", reply_markup=reply_markup)
     return "SHOW"
 
 
 async def annulla_transazione(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: annulla_transazione.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
-    context.user_data["transazione_corrente"] = {}
+    context.user_data.pop("transazione_corrente", None)
 
-    await query.delete_message()
+    await outbox.delete(query.message)
     return ConversationHandler.END
 
 
 async def save_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: save_transaction.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     transazione_str = current_transaction(context)
-    transaction = current_transaction(context, return_dict=True)
+    transaction = context.user_data["transazione_corrente"]
 
-    datetime_str = transaction["data"].strftime("%Y-%m-%d")
+    datetime_str = transaction.data.strftime("%Y-%m-%d")
 
     user_id = int(update.effective_user.id)
-    Transazione.create(
-        timestamp=transaction["timestamp"],
-        date=datetime_str,
-        user_id=user_id,
-        importo=transaction["importo"],
-        descrizione=transaction["descrizione"],
-        categoria=transaction["categoria"],
-    )
-    logger.info("Transazione creata.")
-    dbquery = Categoria.select().where(Categoria.user_id == user_id, Categoria.name == transaction["categoria"])
-    if dbquery:
-        old_used = dbquery[0].times_used
-    else:
-        old_used = 0
-    Categoria.update(times_used=old_used + 1).where(
-        Categoria.user_id == user_id, Categoria.name == transaction["categoria"]
-    ).execute()
-    logger.info(f'Categoria {transaction["categoria"]} aggiornata.')
+    row = {
+        "timestamp": transaction.timestamp,
+        "date": datetime_str,
+        "user_id": user_id,
+        "importo": transaction.importo,
+        "descrizione": transaction.descrizione,
+        "categoria_id": category_id(user_id, transaction.categoria),
+        "valuta": transaction.valuta or exchange.report_currency(context.user_data["valuta"]),
+    }
+    duplicate = find_duplicate(row) if query.data != "salva_comunque" else None
+    if duplicate is not None:
+        orario = datetime.datetime.fromtimestamp(duplicate).strftime("%H:%M")
+        reply_markup = InlineKeyboardMarkup(
+            [
+                [
+                    InlineKeyboardButton("❌ Annulla", callback_data="annulla_transazione"),
+                    InlineKeyboardButton("✅ Salva comunque", callback_data="salva_comunque"),
+                ]
+            ]
+        )
+        await outbox.edit(
+            query.message,
+            text=f"{transazione_str}\n\n⚠️ Hai già salvato questa transazione alle {orario}, la salvo di nuovo?",
+            reply_markup=reply_markup,
+        )
+        return "SHOW"
 
-    await query.edit_message_text(text=f"Transazione salvata!\n\n{transazione_str}", parse_mode="HTML")
+    # Before the row is written, see budget.record
+    over = budget.record([row], context.user_data["valuta"])
+    if ingest.buffer:
+        ingest.add(row, context.application)
+        logger.info("Transazione accodata.")
+    else:
+        Transazione.create(**row)
+        logger.info("Transazione creata.")
+        Categoria.update(times_used=Categoria.times_used + 1).where(Categoria.id == row["categoria_id"]).execute()
+        logger.info(f"Categoria {transaction.categoria} aggiornata.")
+        add_to_rollup(row)
+        snapshots.append(row)
+    remember_transactions([row])
+    reports.invalidate(user_id)
+    context.user_data.pop("transazione_corrente", None)
+
+    avvisi = budget_warnings(user_id, over, context.user_data["valuta"])
+    await outbox.edit(query.message, text=f"Transazione salvata!\n\n{transazione_str}{avvisi}")
     return ConversationHandler.END
 
 
+def budget_warnings(user_id, over, valuta):
+    # Text for the categories a save took over budget, see budget.record
+    return "".join(
+        f"\n\n⚠️ Budget di {html.escape(category_name(user_id, categoria_id))} superato: "
+        f"{format_importo(spesa)} su {format_importo(limite)} {valuta or ''}"
+        for categoria_id, spesa, limite in over
+    )
+
+
 async def menu_categorie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_categorie.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
     keyboard = [
         [InlineKeyboardButton("📃 Nuova Lista", callback_data="menu_categorie_nuovalista")],
         [InlineKeyboardButton("➕ Nuova Categoria", callback_data="menu_categorie_nuovacat")],
+        [InlineKeyboardButton("💰 Budget", callback_data="menu_budget")],
         [
             InlineKeyboardButton("🔙 Indietro", callback_data="goto_menu"),
         ],
@@ -348,16 +501,20 @@ async def menu_categorie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = int(update.effective_user.id)
     categorie = get_categories(user_id)  # (cat.name, cat.times_used)
     cats = "\n".join(cat[0] for cat in categorie)
-    await query.edit_message_text(text=f"🏷️ CATEGORIE\n\n{cats}", parse_mode="HTML", reply_markup=reply_markup)
+    await outbox.edit(query.message, text=f"🏷️ CATEGORIE\n\n{cats}", reply_markup=reply_markup)
 
 
 async def menu_categorie_nuovalista(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_categorie_nuovalista.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
 
-    await query.message.reply_html(text="Inviami una nuova lista:", reply_markup=reply_markup)
+    await outbox.send(
+        query.message.chat,
+        text="Inviami una nuova lista, una categoria per riga.\nPer rinominare una categoria: <code>Vecchio => Nuovo</code>",
+        reply_markup=reply_markup,
+    )
     return "CAT_NEWLIST"
 
 
@@ -366,35 +523,29 @@ async def menu_categorie_nuovalista_actual(update: Update, context: ContextTypes
 
     if update.message.text:
         user_id = update.effective_user.id
-        new_cat = update.message.text.split("\n")
-        new_cat_list = [(cat, 0) for cat in new_cat]
-        old_cat_list = get_categories(user_id)
-
-        Categoria.delete().where(Categoria.user_id == user_id).execute()
-        for new_cat in new_cat_list:
-            if new_cat[0] in [cat[0] for cat in old_cat_list]:
-                times_used = [old_cat[1] for old_cat in old_cat_list if old_cat[0] == new_cat[0]][0]
-                Categoria.create(user_id=user_id, name=new_cat[0], times_used=times_used)
-            else:
-                Categoria.create(user_id=user_id, name=new_cat[0], times_used=0)
+        # Categories left out are only hidden, "Vecchio => Nuovo" renames keep the history
+        if set_categories(user_id, update.message.text.split("\n")):
+            snapshots.invalidate(user_id)
+            budget.invalidate(user_id)
+        reports.invalidate(user_id)
 
         new_cats = "\n".join([cat[0] for cat in get_categories(user_id)])
-        await update.message.reply_html(text=f"Lista salvata!\n\n{new_cats}")
+        await outbox.send(update.effective_chat, text=f"Lista salvata!\n\n{new_cats}")
         await menu(update, context)
         return ConversationHandler.END
 
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
-    await update.message.reply_html(text="Inviami una nuova lista:", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text="Inviami una nuova lista:", reply_markup=reply_markup)
     return "CAT_NEWLIST"
 
 
 async def menu_categorie_nuovacat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_categorie_nuovacat.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
 
-    await query.message.reply_html(text="Scrivi una nuova categoria:", reply_markup=reply_markup)
+    await outbox.send(query.message.chat, text="Scrivi una nuova categoria:", reply_markup=reply_markup)
     return "CAT_NEW"
 
 
@@ -403,28 +554,97 @@ async def menu_categorie_nuovacat_actual(update: Update, context: ContextTypes.D
 
     if update.message.text:
         user_id = update.effective_user.id
-        Categoria.create(user_id=user_id, name=update.message.text, times_used=0)
+        add_category(user_id, update.message.text)
         new_cats = "\n".join([cat[0] for cat in get_categories(user_id)])
-        await update.message.reply_html(text=f"Categoria creata!\n\n{new_cats}")
-        if not context.user_data["transazione_corrente"]:
+        await outbox.send(update.effective_chat, text=f"Categoria creata!\n\n{new_cats}")
+        if not context.user_data.get("transazione_corrente"):
             await menu(update, context)
             return ConversationHandler.END
         else:
-            context.user_data["transazione_corrente"]["categoria"] = update.message.text
+            context.user_data["transazione_corrente"].categoria = update.message.text
             await show_transazione(update, context)
             return "SHOW"
 
     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
-    await update.message.reply_html(text="Scrivi una nuova categoria:", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, text="Scrivi una nuova categoria:", reply_markup=reply_markup)
     return "CAT_NEW"
 
 
+async def menu_budget(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_budget.")
+    query = update.callback_query
+    await outbox.answer(query)
+    user_id = update.effective_user.id
+    valuta = context.user_data["valuta"]
+
+    mese = datetime.date.today().strftime("%Y-%m")
+    limiti = budget.budgets(user_id)
+    spese = budget.spent(user_id, mese, valuta) if limiti else {}
+    righe = [
+        f"{html.escape(category_name(user_id, categoria_id))}: "
+        f"{format_importo(spese.get(categoria_id, 0))} su {format_importo(limite)} {valuta or ''}"
+        for categoria_id, limite in limiti.items()
+    ]
+    budget_str = "\n".join(righe) or "Nessun budget impostato."
+
+    categorie = get_categories(user_id)
+    ids = {name: categoria_id for categoria_id, name in category_names(user_id).items()}
+    categorie_inline = [InlineKeyboardButton(cat[0], callback_data=f"budget_{ids[cat[0]]}") for cat in categorie]
+    keyboard = [categorie_inline[i : i + 2] for i in range(0, len(categorie_inline), 2)]
+    keyboard.append([InlineKeyboardButton("🔙 Indietro", callback_data="back")])
+    await outbox.edit(
+        query.message,
+        text=f"💰 BUDGET MENSILI ({mese})\n\n{budget_str}\n\nScegli una categoria per cambiarne il budget:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+    return "BUDGET"
+
+
+async def menu_budget_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_budget_categoria.")
+    query = update.callback_query
+    await outbox.answer(query)
+    user_id = update.effective_user.id
+
+    categoria_id = int(query.data.split("_")[1])
+    context.user_data["budget_categoria"] = categoria_id
+    attuale = budget.budgets(user_id).get(categoria_id)
+    attuale_str = f" (ora {format_importo(attuale)} {context.user_data['valuta'] or ''})" if attuale else ""
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
+    await outbox.edit(
+        query.message,
+        text=f"Budget mensile di {html.escape(category_name(user_id, categoria_id))}{attuale_str}.\n"
+        "Scrivi un importo, 0 per toglierlo:",
+        reply_markup=reply_markup,
+    )
+    return "BUDGET_IMPORTO"
+
+
+async def menu_budget_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_budget_actual.")
+    try:
+        importo = parse_importo(update.message.text)
+    except ValueError:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]])
+        await outbox.send(
+            update.effective_chat, text="Importo non valido, scrivi un importo:", reply_markup=reply_markup
+        )
+        return "BUDGET_IMPORTO"
+
+    categoria_id = context.user_data.pop("budget_categoria", None)
+    if categoria_id is not None:
+        budget.set_budget(update.effective_user.id, categoria_id, importo)
+        await outbox.send(update.effective_chat, text="Budget salvato!" if importo > 0 else "Budget tolto!")
+    await menu(update, context)
+    return ConversationHandler.END
+
+
 async def menu_transazioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_transazioni.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
     current_month = datetime.date.today().strftime("%Y-%m")
-    last_month = (datetime.date.today() - datetime.timedelta(days=30)).strftime("%Y-%m")
+    last_month = previous_month()
 
     keyboard = [
         [
@@ -438,122 +658,270 @@ async def menu_transazioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text="💼 TRANSAZIONI", parse_mode="HTML", reply_markup=reply_markup)
+    await outbox.edit(query.message, text="💼 TRANSAZIONI", reply_markup=reply_markup)
     return "TRANSAZIONI"
 
 
 async def menu_transazioni_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_transazioni_button.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     month = query.data.split("_")[1]
 
     table = elenco_transazioni(context, update.effective_user.id, month)
     if not table:
-        await query.edit_message_text(
+        await outbox.edit(
+            query.message,
             text="Non ho trovato niente.",
-            parse_mode="HTML",
         )
         return ConversationHandler.END
 
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f'<pre><code class="text">{table}</code></pre>',
-        parse_mode="HTML",
     )
     return ConversationHandler.END
 
 
+async def cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: cerca.")
+    if not context.args:
+        await outbox.send(
+            update.effective_chat,
+            "Cosa cerchi? Scrivi una o più parole della descrizione, ad esempio <code>kebab</code>.",
+        )
+        return "SEARCH_TEXT"
+    context.user_data["ricerca"] = " ".join(context.args)
+    return await send_search(update.message, context, update.effective_user.id)
+
+
+async def cerca_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: cerca_actual.")
+    context.user_data["ricerca"] = update.message.text
+    return await send_search(update.message, context, update.effective_user.id)
+
+
+async def cerca_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: cerca_page.")
+    query = update.callback_query
+    await outbox.answer(query)
+    if "ricerca" not in context.user_data:
+        await outbox.edit(query.message, text="Ricerca scaduta, usa di nuovo /cerca.")
+        return ConversationHandler.END
+    page = int(query.data.split("_")[1])
+    return await send_search(query.message, context, update.effective_user.id, page, edit=True)
+
+
+async def send_search(message, context, user_id, page=0, edit=False):
+    text = context.user_data["ricerca"]
+    transactions, has_more = search_transactions(user_id, text, page)
+    # Archived years have no search index (archive.py)
+    years = archived_years()
+    note = f"\n\nℹ️ Non cerco negli anni archiviati (fino al {years[-1]})." if years else ""
+    if not transactions:
+        await outbox.send(message.chat, f"Non ho trovato niente.{note}")
+        return ConversationHandler.END
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Precedenti", callback_data=f"cerca_{page - 1}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Successivi ▶️", callback_data=f"cerca_{page + 1}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    table = transactions_table(context, user_id, transactions, date_format="%y-%m-%d", total=False)
+    text = f'🔎 {html.escape(text)} (pagina {page + 1})\n\n<pre><code class="text">{table}</code></pre>{note}'
+    if edit:
+        await outbox.edit(message, text=text, reply_markup=reply_markup)
+    else:
+        await outbox.send(message.chat, text, reply_markup=reply_markup)
+    return ConversationHandler.END
+
+
 async def menu_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_reports.")
     query = update.callback_query
-    await query.answer()
-    current_month = datetime.date.today().strftime("%Y-%m")
-    last_month = (datetime.date.today() - datetime.timedelta(days=30)).strftime("%Y-%m")
+    await outbox.answer(query)
 
     keyboard = [
-        [
-            InlineKeyboardButton("Mese corrente", callback_data=f"reports_{current_month}"),
-        ],
-        [
-            InlineKeyboardButton("Mese scorso", callback_data=f"reports_{last_month}"),
-        ],
-        [
-            InlineKeyboardButton("🔙 Indietro", callback_data="back"),
-        ],
+        [InlineKeyboardButton(label, callback_data=f"reports_{start_date}_{end_date}")]
+        for label, start_date, end_date in report_presets()
+    ]
+    keyboard += [
+        [InlineKeyboardButton("📅 Personalizzato", callback_data="reports_personalizzato")],
+        [InlineKeyboardButton("🔙 Indietro", callback_data="back")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text="📊 REPORTS", parse_mode="HTML", reply_markup=reply_markup)
+    await outbox.edit(query.message, text="📊 REPORTS", reply_markup=reply_markup)
     return "REPORTS"
 
 
+async def menu_reports_personalizzato(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_reports_personalizzato.")
+    query = update.callback_query
+    await outbox.answer(query)
+    await outbox.edit(
+        query.message,
+        text=(
+            "Scrivi il periodo, ad esempio:\n\n"
+            "<code>2024</code>\n<code>2024-01 2024-03</code>\n<code>2024-01-15 2024-03-31</code>"
+        ),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Indietro", callback_data="back")]]),
+    )
+    return "REPORTS_RANGE"
+
+
+async def menu_reports_personalizzato_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_reports_personalizzato_actual.")
+    try:
+        start_date, end_date = parse_period(update.message.text)
+    except ValueError:
+        await outbox.send(update.effective_chat, "Periodo non valido, riprova (es. 2024-01 2024-03).")
+        return "REPORTS_RANGE"
+    return await send_report(update.message, context, update.effective_user.id, start_date, end_date)
+
+
 async def menu_reports_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_reports_button.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
+
+    _, start_date, end_date = query.data.split("_")
+    start_date, end_date = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    return await send_report(query.message, context, update.effective_user.id, start_date, end_date, edit=True)
 
-    month = query.data.split("_")[1]
 
-    spending_by_cat, spending_by_month, spending_by_month_by_cat = analyze_transactions(
-        month=month, user_id=update.effective_user.id
+async def send_report(message, context, user_id, start_date, end_date, edit=False):
+    # edit: the report replaces the menu message, otherwise it's sent as a new message
+    spending_by_cat, spending_by_month, spending_by_month_by_cat = reports.get_report(
+        user_id, start_date, end_date, context.user_data["valuta"]
     )
 
     if not spending_by_cat or not spending_by_month or not spending_by_month_by_cat:
-        await query.edit_message_text(
-            text="Non ho trovato niente.",
-            parse_mode="HTML",
-        )
+        if edit:
+            await outbox.edit(message, text="Non ho trovato niente.")
+        else:
+            await outbox.send(message.chat, text="Non ho trovato niente.")
         return ConversationHandler.END
 
-    await query.message.delete()
-
-    newmsg = await query.message.reply_text("Sto elaborando i dati, attendi.")
+    if "report" not in context.user_data:
+        load_user_settings(context, user_id)
+    aggregates = (spending_by_cat, spending_by_month, spending_by_month_by_cat)
+    if context.user_data["report"] == "grafico":
+        send_report_charts(context, message, user_id, start_date, end_date, aggregates, keep_message=not edit)
+        return ConversationHandler.END
 
-    DO_BYCAT = True
-    DO_BYMONTH = False
-    DO_BYMONTH_BYCAT = False
+    report = text_report(spending_by_cat, spending_by_month, spending_by_month_by_cat, context.user_data["valuta"])
+    reply_markup = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("🖼️ Grafico", callback_data=f"reportsimg_{start_date}_{end_date}")],
+            [InlineKeyboardButton("🔙 Indietro", callback_data="back")],
+        ]
+    )
+    text = (
+        f"📊 {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}\n\n"
+        f'<pre><code class="text">{report}</code></pre>'
+    )
+    if edit:
+        await outbox.edit(message, text=text, reply_markup=reply_markup)
+    else:
+        await outbox.send(message.chat, text, reply_markup=reply_markup)
+    return "REPORTS"
 
-    if DO_BYCAT:
-        with tempfile.NamedTemporaryFile(suffix=".jpg") as by_cat_photo:
-            plotly_by_cat(spending_by_cat, by_cat_photo.name)
-            await newmsg.reply_photo(photo=open(by_cat_photo.name, "rb"), quote=False)
 
-    if DO_BYMONTH:
-        with tempfile.NamedTemporaryFile(suffix=".jpg") as by_month_photo:
-            plotly_by_month(spending_by_month, by_month_photo.name)
-            await newmsg.reply_photo(photo=open(by_month_photo.name, "rb"), quote=False)
+async def menu_reports_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_reports_images.")
+    query = update.callback_query
+    await outbox.answer(query)
 
-    if DO_BYMONTH_BYCAT:
-        with tempfile.NamedTemporaryFile(suffix=".jpg") as by_month_by_cat_photo:
-            plotly_by_month_and_category(spending_by_month_by_cat, by_month_by_cat_photo.name)
-            await newmsg.reply_photo(photo=open(by_month_by_cat_photo.name, "rb"), quote=False)
+    _, start_date, end_date = query.data.split("_")
+    start_date, end_date = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    user_id = update.effective_user.id
+    aggregates = reports.get_report(user_id, start_date, end_date, context.user_data["valuta"])
+    if not aggregates[0]:
+        await outbox.edit(query.message, text="Non ho trovato niente.")
+        return ConversationHandler.END
 
+    # Keep the text report, the charts are sent below it
+    await outbox.edit(query.message, reply_markup=None)
+    send_report_charts(context, query.message, user_id, start_date, end_date, aggregates, keep_message=True)
     return ConversationHandler.END
 
 
+def send_report_charts(context, message, user_id, start_date, end_date, aggregates, keep_message=False):
+    # Rendering only needs the aggregates: it runs in the background, out of the update's transaction
+    # and without holding up the next updates
+    currency = exchange.report_currency(context.user_data["valuta"])
+    context.application.create_task(
+        report_charts(message, user_id, start_date, end_date, aggregates, currency, keep_message), name="report_charts"
+    )
+
+
+async def report_charts(message, user_id, start_date, end_date, aggregates, currency, keep_message):
+    DO_BYCAT = True
+    DO_BYMONTH = False
+    DO_BYMONTH_BYCAT = False
+
+    kinds = [
+        kind
+        for kind, enabled in (
+            ("by_cat", DO_BYCAT),
+            ("by_month", DO_BYMONTH),
+            ("by_month_and_category", DO_BYMONTH_BYCAT),
+        )
+        if enabled
+    ]
+    # Calls of its own, not the update's: the menu message itself (or a new one below the kept text
+    # report) says to wait and goes out before the charts are rendered, made right away since it's
+    # edited again if they fail
+    if keep_message:
+        placeholder = await message.chat.send_message("Sto elaborando i dati, attendi.")
+    else:
+        placeholder = await message.edit_text("Sto elaborando i dati, attendi.")
+    try:
+        # Rendered concurrently, sent together as one media group
+        photos = await asyncio.gather(
+            *(reports.get_chart(user_id, start_date, end_date, kind, aggregates, currency) for kind in kinds)
+        )
+    except Exception as e:
+        # kaleido or matplotlib: nobody else would hear of it in a task
+        logger.error(f"Grafici del report non generati: {e!r}", exc_info=e)
+        await placeholder.edit_text("Non sono riuscito a generare i grafici, riprova più tardi.")
+        return
+    async with outbox.collect():
+        for photo in photos:
+            await outbox.send_photo(message.chat, photo)
+
+
 async def menu_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_settings.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     valuta_corrente = context.user_data.get("valuta")
     if not valuta_corrente:
         context.user_data["valuta"] = "€"
         valuta_corrente = "€"
+    if "report" not in context.user_data:
+        load_user_settings(context, update.effective_user.id)
+    report_corrente = context.user_data["report"]
+    digest_corrente = context.user_data.get("digest", config.DIGEST_DEFAULT)
     keyboard = [
         [InlineKeyboardButton(f"📃 Cambia Valuta ({valuta_corrente})", callback_data="menu_setting_valuta")],
+        [InlineKeyboardButton(f"📊 Reports: {report_corrente}", callback_data="menu_setting_report")],
+        [InlineKeyboardButton(f"📬 Riepilogo: {digest_corrente}", callback_data="menu_setting_digest")],
         [
             InlineKeyboardButton("🔙 Indietro", callback_data="goto_menu"),
         ],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text="⚙️ SETTINGS", parse_mode="HTML", reply_markup=reply_markup)
+    await outbox.edit(query.message, text="⚙️ SETTINGS", reply_markup=reply_markup)
 
 
 async def menu_setting_valuta(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_setting_valuta.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     keyboard = [
         [InlineKeyboardButton("€", callback_data="valuta_€"), InlineKeyboardButton("EUR", callback_data="valuta_EUR")],
@@ -571,10 +939,10 @@ async def menu_setting_valuta(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data["valuta"] = "€"
         valuta_corrente = "€"
 
-    await query.edit_message_text(
+    await outbox.edit(
+        query.message,
         text=f"Valuta corrente: {valuta_corrente}",
         reply_markup=reply_markup,
-        parse_mode="HTML",
     )
     return "SET_VALUTA"
 
@@ -582,23 +950,49 @@ async def menu_setting_valuta(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def menu_setting_valuta_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Conversation handler: menu_setting_valuta_buttons.")
     query = update.callback_query
-    await query.answer()
+    await outbox.answer(query)
 
     nuova_valuta = query.data.split("_")[1]
     if nuova_valuta == "none":
         nuova_valuta = None
 
     context.user_data["valuta"] = nuova_valuta
-    Setting.replace(user_id=update.effective_user.id, setting1=nuova_valuta).execute()
+    save_user_setting(update.effective_user.id, setting1=nuova_valuta)
+    # Cached reports and budget totals are in the old currency
+    reports.invalidate(update.effective_user.id)
+    budget.invalidate(update.effective_user.id)
     await menu_settings(update, context)
     return ConversationHandler.END
 
 
+async def menu_setting_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_setting_report.")
+    if "report" not in context.user_data:
+        load_user_settings(context, update.effective_user.id)
+
+    nuovo_report = "grafico" if context.user_data["report"] == "testo" else "testo"
+    context.user_data["report"] = nuovo_report
+    save_user_setting(update.effective_user.id, setting2=nuovo_report)
+    await menu_settings(update, context)
+
+
+async def menu_setting_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Conversation handler: menu_setting_digest.")
+    if "digest" not in context.user_data:
+        load_user_settings(context, update.effective_user.id)
+
+    choices = digest.CHOICES
+    nuovo_digest = choices[(choices.index(context.user_data["digest"]) + 1) % len(choices)]
+    context.user_data["digest"] = nuovo_digest
+    save_user_setting(update.effective_user.id, setting3=nuovo_digest)
+    await menu_settings(update, context)
+
+
 async def menu_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Conversation handler: menu_help.")
     query = update.callback_query
-    await query.answer()
-    await query.message.delete()
+    await outbox.answer(query)
+    await outbox.delete(query.message)
     messaggio_list = [
         "Ciao! Questo bot ti permette di salvare le tue transazioni e di tenerne traccia.",
         "Per salvare una transazione, invia un messaggio con il seguente formato:",
@@ -607,21 +1001,31 @@ async def menu_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Ad esempio:",
         "<code>12 Kebab da ciccio</code>",
         "",
+        "Puoi anche inviare più transazioni insieme, una per riga:",
+        "<code>12 Kebab da ciccio",
+        "4.50 Caffè e brioche",
+        "35 Benzina</code>",
+        "",
+        "Per una spesa in un'altra valuta scrivila dopo l'importo, verrà convertita nei report:",
+        "<code>12.50 USD Pranzo</code>",
+        "",
         "Se la descrizione è simile a qualcosa che hai già inserito prima, verrà automaticamente selezionata la categoria corrispondente.",
         "Altrimenti, puoi usare i bottoni per selezionare una categoria esistente, crearne una nuova, cambiare l'importo, la descrizione e la data.",
         "",
+        "Per cercare tra le transazioni passate: <code>/cerca kebab</code>",
+        "",
         "Per vedere gli altri comandi, usa /menu",
         "Ciao!",
     ]
     messaggio = "\n".join(messaggio_list)
-    await update.effective_chat.send_message(messaggio, parse_mode="HTML")
+    await outbox.send(update.effective_chat, messaggio)
 
 
 async def goto_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Conversation handler: goto_menu.")
     query = update.callback_query
-    await query.answer()
-    await query.message.delete()
+    await outbox.answer(query)
+    await outbox.delete(query.message)
     await menu(update, context)
 
 
@@ -644,26 +1048,138 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.effective_chat.send_message("Cosa vuoi fare?", reply_markup=reply_markup)
+    await outbox.send(update.effective_chat, "Cosa vuoi fare?", reply_markup=reply_markup)
     return
 
 async def end_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info("Conversation handler: end_conversation.")
-    await update.effective_chat.send_message("Senti io ho da fare, alla prossima, ci si becca!")
+    await outbox.send(update.effective_chat, "Senti io ho da fare, alla prossima, ci si becca!")
     return ConversationHandler.END
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Conversation handler: stats.")
+    processor = context.application.update_processor
+    text = ""
+    if isinstance(processor, UnitOfWork):
+        counters = processor.stats()
+        text = (
+            f"{counters['updates']} update, {counters['statements_per_update']:.1f} query/update "
+            f"(max {counters['max_statements']}), {counters['ms_per_update']:.1f} ms/update "
+            f"(max {counters['max_ms']:.0f} ms)\n\n"
+        )
+    order = "max_ms" if context.args and context.args[0] == "max" else "total_ms"
+    text += query_report(order=order)
+    await update.message.reply_html(f"<pre>{html.escape(text[:4000])}</pre>")
+
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Conversation handler: backup_command.")
+    if not config.BACKUP_DIR:
+        await update.message.reply_text("Backup non configurati (BACKUP_DIR).")
+        return
+    verify = bool(context.args) and context.args[0] == "verifica"
+    if verify and not backup.backups():
+        await update.message.reply_text("Nessun backup.")
+        return
+    await update.message.reply_text(f"{'Verifica avviata' if verify else 'Backup avviato'}, ti scrivo quando è finito.")
+    # In the background: updates are processed one at a time, the bot must keep serving them meanwhile
+    context.application.create_task(send_backup(context.bot, update.effective_chat.id, verify), update=update)
+
+
+async def send_backup(bot, chat_id, verify):
+    try:
+        if verify:
+            # The latest backup restored to a temporary file and checked
+            path = backup.backups()[-1]
+            ok, details = await asyncio.to_thread(backup.verify, path)
+            await bot.send_message(chat_id, f"{os.path.basename(path)}: {'ok' if ok else 'NON VALIDO'} ({details})")
+            return
+        path, seconds, details = await asyncio.to_thread(backup.backup)
+    except (OSError, sqlite3.Error) as e:
+        await bot.send_message(chat_id, f"{'Verifica fallita' if verify else 'Backup fallito'}: {e!r}")
+        return
+    size = os.path.getsize(path) / 1024 / 1024
+    await bot.send_message(chat_id, f"Backup {os.path.basename(path)}: {details}, {size:.1f} MB in {seconds:.1f}s.")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Conversation handler: profile_command.")
+    if diagnostics.is_profiling():
+        await update.message.reply_text("C'è già un profilo in corso.")
+        return
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+    seconds = min(seconds, diagnostics.MAX_SECONDS)
+    await update.message.reply_text(f"Profilo di {seconds}s avviato, ti mando i risultati alla fine.")
+    # In the background: updates are processed one at a time, the bot must keep serving them meanwhile
+    context.application.create_task(send_profile(context.bot, update.effective_chat.id, seconds), update=update)
+
+
+async def send_profile(bot, chat_id, seconds):
+    result = await asyncio.to_thread(diagnostics.profile, seconds)
+    if result is None:
+        await bot.send_message(chat_id, "C'è già un profilo in corso.")
+        return
+    stacks, summary = result
+    filename = f"profile-{datetime.datetime.now():%Y%m%d-%H%M%S}.folded"
+    await bot.send_document(chat_id, document=stacks.encode(), filename=filename)
+    await bot.send_message(chat_id, f"<pre>{html.escape(summary)}</pre>", parse_mode="HTML")
+
+
+async def memoria_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Conversation handler: memoria_command.")
+    stop = bool(context.args) and context.args[0] == "stop"
+    text = await asyncio.to_thread(diagnostics.memory_diff, stop)
+    await update.message.reply_html(f"<pre>{html.escape(text)}</pre>")
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.error("Errore in un handler, modifiche annullate.", exc_info=context.error)
+    # What the handlers wrote and the replies that could confirm it are dropped, with the
+    # in-memory state that followed the writes
+    rollback_update()
+    await outbox.discard()
+    if not isinstance(update, Update) or update.effective_user is None:
+        return
+    user_id = update.effective_user.id
+    forget_user(user_id)
+    snapshots.invalidate(user_id)
+    reports.invalidate(user_id)
+    budget.invalidate(user_id)
+    if update.effective_chat:
+        await outbox.send(update.effective_chat, "Qualcosa è andato storto, riprova.")
+
+
 async def post_init(app: Application) -> None:
     logger.info("Conversation handler: post_init.")
     Transazione.create_table()
     Categoria.create_table()
     Setting.create_table()
-
-
-def main() -> None:
-    builder = ApplicationBuilder()
-    builder.token(config.TOKEN)
+    Riepilogo.create_table()
+    Budget.create_table()
+    run_migrations()
+    # bot_data["shard"] = (index, workers) when running as a sharded worker, see sharding.py
+    reports.schedule_prerender(app.job_queue, shard=app.bot_data.get("shard"))
+    archive.schedule_archive(app.job_queue, shard=app.bot_data.get("shard"))
+    backup.schedule_backup(app.job_queue, shard=app.bot_data.get("shard"))
+    digest.schedule_digest(app.job_queue, shard=app.bot_data.get("shard"))
+    sessions.schedule_eviction(app.job_queue)
+    ingest.start(app)
+
+
+async def post_shutdown(app: Application) -> None:
+    logger.info("Conversation handler: post_shutdown.")
+    await ingest.stop(app)
+    snapshots.save_all()
+
+
+def build_application(builder: ApplicationBuilder = None) -> Application:
+    if builder is None:
+        builder = ApplicationBuilder()
+        builder.token(config.TOKEN)
     builder.post_init(post_init)
+    builder.post_shutdown(post_shutdown)
+    builder.concurrent_updates(UnitOfWork())
 
     application = builder.build()
 
@@ -671,24 +1187,35 @@ def main() -> None:
         entry_points=[
             CommandHandler("menu", menu),
             CommandHandler("start", menu),
+            # Before the text handler, which would take "/cerca ..." for an expense
+            CommandHandler("cerca", cerca),
             MessageHandler(~filters.UpdateType.EDITED & filters.TEXT, start),
+            # Search results end the conversation, so their page buttons are entry points
+            CallbackQueryHandler(cerca_page, pattern=r"^cerca_\d+$"),
             CallbackQueryHandler(goto_menu, pattern="^goto_menu$"),
             CallbackQueryHandler(menu_help, pattern="^goto_help$"),
             CallbackQueryHandler(menu_categorie, pattern="^goto_categories$"),
             CallbackQueryHandler(menu_categorie_nuovalista, pattern="^menu_categorie_nuovalista$"),
             CallbackQueryHandler(menu_categorie_nuovacat, pattern="^menu_categorie_nuovacat$"),
+            CallbackQueryHandler(menu_budget, pattern="^menu_budget$"),
             CallbackQueryHandler(menu_transazioni, pattern="^goto_transactions$"),
             CallbackQueryHandler(menu_reports, pattern="^goto_reports$"),
             CallbackQueryHandler(menu_settings, pattern="^goto_settings$"),
             CallbackQueryHandler(menu_setting_valuta, pattern="^menu_setting_valuta$"),
+            CallbackQueryHandler(menu_setting_report, pattern="^menu_setting_report$"),
+            CallbackQueryHandler(menu_setting_digest, pattern="^menu_setting_digest$"),
         ],
         states={
+            "BATCH": [
+                CallbackQueryHandler(save_batch, pattern="^batch_salva$"),
+                CallbackQueryHandler(annulla_batch, pattern="^batch_annulla$"),
+            ],
             "SHOW": [
                 CallbackQueryHandler(cambia_data, pattern="^cambia_categoria$"),
                 CallbackQueryHandler(cambia_categoria, pattern="^cambia_data$"),
                 CallbackQueryHandler(cambia_descrizione, pattern="^cambia_descrizione$"),
                 CallbackQueryHandler(cambia_importo, pattern="^cambia_importo$"),
-                CallbackQueryHandler(save_transaction, pattern="^salva_transazione$"),
+                CallbackQueryHandler(save_transaction, pattern="^salva_(transazione|comunque)$"),
                 CallbackQueryHandler(annulla_transazione, pattern="^annulla_transazione$"),
             ],
             "EDIT_DESC": [
@@ -718,6 +1245,14 @@ def main() -> None:
                 MessageHandler(~filters.UpdateType.EDITED & filters.TEXT, menu_categorie_nuovacat_actual),
                 CallbackQueryHandler(goto_menu, pattern="^back$"),
             ],
+            "BUDGET": [
+                CallbackQueryHandler(menu_budget_categoria, pattern=r"^budget_\d+$"),
+                CallbackQueryHandler(goto_menu, pattern="^back$"),
+            ],
+            "BUDGET_IMPORTO": [
+                MessageHandler(~filters.UpdateType.EDITED & filters.TEXT, menu_budget_actual),
+                CallbackQueryHandler(menu_budget, pattern="^back$"),
+            ],
             "SET_VALUTA": [
                 CallbackQueryHandler(menu_setting_valuta_buttons, pattern="^valuta_"),
                 CallbackQueryHandler(goto_menu, pattern="^back$"),
@@ -727,9 +1262,18 @@ def main() -> None:
                 CallbackQueryHandler(goto_menu, pattern="^back$"),
             ],
             "REPORTS": [
+                CallbackQueryHandler(menu_reports_personalizzato, pattern="^reports_personalizzato$"),
                 CallbackQueryHandler(menu_reports_button, pattern="^reports_"),
+                CallbackQueryHandler(menu_reports_images, pattern="^reportsimg_"),
                 CallbackQueryHandler(goto_menu, pattern="^back$"),
             ],
+            "REPORTS_RANGE": [
+                MessageHandler(~filters.UpdateType.EDITED & filters.TEXT, menu_reports_personalizzato_actual),
+                CallbackQueryHandler(menu_reports, pattern="^back$"),
+            ],
+            "SEARCH_TEXT": [
+                MessageHandler(~filters.UpdateType.EDITED & filters.TEXT, cerca_actual),
+            ],
             -2 : [
                 TypeHandler(Update, end_conversation)
             ]
@@ -738,8 +1282,26 @@ def main() -> None:
         conversation_timeout=60
     )
 
+    # Before the conversation, which would take the admin commands as the description of an expense
+    application.add_handler(CommandHandler("stats", stats, filters=filters.User(user_id=config.ADMIN_IDS)))
+    application.add_handler(
+        CommandHandler("backup", backup_command, filters=filters.User(user_id=config.ADMIN_IDS))
+    )
+    application.add_handler(
+        CommandHandler("profile", profile_command, filters=filters.User(user_id=config.ADMIN_IDS))
+    )
+    application.add_handler(
+        CommandHandler("memoria", memoria_command, filters=filters.User(user_id=config.ADMIN_IDS))
+    )
     application.add_handler(conv_handler)
+    # Group -1 runs first for every update: last seen times and settings loaded lazily (sessions.py)
+    application.add_handler(TypeHandler(Update, sessions.touch), group=-1)
+    application.add_error_handler(error_handler)
+    return application
 
+
+def main() -> None:
+    application = build_application()
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
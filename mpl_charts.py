@@ -0,0 +1,122 @@
+"""
+Matplotlib (Agg) renderer for the report charts.
+
+Same input (amounts in cents) and output as the kaleido path in utils.plotly_by_*, without a headless browser:
+enable it with CHART_RENDERER = "matplotlib" in config.
+"""
+import datetime
+import functools
+import re
+
+from matplotlib import font_manager
+from matplotlib.figure import Figure
+from matplotlib.ft2font import FT2Font
+
+from utils import BAR_COLORS, BAR_PATTERNS
+
+DPI = 100
+
+
+def _rgb(color):
+    # plotly colors are "rgb(r,g,b)" strings
+    r, g, b = color[color.index("(") + 1 : -1].split(",")
+    return int(r) / 255, int(g) / 255, int(b) / 255
+
+
+COLORS = [_rgb(color) for color in BAR_COLORS]
+
+# Emoji variation selectors and joiners, left over once the emoji around them are dropped
+EMOJI_JOINERS = re.compile("[\ufe00-\ufe0f\u200d]")
+
+
+@functools.lru_cache(maxsize=None)
+def _charmap():
+    # Code points of the default font (DejaVu Sans)
+    return FT2Font(font_manager.findfont(font_manager.FontProperties())).get_charmap()
+
+
+def _plain(label):
+    # Category names start with an emoji, which the font doesn't have: it would be drawn as an
+    # empty box (and logged as a missing glyph), so the characters it can't draw are left out
+    plain = EMOJI_JOINERS.sub("", "".join(char for char in label if ord(char) in _charmap())).strip()
+    return plain or label
+
+
+def _new_figure(width, height):
+    # Figure objects are not tied to pyplot, so nothing is kept around between reports
+    return Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+
+
+def _simple_white(ax):
+    ax.spines[["top", "right"]].set_visible(False)
+    ax.tick_params(labelsize=11)
+
+
+def _label_bars(ax, bars, font_size, currency, horizontal=True):
+    ax.bar_label(
+        bars,
+        labels=[f"{value:.2f} {currency}" for value in bars.datavalues],
+        padding=3,
+        fontsize=font_size,
+        color="black",
+    )
+    ax.margins(x=0.25) if horizontal else ax.margins(y=0.15)
+
+
+def _month_label(month):
+    return datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
+
+
+def by_cat(data, currency, file_name):
+    fig = _new_figure(800, 500)
+    ax = fig.add_subplot()
+    categories = [_plain(category).upper() for category, _ in data]
+    bars = ax.barh(
+        categories,
+        [spending / 100 for _, spending in data],
+        color=[COLORS[i % len(COLORS)] for i in range(len(data))],
+    )
+    _label_bars(ax, bars, 12, currency)
+    _simple_white(ax)
+    fig.suptitle("SPENDING BY CATEGORY", fontsize=20)
+    fig.savefig(file_name)
+
+
+def by_month(data, currency, file_name):
+    fig = _new_figure(800, 500)
+    ax = fig.add_subplot()
+    bars = ax.bar(
+        [_month_label(month) for month, _ in data],
+        [spending / 100 for _, spending in data],
+        color=[COLORS[i % len(COLORS)] for i in range(len(data))],
+    )
+    _label_bars(ax, bars, 12, currency, horizontal=False)
+    _simple_white(ax)
+    fig.suptitle("SPENDING BY MONTH", fontsize=20)
+    fig.savefig(file_name)
+
+
+def by_month_and_category(data, currency, file_name):
+    data = data[-4:]
+    style = {}
+    for _, categories in data:
+        for cat in categories:
+            style.setdefault(_plain(cat).upper(), len(style))
+
+    fig = _new_figure(900, 1000)
+    axes = fig.subplots(2, 2, gridspec_kw={"hspace": 0.25, "wspace": 0.6}).flatten()
+    for ax, (month, categories) in zip(axes, data):
+        labels = [_plain(cat).upper() for cat in categories]
+        bars = ax.barh(
+            labels,
+            [spending / 100 for spending in categories.values()],
+            color=[COLORS[style[cat] % len(COLORS)] for cat in labels],
+            hatch=[BAR_PATTERNS[style[cat] % len(BAR_PATTERNS)] or None for cat in labels],
+        )
+        _label_bars(ax, bars, 10, currency)
+        _simple_white(ax)
+        ax.set_title(_month_label(month).upper(), fontsize=12)
+    for ax in axes[len(data) :]:
+        ax.set_visible(False)
+    fig.suptitle("SPENDING BY MONTH AND CATEGORY", fontsize=20)
+    fig.savefig(file_name)
@@ -0,0 +1,175 @@
+"""
+Outbound Telegram calls of one update, coalesced.
+
+UnitOfWork collects the replies of each update's handlers (answer, send, edit, delete, send_photo)
+and makes the calls when the handlers are done, after the database transaction has been committed,
+so the SQLite write lock is never held across a network round trip. On the way out:
+- consecutive messages to the same chat become one (texts joined by a blank line, the last one's
+  keyboard), e.g. "Categoria creata!" followed by the menu;
+- only the last of several edits of the same message is sent, and a deleted message isn't edited;
+- photos to the same chat go as one media group;
+- callback queries are answered right away in the background, once, and edits and deletes of
+  messages already on screen run concurrently with the new messages, which keep their order.
+Outside an update (conversation timeouts, jobs) the helpers just make the call.
+"""
+import asyncio
+import contextlib
+import contextvars
+import logging
+
+from telegram import InputMediaPhoto
+from telegram.constants import MessageLimit
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("outbox", default=None)
+
+
+class Outbox:
+    def __init__(self):
+        self.answered = set()  # callback query ids
+        self.background = []  # tasks already started: callback query answers
+        self.edits = {}  # (chat_id, message_id) -> kwargs of the last edit, or None for a delete
+        self.messages = {}  # (chat_id, message_id) -> Message, for the calls
+        self.sends = []  # [chat, "text" or "photos", payload, reply_markup] in order
+
+    def answer(self, query):
+        if query.id not in self.answered:
+            self.answered.add(query.id)
+            self.background.append(asyncio.create_task(query.answer()))
+
+    def edit(self, message, text=None, reply_markup=None):
+        key = (message.chat_id, message.message_id)
+        if key in self.edits and self.edits[key] is None:
+            return
+        self.messages[key] = message
+        self.edits[key] = {"text": text, "reply_markup": reply_markup}
+
+    def delete(self, message):
+        key = (message.chat_id, message.message_id)
+        self.messages[key] = message
+        self.edits[key] = None
+
+    def send(self, chat, text, reply_markup=None):
+        if self.sends:
+            last = self.sends[-1]
+            merged = f"{last[2]}\n\n{text}"
+            same_chat = last[0].id == chat.id and last[1] == "text"
+            # A keyboard stays at the bottom of its own message
+            if same_chat and last[3] is None and len(merged) <= MessageLimit.MAX_TEXT_LENGTH:
+                last[2], last[3] = merged, reply_markup
+                return
+        self.sends.append([chat, "text", text, reply_markup])
+
+    def send_photo(self, chat, photo):
+        if self.sends:
+            last = self.sends[-1]
+            if last[0].id == chat.id and last[1] == "photos" and len(last[2]) < 10:
+                last[2].append(photo)
+                return
+        self.sends.append([chat, "photos", [photo], None])
+
+    def discard(self):
+        # Callback queries are still answered, they are already on their way
+        self.edits, self.messages, self.sends = {}, {}, []
+
+    async def _send_all(self, sends):
+        for chat, kind, payload, reply_markup in sends:
+            if kind == "text":
+                await chat.send_message(payload, parse_mode="HTML", reply_markup=reply_markup)
+            elif len(payload) == 1:
+                await chat.send_photo(photo=payload[0])
+            else:
+                await chat.send_media_group(media=[InputMediaPhoto(photo) for photo in payload])
+
+    def _edit(self, key, kwargs):
+        message = self.messages[key]
+        if kwargs is None:
+            return message.delete()
+        if kwargs["text"] is None:
+            return message.edit_reply_markup(reply_markup=kwargs["reply_markup"])
+        return message.edit_text(parse_mode="HTML", **kwargs)
+
+    async def flush(self):
+        background, self.background = self.background, []
+        edits, self.edits = self.edits, {}
+        sends, self.sends = self.sends, []
+        calls = [*background, *(self._edit(key, kwargs) for key, kwargs in edits.items())]
+        if sends:
+            calls.append(self._send_all(sends))
+        for result in await asyncio.gather(*calls, return_exceptions=True):
+            if isinstance(result, TelegramError):
+                logger.warning(f"Chiamata a Telegram fallita: {result!r}")
+            elif isinstance(result, BaseException):
+                raise result
+
+
+@contextlib.asynccontextmanager
+async def collect():
+    # The calls of the block are made when it ends
+    outbox = Outbox()
+    token = _current.set(outbox)
+    try:
+        yield outbox
+    finally:
+        _current.reset(token)
+        await outbox.flush()
+
+
+async def flush():
+    # Makes the calls queued so far, e.g. before a long computation the user should know about. Not in
+    # handlers: their calls wait for the update's commit, long work goes to a task with its own collect()
+    outbox = _current.get()
+    if outbox is not None:
+        await outbox.flush()
+
+
+async def discard():
+    # Drops the calls queued so far, e.g. the replies of handlers whose writes were rolled back
+    outbox = _current.get()
+    if outbox is not None:
+        outbox.discard()
+
+
+async def answer(query):
+    outbox = _current.get()
+    if outbox is None:
+        await query.answer()
+    else:
+        outbox.answer(query)
+
+
+async def edit(message, text=None, reply_markup=None):
+    # Without text only the keyboard changes
+    outbox = _current.get()
+    if outbox is None and text is None:
+        await message.edit_reply_markup(reply_markup=reply_markup)
+    elif outbox is None:
+        await message.edit_text(text, parse_mode="HTML", reply_markup=reply_markup)
+    else:
+        outbox.edit(message, text, reply_markup)
+
+
+async def delete(message):
+    outbox = _current.get()
+    if outbox is None:
+        await message.delete()
+    else:
+        outbox.delete(message)
+
+
+async def send(chat, text, reply_markup=None):
+    outbox = _current.get()
+    if outbox is None:
+        await chat.send_message(text, parse_mode="HTML", reply_markup=reply_markup)
+    else:
+        outbox.send(chat, text, reply_markup)
+
+
+async def send_photo(chat, photo):
+    outbox = _current.get()
+    if outbox is None:
+        await chat.send_photo(photo=photo)
+    else:
+        outbox.send_photo(chat, photo)
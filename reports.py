@@ -0,0 +1,173 @@
+"""
+Report cache and off-peak pre-rendering.
+
+Aggregates and chart images are cached per (user, period) and dropped whenever the user saves a
+transaction. The prerender_reports job fills the cache for every active user during the night,
+so the month-end rush of Reports taps is served from memory.
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import tempfile
+
+import config
+import exchange
+from utils import (
+    Setting,
+    Transazione,
+    analyze_transactions,
+    in_unit_of_work,
+    month_range,
+    plotly_by_cat,
+    plotly_by_month,
+    plotly_by_month_and_category,
+    previous_month,
+)
+
+logger = logging.getLogger(__name__)
+
+CHARTS = {
+    "by_cat": (plotly_by_cat, 0),
+    "by_month": (plotly_by_month, 1),
+    "by_month_and_category": (plotly_by_month_and_category, 2),
+}
+
+# (user_id, start_date, end_date) -> {"aggregates": (by_cat, by_month, by_month_by_cat), "charts": {kind: jpg bytes}}
+_cache = collections.OrderedDict()
+# user_id -> number of invalidations, so a slow prerender can't store data older than a save
+_generation = collections.Counter()
+
+
+def _store(key, entry):
+    _cache[key] = entry
+    _cache.move_to_end(key)
+    while len(_cache) > config.REPORT_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def invalidate(user_id):
+    _generation[user_id] += 1
+    for key in [key for key in _cache if key[0] == user_id]:
+        del _cache[key]
+
+
+def get_report(user_id, start_date, end_date, valuta=None):
+    # valuta: the user's currency setting (invalidate when it changes)
+    key = (user_id, start_date, end_date)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]["aggregates"]
+    aggregates = analyze_transactions(user_id=user_id, start_date=start_date, end_date=end_date, valuta=valuta)
+    if aggregates[0]:
+        _store(key, {"aggregates": aggregates, "charts": {}})
+    return aggregates
+
+
+def render_chart(kind, aggregates, currency):
+    # Blocking (kaleido/matplotlib), run it in a worker thread from async code; currency: the ISO
+    # code the aggregates are in (exchange.report_currency)
+    plot, index = CHARTS[kind]
+    fd, file_name = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    try:
+        plot(aggregates[index], currency, file_name)
+        with open(file_name, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(file_name)
+
+
+async def get_chart(user_id, start_date, end_date, kind, aggregates, currency):
+    entry = _cache.get((user_id, start_date, end_date))
+    if entry and kind in entry["charts"]:
+        return entry["charts"][kind]
+    chart = await asyncio.to_thread(render_chart, kind, aggregates, currency)
+    if entry:
+        entry["charts"][kind] = chart
+    return chart
+
+
+def report_periods(today=None):
+    # Current and previous month, the most requested reports
+    today = today or datetime.date.today()
+    return [month_range(today.strftime("%Y-%m")), month_range(previous_month(today))]
+
+
+def active_users(days, shard=None):
+    since = datetime.date.today() - datetime.timedelta(days=days)
+    query = Transazione.select(Transazione.user_id).where(Transazione.date >= since).distinct().tuples()
+    user_ids = [user_id for (user_id,) in query]
+    if shard:
+        # Sharded deployment: each worker only serves (and caches reports for) its own users
+        from sharding import shard_for
+
+        index, workers = shard
+        user_ids = [user_id for user_id in user_ids if shard_for(user_id, workers) == index]
+    return user_ids
+
+
+def chart_users(user_ids):
+    # Users that get images with their reports; the others only need the aggregates
+    if config.DEFAULT_REPORT_MODE == "grafico":
+        text_users = Setting.select(Setting.user_id).where(Setting.setting2 == "testo")
+        return set(user_ids) - {s.user_id for s in text_users}
+    graph_users = Setting.select(Setting.user_id).where(Setting.setting2 == "grafico")
+    return set(user_ids) & {s.user_id for s in graph_users}
+
+
+def user_currencies():
+    # user_id -> currency setting, for the users who chose one (see load_user_settings)
+    return dict(Setting.select(Setting.user_id, Setting.setting1).where(Setting.setting1.is_null(False)).tuples())
+
+
+async def prerender_reports(context):
+    logger.info("Job: prerender_reports.")
+    user_ids = active_users(config.PRERENDER_ACTIVE_DAYS, shard=context.job.data)
+    with_charts = chart_users(user_ids)
+    valute = user_currencies()
+    semaphore = asyncio.Semaphore(config.PRERENDER_CONCURRENCY)
+
+    async def prerender(user_id, start_date, end_date):
+        async with semaphore:
+            generation = _generation[user_id]
+            valuta = valute.get(user_id, config.DEFAULT_CURRENCY)
+            aggregates = await asyncio.to_thread(
+                in_unit_of_work,
+                analyze_transactions,
+                user_id=user_id,
+                start_date=start_date,
+                end_date=end_date,
+                valuta=valuta,
+            )
+            if not aggregates[0]:
+                return
+            entry = {"aggregates": aggregates, "charts": {}}
+            if user_id in with_charts:
+                entry["charts"]["by_cat"] = await asyncio.to_thread(
+                    render_chart, "by_cat", aggregates, exchange.report_currency(valuta)
+                )
+            if generation == _generation[user_id]:
+                _store((user_id, start_date, end_date), entry)
+
+    results = await asyncio.gather(
+        *[prerender(user_id, *period) for user_id in user_ids for period in report_periods()], return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    for error in errors[:5]:
+        logger.error("prerender_reports: %r", error)
+    logger.info(
+        f"prerender_reports: {len(user_ids)} utenti, {len(results) - len(errors)} report, {len(errors)} errori."
+    )
+
+
+def schedule_prerender(job_queue, shard=None):
+    if not config.PRERENDER_TIME:
+        return
+    if job_queue is None:
+        logger.warning("JobQueue non disponibile, installa python-telegram-bot[job-queue] per il prerender.")
+        return
+    hour, minute = (int(x) for x in config.PRERENDER_TIME.split(":"))
+    job_queue.run_daily(prerender_reports, time=datetime.time(hour, minute), data=shard, name="prerender_reports")
@@ -0,0 +1,70 @@
+"""
+Idle user_data eviction (config.USER_DATA_IDLE).
+
+PTB keeps context.user_data for every user who ever wrote to the bot, for as long as the process
+runs. touch (a TypeHandler in group -1, before the conversation) records when each user was last
+seen and loads the settings of users with no user_data, new or evicted; a job drops the user_data of
+users idle for more than USER_DATA_IDLE seconds. That is well beyond the conversation timeout, so a
+conversation in progress never loses its pending transaction.
+"""
+import collections
+import logging
+import time
+
+import config
+from utils import load_user_settings
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = 300  # seconds between two sweeps
+
+_last_seen = collections.OrderedDict()  # user_id -> time.monotonic(), least recently seen first
+
+
+async def touch(update, context):
+    user = update.effective_user
+    if user is None:
+        return
+    _last_seen[user.id] = time.monotonic()
+    _last_seen.move_to_end(user.id)
+    if "valuta" not in context.user_data:
+        load_user_settings(context, user.id)
+
+
+def evict_idle(application, idle):
+    # Only the users at the front of _last_seen are looked at, the sweep costs what it evicts
+    cutoff = time.monotonic() - idle
+    evicted = 0
+    while _last_seen:
+        user_id, seen = next(iter(_last_seen.items()))
+        if seen > cutoff:
+            break
+        del _last_seen[user_id]
+        application.drop_user_data(user_id)
+        if user_id in application.chat_data:
+            # Private chat, same id
+            application.drop_chat_data(user_id)
+        evicted += 1
+    if application.persistence is None:
+        # PTB only empties these in update_persistence, which never runs without a persistence:
+        # they would keep every user id ever seen
+        application._user_ids_to_be_updated_in_persistence.clear()
+        application._user_ids_to_be_deleted_in_persistence.clear()
+        application._chat_ids_to_be_updated_in_persistence.clear()
+        application._chat_ids_to_be_deleted_in_persistence.clear()
+    return evicted
+
+
+async def evict_job(context):
+    evicted = evict_idle(context.application, config.USER_DATA_IDLE)
+    if evicted:
+        logger.info(f"user_data di {evicted} utenti inattivi eliminati, {len(context.application.user_data)} restanti.")
+
+
+def schedule_eviction(job_queue):
+    if not config.USER_DATA_IDLE:
+        return
+    if job_queue is None:
+        logger.warning("JobQueue non disponibile, installa python-telegram-bot[job-queue] per liberare la memoria.")
+        return
+    job_queue.run_repeating(evict_job, interval=SWEEP_INTERVAL, name="evict_user_data")
@@ -0,0 +1,191 @@
+"""
+Sharded deployment: one webhook receiver in front of N bot worker processes.
+
+    python sharding.py
+
+The front process receives the Telegram webhooks and routes every update by user_id to one of
+SHARD_WORKERS workers, so a user always lands on the same process and on the same
+ConversationHandler state. With SHARD_DATABASES every worker also owns its own SQLite file
+(db/sqlite-<n>.db) instead of sharing db/sqlite.db.
+"""
+import asyncio
+import http.server
+import json
+import logging
+import multiprocessing
+import zlib
+
+from telegram import Bot, Update
+from telegram.ext import ApplicationBuilder
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Update fields carrying the user who sent it
+USER_FIELDS = [
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll_answer",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+]
+
+
+def shard_for(user_id, workers):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def update_user_id(data):
+    # Works on the raw webhook JSON, the front process never builds Update objects
+    for field in USER_FIELDS:
+        if field in data:
+            sender = data[field].get("from") or data[field].get("user") or data[field].get("chat")
+            if sender:
+                return sender["id"]
+    return 0
+
+
+def shard_database(index):
+    return f"db/sqlite-{index}.db"
+
+
+def default_builder():
+    builder = ApplicationBuilder()
+    builder.token(config.TOKEN)
+    builder.updater(None)  # updates come from the front process
+    return builder
+
+
+async def _worker(index, workers, updates, database, events, builder_factory):
+    import main
+    import utils
+
+    if database:
+        utils.init_db("sqlite", path=database)
+
+    application = main.build_application(builder_factory())
+    application.bot_data["shard"] = (index, workers)
+    loop = asyncio.get_running_loop()
+
+    async with application:
+        # post_init is only called by run_polling/run_webhook
+        await main.post_init(application)
+        await application.start()
+        if events is not None:
+            events.put(("ready", index))
+
+        processed = 0
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            # One update at a time: the ConversationHandler state and SQLite writes stay ordered
+            update = Update.de_json(data, application.bot)
+            await application.update_processor.process_update(update, application.process_update(update))
+            processed += 1
+
+        await application.stop()
+        await main.post_shutdown(application)
+
+    if events is not None:
+        events.put(("done", index, processed))
+
+
+def run_worker(index, workers, updates, database=None, events=None, builder_factory=default_builder, log_level=None):
+    if log_level is not None:
+        import main  # noqa: F401 (configures logging)
+
+        logging.getLogger().setLevel(log_level)
+    asyncio.run(_worker(index, workers, updates, database, events, builder_factory))
+
+
+def start_workers(workers, databases=None, events=None, builder_factory=default_builder, log_level=None):
+    # spawn, not fork: every worker gets a fresh interpreter, event loop and database connection
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    processes = [
+        ctx.Process(
+            target=run_worker,
+            args=(index, workers, queues[index]),
+            kwargs={
+                "database": databases[index] if databases else None,
+                "events": events,
+                "builder_factory": builder_factory,
+                "log_level": log_level,
+            },
+            name=f"worker-{index}",
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def route(queues, data):
+    queues[shard_for(update_user_id(data), len(queues))].put(data)
+
+
+def stop_workers(queues, processes):
+    for q in queues:
+        q.put(None)
+    for process in processes:
+        process.join()
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    queues = []
+
+    def do_POST(self):
+        if config.WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        except (KeyError, ValueError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        route(self.queues, data)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve():
+    workers = config.SHARD_WORKERS
+    databases = [shard_database(index) for index in range(workers)] if config.SHARD_DATABASES else None
+    queues, processes = start_workers(workers, databases)
+
+    asyncio.run(
+        Bot(config.TOKEN).set_webhook(
+            config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES
+        )
+    )
+
+    WebhookHandler.queues = queues
+    # One request at a time: with a thread per request two updates of the same user could reach their
+    # worker's queue in either order, while the ConversationHandler needs them in the order they came.
+    # Routing is only a queue put, and HTTP/1.0 closes every connection after its request.
+    server = http.server.HTTPServer(("0.0.0.0", config.WEBHOOK_PORT), WebhookHandler)
+    logger.info(f"Webhook su porta {config.WEBHOOK_PORT}, {workers} worker.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop_workers(queues, processes)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    serve()
@@ -0,0 +1,177 @@
+"""
+Columnar per-user snapshots of transazioni for analytics (config.SNAPSHOTS).
+
+A snapshot is a NumPy structured array of (date, importo in cents, category id, currency) per user.
+It is built from one query the first time a user's report is needed, then
+kept in memory (SNAPSHOT_CACHE_SIZE users) and appended to on every save, so reports are computed
+with vectorized masks and bincounts instead of rows read back through peewee, amounts in other
+currencies converted in the same pass (exchange.convert).
+With SNAPSHOT_DIR the snapshots are also saved as .npy files and memory-mapped when loaded again.
+"""
+import collections
+import logging
+import os
+import threading
+
+import numpy as np
+
+import config
+import exchange
+from utils import tier_models
+
+logger = logging.getLogger(__name__)
+
+# categoria_id 0: no category, valuta b"": the user's currency
+DTYPE = np.dtype([("date", "datetime64[D]"), ("importo", "i8"), ("categoria_id", "i4"), ("valuta", "S3")])
+
+# user_id -> Snapshot, least recently used first
+_snapshots = collections.OrderedDict()
+# Reports are also computed in worker threads (prerender_reports)
+_lock = threading.RLock()
+
+
+class Snapshot:
+    def __init__(self, rows):
+        self.rows = rows  # DTYPE array, possibly a read-only memmap
+        self.tail = []  # rows appended since the last compact()
+        self.dirty = False  # not saved to SNAPSHOT_DIR yet
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows: (date, importo, categoria_id, valuta) tuples
+        snapshot = cls(np.empty(0, DTYPE))
+        snapshot.tail = [
+            (np.datetime64(date, "D"), importo, categoria_id or 0, valuta or "")
+            for date, importo, categoria_id, valuta in rows
+        ]
+        snapshot.compact()
+        return snapshot
+
+    def append(self, row):
+        self.tail.append(
+            (np.datetime64(row["date"], "D"), row["importo"], row["categoria_id"] or 0, row.get("valuta") or "")
+        )
+        self.dirty = True
+
+    def compact(self):
+        # One copy for all the rows appended since the last report, not one per save
+        if self.tail:
+            self.rows = np.concatenate([self.rows, np.array(self.tail, DTYPE)])
+            self.tail = []
+
+    def __len__(self):
+        return len(self.rows) + len(self.tail)
+
+    def range_totals(self, start_date, end_date, valuta):
+        # (month, category id or None, cents in valuta) for the transactions between start_date and end_date
+        self.compact()
+        dates = self.rows["date"]
+        selected = self.rows[(dates >= np.datetime64(start_date, "D")) & (dates <= np.datetime64(end_date, "D"))]
+        if not len(selected):
+            return []
+        months = selected["date"].astype("datetime64[M]").astype(np.int64)
+        first = months.min()
+        # Category ids are global, renumber the ones in range so the bincount stays small
+        categories, categoria = np.unique(selected["categoria_id"], return_inverse=True)
+        keys = (months - first) * len(categories) + categoria
+        counts = np.bincount(keys)
+        importi = exchange.convert(selected["importo"], selected["valuta"], selected["date"], valuta)
+        # float64 sums are exact for totals below 2**53 cents
+        sums = np.bincount(keys, weights=importi)
+        return [
+            (
+                str(np.datetime64(int(first + key // len(categories)), "M")),
+                int(categories[key % len(categories)]) or None,
+                int(round(sums[key])),
+            )
+            for key in np.flatnonzero(counts)
+        ]
+
+    def save(self, path):
+        self.compact()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(f"{path}.npy", self.rows)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(f"{path}.npy", mmap_mode="r"))
+
+
+def snapshot_path(user_id):
+    return os.path.join(config.SNAPSHOT_DIR, str(user_id))
+
+
+def build(user_id):
+    # The whole history, archived years included
+    return Snapshot.from_rows(
+        row
+        for model in tier_models()
+        for row in model.select(model.date, model.importo, model.categoria, model.valuta)
+        .where(model.user_id == user_id)
+        .tuples()
+    )
+
+
+def count(user_id):
+    return sum(model.select().where(model.user_id == user_id).count() for model in tier_models())
+
+
+def load(user_id):
+    # A saved snapshot is only used if it still has all the user's transactions (it isn't saved on
+    # every append, so after a crash it can be behind the database)
+    path = snapshot_path(user_id)
+    if not os.path.exists(f"{path}.npy"):
+        return None
+    snapshot = Snapshot.load(path)
+    if snapshot.rows.dtype != DTYPE or len(snapshot) != count(user_id):
+        return None
+    return snapshot
+
+
+def _evict(user_id, snapshot):
+    if config.SNAPSHOT_DIR and snapshot.dirty:
+        snapshot.save(snapshot_path(user_id))
+
+
+def get(user_id):
+    with _lock:
+        if user_id in _snapshots:
+            _snapshots.move_to_end(user_id)
+            return _snapshots[user_id]
+        snapshot = load(user_id) if config.SNAPSHOT_DIR else None
+        if snapshot is None:
+            snapshot = build(user_id)
+            snapshot.dirty = True
+        _snapshots[user_id] = snapshot
+        while len(_snapshots) > config.SNAPSHOT_CACHE_SIZE:
+            _evict(*_snapshots.popitem(last=False))
+        return snapshot
+
+
+def range_totals(user_id, start_date, end_date, valuta):
+    with _lock:
+        return get(user_id).range_totals(start_date, end_date, valuta)
+
+
+def append(row):
+    # Users without a snapshot in memory get one, with this row, from the database when needed
+    with _lock:
+        if row["user_id"] in _snapshots:
+            _snapshots[row["user_id"]].append(row)
+
+
+def invalidate(user_id):
+    # For writes that can't be appended (batches that may repeat rows, merged categories)
+    with _lock:
+        _snapshots.pop(user_id, None)
+        if config.SNAPSHOT_DIR and os.path.exists(f"{snapshot_path(user_id)}.npy"):
+            os.remove(f"{snapshot_path(user_id)}.npy")
+
+
+def save_all():
+    if not config.SNAPSHOT_DIR:
+        return
+    with _lock:
+        saved = [snapshot.save(snapshot_path(user_id)) for user_id, snapshot in _snapshots.items() if snapshot.dirty]
+    logger.info(f"Snapshot salvati: {len(saved)}.")
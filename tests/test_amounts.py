@@ -0,0 +1,36 @@
+import pytest
+
+from utils import format_importo, parse_importo
+
+
+@pytest.mark.parametrize(
+    "text, cents",
+    [
+        ("12", 1200),
+        ("12.5", 1250),
+        ("12,50", 1250),
+        (" 7 ", 700),
+        ("-3.5", -350),
+        # Half a cent rounds away from zero, never through a float
+        ("12.345", 1235),
+        ("0.005", 1),
+        ("0.004", 0),
+        ("1.115", 112),
+    ],
+)
+def test_parse_importo(text, cents):
+    assert parse_importo(text) == cents
+
+
+@pytest.mark.parametrize("text", ["", "abc", "12,5,0", "12.5.0", "nan", "inf"])
+def test_parse_importo_invalid(text):
+    with pytest.raises(ValueError, match="Importo non valido"):
+        parse_importo(text)
+
+
+@pytest.mark.parametrize(
+    "cents, text", [(0, "0.00"), (5, "0.05"), (1250, "12.50"), (-5, "-0.05"), (-1234, "-12.34"), (123456, "1234.56")]
+)
+def test_format_importo(cents, text):
+    assert format_importo(cents) == text
+    assert parse_importo(text) == cents
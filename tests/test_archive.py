@@ -0,0 +1,67 @@
+import asyncio
+import contextlib
+import itertools
+import sqlite3
+import time
+
+import pytest
+from telegram.ext import MessageHandler, filters
+
+import archive
+import config
+import ingest
+import loadtest
+import utils
+
+USER_ID = 100000
+
+
+async def failing_handler(update, context):
+    raise RuntimeError("handler fallito dopo il cambio di categorie")
+
+
+def archived_categories(year):
+    with contextlib.closing(sqlite3.connect(utils.archive_path(year))) as conn:
+        return {categoria_id for (categoria_id,) in conn.execute("SELECT categoria_id FROM transazioni")}
+
+
+def merge_updates(update_ids):
+    return [
+        loadtest.callback_update(next(update_ids), USER_ID, "menu_categorie_nuovalista"),
+        loadtest.text_update(next(update_ids), USER_ID, "Vecchia => Nuova"),
+    ]
+
+
+@pytest.fixture
+def archived(backend, tmp_path, monkeypatch):
+    # An archived 2020 with the user's expenses in "Vecchia"
+    if backend != "sqlite":
+        pytest.skip("archivi solo con SQLite")
+    monkeypatch.setattr(config, "ARCHIVE_DIR", str(tmp_path / "archivio"))
+    asyncio.run(loadtest.replay([]))
+    with utils.unit_of_work():
+        utils.add_category(USER_ID, "Vecchia")
+        utils.add_category(USER_ID, "Nuova")
+    ids = {name: categoria_id for categoria_id, name in utils.category_names(USER_ID).items()}
+    row = {"timestamp": int(time.time()), "user_id": USER_ID, "importo": 1000, "descrizione": "pizza"}
+    ingest.write_rows([{**row, "date": f"2020-0{month}-01", "categoria_id": ids["Vecchia"]} for month in (1, 2)])
+    assert archive.archive_closed_years() == [2020]
+    return ids
+
+
+def test_merge_reaches_archives(archived):
+    asyncio.run(loadtest.replay(merge_updates(itertools.count(1))))
+
+    assert archived_categories(2020) == {archived["Nuova"]}
+    assert not utils.Categoria.select().where(utils.Categoria.id == archived["Vecchia"]).exists()
+
+
+def test_failed_merge_leaves_archives(archived):
+    def on_build(application):
+        # After the ConversationHandler (group 0) has merged the categories
+        application.add_handler(MessageHandler(filters.Regex("=>"), failing_handler), group=1)
+
+    asyncio.run(loadtest.replay(merge_updates(itertools.count(1)), on_build=on_build))
+
+    assert archived_categories(2020) == {archived["Vecchia"]}
+    assert utils.Categoria.select().where(utils.Categoria.id == archived["Vecchia"]).exists()
@@ -0,0 +1,50 @@
+import asyncio
+import itertools
+
+import pytest
+
+import config
+import loadtest
+import utils
+from utils import parse_batch
+
+USER_ID = 100000
+
+
+@pytest.fixture(autouse=True)
+def no_rates(monkeypatch):
+    # Only the user's own currency is recognised
+    monkeypatch.setattr(config, "EXCHANGE_RATES_FILE", None)
+
+
+def test_parse_batch():
+    text = "12 pizza\n\n  7  spesa conad  \n3EUR\n5,50 cinema"
+    assert parse_batch(text, "EUR") == (
+        [(1200, None, "pizza"), (700, None, "spesa conad"), (300, "EUR", None), (550, None, "cinema")],
+        [],
+    )
+
+
+def test_parse_batch_invalid_lines():
+    # Kept as they were typed, the valid lines around them still parse
+    text = "ciao\n12 pizza\n$3 caffè\n12.5.0 bar\n5 USD cinema"
+    entries, invalid = parse_batch(text, "EUR")
+    assert entries == [(1200, None, "pizza"), (500, None, "USD cinema")]
+    assert invalid == ["ciao", "$3 caffè", "12.5.0 bar"]
+
+
+def test_parse_batch_empty():
+    assert parse_batch("\n  \n", "EUR") == ([], [])
+
+
+def test_batch_skips_invalid_lines(backend):
+    update_ids = itertools.count(1)
+    updates = [
+        loadtest.text_update(next(update_ids), USER_ID, "12 pizza\n<b>ciao\n3,50 caffè"),
+        loadtest.callback_update(next(update_ids), USER_ID, "batch_salva"),
+    ]
+    application = asyncio.run(loadtest.replay(updates))
+
+    assert "Righe ignorate:\n&lt;b&gt;ciao" in application.bot.request.texts[0]
+    saved = utils.Transazione.select(utils.Transazione.importo).order_by(utils.Transazione.importo).tuples()
+    assert [importo for (importo,) in saved] == [350, 1200]
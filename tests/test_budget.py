@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import itertools
+import time
+
+import pytest
+
+import budget
+import ingest
+import loadtest
+import utils
+
+USER_ID = 100000
+
+
+@pytest.fixture
+def categoria_id(backend):
+    # A category with a budget of 100.00
+    asyncio.run(loadtest.replay([]))
+    with utils.unit_of_work():
+        utils.add_category(USER_ID, "Svago")
+        categoria_id = utils.category_id(USER_ID, "Svago")
+        budget.set_budget(USER_ID, categoria_id, 10000)
+    return categoria_id
+
+
+def row(categoria_id, importo):
+    return {
+        "timestamp": int(time.time()),
+        "date": datetime.date.today().isoformat(),
+        "user_id": USER_ID,
+        "importo": importo,
+        "descrizione": "cinema",
+        "categoria_id": categoria_id,
+        "valuta": None,
+    }
+
+
+def test_warns_once_over_budget(categoria_id):
+    assert budget.record([row(categoria_id, 6000)], "EUR") == []
+    assert budget.record([row(categoria_id, 4000)], "EUR") == []  # exactly the budget
+    assert budget.record([row(categoria_id, 1)], "EUR") == [(categoria_id, 10001, 10000)]
+    # Already over: no warning for later saves, alone or in a batch
+    assert budget.record([row(categoria_id, 500)], "EUR") == []
+    assert budget.record([row(categoria_id, 500), row(None, 99999)], "EUR") == []
+
+
+def test_batch_crossing_warns_once(categoria_id):
+    rows = [row(categoria_id, 4000), row(categoria_id, 4000), row(categoria_id, 4000)]
+    assert budget.record(rows, "EUR") == [(categoria_id, 12000, 10000)]
+
+
+def test_reload_counts_write_behind_rows(categoria_id, tmp_path, monkeypatch):
+    # Rows acknowledged but not flushed yet aren't in the rollup the totals are loaded from
+    monkeypatch.setattr(ingest, "buffer", ingest.WriteBehindBuffer(str(tmp_path / "ingest.log")))
+    try:
+        ingest.buffer.append(row(categoria_id, 9000))
+        budget.invalidate(USER_ID)
+        assert budget.record([row(categoria_id, 2000)], "EUR") == [(categoria_id, 11000, 10000)]
+    finally:
+        ingest.buffer.close()
+
+
+def saved_expense(update_ids, text, categoria):
+    # "cambia_data" is the callback of the "Cambia categoria" button
+    return [
+        loadtest.text_update(next(update_ids), USER_ID, text),
+        loadtest.callback_update(next(update_ids), USER_ID, "cambia_data"),
+        loadtest.callback_update(next(update_ids), USER_ID, f"cat_{categoria}"),
+        loadtest.callback_update(next(update_ids), USER_ID, "salva_transazione"),
+    ]
+
+
+def test_warning_through_the_bot(backend):
+    # The default categories, then a budget of 100.00 for one of them set from the menu
+    update_ids = itertools.count(1)
+    asyncio.run(loadtest.replay([loadtest.callback_update(next(update_ids), USER_ID, "goto_categories")]))
+    categoria_id = utils.category_id(USER_ID, "🍔 Cibo")
+    updates = [
+        loadtest.callback_update(next(update_ids), USER_ID, "menu_budget"),
+        loadtest.callback_update(next(update_ids), USER_ID, f"budget_{categoria_id}"),
+        loadtest.text_update(next(update_ids), USER_ID, "100"),
+        *saved_expense(update_ids, "60 pizza", "🍔 Cibo"),
+        *saved_expense(update_ids, "50 kebab", "🍔 Cibo"),
+        *saved_expense(update_ids, "10 gelato", "🍔 Cibo"),
+    ]
+    application = asyncio.run(loadtest.replay(updates))
+
+    saved = [text for text in application.bot.request.texts if text.startswith("Transazione salvata!")]
+    assert len(saved) == 3
+    assert "⚠️ Budget di 🍔 Cibo superato: 110.00 su 100.00" in saved[1]
+    assert "Budget" not in saved[0] and "Budget" not in saved[2]
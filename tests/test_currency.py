@@ -0,0 +1,182 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+import sqlite3
+
+import numpy as np
+import pytest
+
+import config
+import exchange
+import ingest
+import loadtest
+import utils
+from utils import parse_entry
+
+USER_ID = 100000
+
+# Gaps on purpose: GBP has no rate on the 4th, JPY none before it, XYZ none at all
+RATES = """Date,USD,JPY,GBP,XYZ,
+2024-03-04,1.10,160.0,N/A,N/A,
+2024-03-01,1.00,N/A,0.80,N/A,
+2024-03-05,1.20,N/A,0.90,N/A,
+"""
+
+
+@pytest.fixture
+def rates(tmp_path, monkeypatch):
+    path = tmp_path / "eurofxref-hist.csv"
+    path.write_text(RATES)
+    monkeypatch.setattr(config, "EXCHANGE_RATES_FILE", str(path))
+    monkeypatch.setattr(config, "EXCHANGE_RATES_BASE", "EUR")
+    monkeypatch.setattr(exchange, "_table", None)
+    return path
+
+
+@pytest.mark.parametrize(
+    "text, entry",
+    [
+        ("12.50 pranzo", (1250, None, "pranzo")),
+        ("12.50 USD pranzo", (1250, "USD", "pranzo")),
+        ("12 EUR pranzo", (1200, "EUR", "pranzo")),
+        ("12 GBP", (1200, "GBP", None)),
+        ("$12.50 pranzo", (1250, "USD", "pranzo")),
+        ("USD12 cena", (1200, "USD", "cena")),
+        ("12,50€", (1250, "EUR", None)),
+        ("12,50$ cena", (1250, "USD", "cena")),
+        # Lowercase words and currencies without rates are part of the description
+        ("12 usd bar", (1200, None, "usd bar")),
+        ("12.50 CHF pranzo", (1250, None, "CHF pranzo")),
+        ("12 XYZ bar", (1200, None, "XYZ bar")),
+    ],
+)
+def test_parse_entry(rates, text, entry):
+    assert parse_entry(text, "EUR") == entry
+
+
+@pytest.mark.parametrize("text", ["", "pranzo 12", "€12$", "CHF12 pranzo", "12,50abc"])
+def test_parse_entry_invalid(rates, text):
+    with pytest.raises(ValueError):
+        parse_entry(text, "EUR")
+
+
+def test_rates_gaps(rates):
+    table = exchange.table()
+    assert set(table.columns) == {"EUR", "USD", "JPY", "GBP"}
+    converted = exchange.convert(
+        [1000, 1000, 1000, 1000, 1000, 1000],
+        ["USD", "USD", "", "GBP", "JPY", "EUR"],
+        ["2024-03-02", "2024-02-01", "2024-03-02", "2024-03-04", "2024-03-01", "2024-03-09"],
+        "EUR",
+    )
+    # A weekend and the day before the file take the nearest earlier (or the first) rate, a currency's
+    # missing days its previous rate, or its first one before it has any
+    assert converted.tolist() == [1000, 1000, 1000, 1250, 6, 1000]
+    assert exchange.convert([1000], ["EUR"], ["2024-03-09"], "USD").tolist() == [1200]
+    assert exchange.convert([1000], ["GBP"], ["2024-03-05"], "USD").tolist() == [1333]
+
+
+def test_missing_rates(rates):
+    # Left as they are, with a warning, rather than failing the report
+    assert exchange.convert([1000], ["CHF"], ["2024-03-05"], "EUR").tolist() == [1000]
+    assert exchange.convert(np.array([1000]), np.array([b"USD"]), ["2024-03-05"], "EUR").tolist() == [833]
+
+
+# Rates exact in cents for the amounts below (multiples of 4): USD changes on Feb 1st
+REPORT_RATES = """Date,USD,GBP,
+2024-01-01,0.5,2.0,
+2024-02-01,0.25,2.0,
+"""
+
+
+def report_rows(categoria_id):
+    rows = []
+    for day in range(1, 91, 3):
+        date = datetime.date(2024, 1, 1) + datetime.timedelta(days=day)
+        for i, valuta in enumerate([None, "USD", "GBP", "EUR"]):
+            rows.append(
+                {
+                    "timestamp": 1700000000 + day * 10 + i,
+                    "date": date.isoformat(),
+                    "user_id": USER_ID,
+                    "importo": 400 * (day % 7 + i + 1),
+                    "descrizione": "spesa",
+                    "categoria_id": categoria_id if (day + i) % 2 else None,
+                    "valuta": valuta,
+                }
+            )
+    return rows
+
+
+def reference(rows, start_date, end_date, valuta):
+    # Row by row, each amount converted at its own day's rate
+    by_cat, by_month = collections.Counter(), collections.Counter()
+    for row in rows:
+        date = datetime.date.fromisoformat(row["date"])
+        if start_date <= date <= end_date:
+            importo = int(exchange.convert([row["importo"]], [row["valuta"] or ""], [date], valuta)[0])
+            by_cat[utils.category_name(USER_ID, row["categoria_id"])] += importo
+            by_month[row["date"][:7]] += importo
+    return dict(by_cat), dict(by_month)
+
+
+@pytest.mark.parametrize("snapshots", [False, True])
+def test_report_paths(backend, tmp_path, monkeypatch, snapshots):
+    # Rollup (whole months) and snapshots, in the user's currency and in another one
+    path = tmp_path / "rates.csv"
+    path.write_text(REPORT_RATES)
+    monkeypatch.setattr(config, "EXCHANGE_RATES_FILE", str(path))
+    monkeypatch.setattr(exchange, "_table", None)
+    monkeypatch.setattr(config, "SNAPSHOTS", snapshots)
+    assert exchange.known("USD") and exchange.known("GBP")
+    asyncio.run(loadtest.replay([]))
+    with utils.unit_of_work():
+        utils.add_category(USER_ID, "Svago")
+    rows = report_rows(utils.category_id(USER_ID, "Svago"))
+    ingest.write_rows(rows)
+
+    D = datetime.date
+    for start_date, end_date in ((D(2024, 1, 1), D(2024, 3, 31)), (D(2024, 1, 15), D(2024, 2, 10))):
+        for valuta in ("EUR", "USD"):
+            by_cat, by_month, _ = utils.analyze_transactions(USER_ID, start_date, end_date, valuta=valuta)
+            assert (dict(by_cat), dict(by_month)) == reference(rows, start_date, end_date, valuta)
+
+
+def test_valuta_migration(backend, tmp_path, monkeypatch):
+    # A database and an archive from before migration 6, without currencies
+    if backend != "sqlite":
+        pytest.skip("schema di prova SQLite")
+    monkeypatch.setattr(config, "ARCHIVE_DIR", str(tmp_path / "archivio"))
+    (tmp_path / "archivio").mkdir()
+    utils.Categoria.create_table()
+    utils.db.execute_sql(
+        "CREATE TABLE transazioni (id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, date DATE NOT NULL, "
+        "user_id INTEGER NOT NULL, importo INTEGER NOT NULL, descrizione TEXT, categoria_id INTEGER)"
+    )
+    utils.db.execute_sql(
+        "CREATE TABLE riepiloghi (user_id INTEGER NOT NULL, month TEXT NOT NULL, categoria_id INTEGER NOT NULL, "
+        "importo INTEGER NOT NULL, PRIMARY KEY (user_id, month, categoria_id))"
+    )
+    utils.db.execute_sql(
+        "INSERT INTO transazioni (timestamp, date, user_id, importo, descrizione) VALUES (1, '2024-03-01', ?, 500, 'x')",
+        (USER_ID,),
+    )
+    utils.db.execute_sql("INSERT INTO riepiloghi VALUES (?, '2024-03', 0, 500)", (USER_ID,))
+    with contextlib.closing(sqlite3.connect(utils.archive_path(2020))) as conn, conn:
+        conn.execute(
+            "CREATE TABLE transazioni (id INTEGER, timestamp INTEGER, date DATE, user_id INTEGER, importo INTEGER, "
+            "descrizione TEXT, categoria_id INTEGER)"
+        )
+        conn.execute("INSERT INTO transazioni VALUES (1, 1, '2020-05-01', ?, 700, 'y', NULL)", (USER_ID,))
+    utils.Migrazione.create_table()
+    utils.Migrazione.insert_many([{"version": version, "applied": 0} for version in range(1, 6)]).execute()
+
+    asyncio.run(loadtest.replay([]))
+
+    assert len(utils.Migrazione.select()) == len(utils.MIGRATIONS)
+    assert [(r.month, r.valuta, r.importo) for r in utils.Riepilogo.select()] == [("2024-03", "", 500)]
+    with contextlib.closing(sqlite3.connect(utils.archive_path(2020))) as conn:
+        assert "valuta" in {row[1] for row in conn.execute("PRAGMA table_info(transazioni)")}
+    by_cat, _, _ = utils.analyze_transactions(USER_ID, datetime.date(2020, 1, 1), datetime.date(2024, 12, 31))
+    assert by_cat == [("Nessuna", 1200)]
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+
+import config
+import loadtest
+import utils
+from utils import find_duplicate, remember_transactions
+
+USER_ID = 100000
+WINDOW = 600
+
+
+def row(timestamp, importo=1250, descrizione="Kebab da Ciccio", date="2024-03-01", valuta=None):
+    return {
+        "timestamp": timestamp,
+        "date": date,
+        "user_id": USER_ID,
+        "importo": importo,
+        "descrizione": descrizione,
+        "categoria_id": None,
+        "valuta": valuta,
+    }
+
+
+@pytest.fixture(params=["memory", "database"])
+def saved(request, backend, monkeypatch):
+    # A transaction saved at 1000: remembered by this process, or only in the table (after a restart)
+    monkeypatch.setattr(config, "DUPLICATE_WINDOW", WINDOW)
+    asyncio.run(loadtest.replay([]))
+    if request.param == "memory":
+        remember_transactions([row(1000)])
+    else:
+        utils.Transazione.create(**row(1000))
+    return 1000
+
+
+@pytest.mark.parametrize("timestamp, found", [(1000, True), (1000 + WINDOW, True), (1000 + WINDOW + 1, False)])
+def test_window(saved, timestamp, found):
+    assert find_duplicate(row(timestamp)) == (saved if found else None)
+
+
+def test_same_expense_only(saved):
+    # Description compared without case and extra spaces, everything else as it is
+    assert find_duplicate(row(1100, descrizione="  kebab  da ciccio ")) == saved
+    assert find_duplicate(row(1100, descrizione="kebab")) is None
+    assert find_duplicate(row(1100, importo=1251)) is None
+    assert find_duplicate(row(1100, date="2024-03-02")) is None
+    assert find_duplicate(row(1100, valuta="USD")) is None
+
+
+def test_window_off(saved, monkeypatch):
+    monkeypatch.setattr(config, "DUPLICATE_WINDOW", 0)
+    assert find_duplicate(row(1100)) is None
+
+
+def test_surrogate_key_migration(backend):
+    # A database from before migration 5: (user_id, timestamp, importo) primary key, no id
+    if backend != "sqlite":
+        pytest.skip("schema di prova SQLite")
+    utils.Categoria.create_table()
+    utils.Riepilogo.create_table()
+    utils.db.execute_sql(
+        "CREATE TABLE transazioni (timestamp INTEGER NOT NULL, date DATE NOT NULL, user_id INTEGER NOT NULL, "
+        "importo INTEGER NOT NULL, descrizione TEXT, categoria_id INTEGER REFERENCES categorie (id), "
+        "PRIMARY KEY (user_id, timestamp, importo))"
+    )
+    for sql in utils.SEARCH_INDEX:
+        utils.db.execute_sql(sql)
+    utils.Migrazione.create_table()
+    utils.Migrazione.insert_many([{"version": version, "applied": 0} for version in (1, 2, 3, 4)]).execute()
+    for timestamp, descrizione in ((1000, "kebab da ciccio"), (1001, "spesa conad")):
+        utils.db.execute_sql(
+            "INSERT INTO transazioni (timestamp, date, user_id, importo, descrizione) VALUES (?, ?, ?, ?, ?)",
+            (timestamp, "2024-03-01", USER_ID, 1250, descrizione),
+        )
+    rowids = dict(utils.db.execute_sql("SELECT descrizione, rowid FROM transazioni").fetchall())
+
+    asyncio.run(loadtest.replay([]))
+
+    assert len(utils.Migrazione.select()) == len(utils.MIGRATIONS)
+    assert {t.descrizione: t.id for t in utils.Transazione.select()} == rowids
+    # The search index still points at the right rows
+    found, _ = utils.search_transactions(USER_ID, "kebab")
+    assert [t.descrizione for t in found] == ["kebab da ciccio"]
+    # The same amount twice in the same second
+    now = int(time.time())
+    utils.Transazione.insert_many([row(now, descrizione="caffè"), row(now, descrizione="caffè")]).execute()
+    assert utils.Transazione.select().where(utils.Transazione.timestamp == now).count() == 2
@@ -0,0 +1,54 @@
+import datetime
+
+import pytest
+
+from utils import month_range, parse_period, report_presets
+
+D = datetime.date
+
+
+@pytest.mark.parametrize(
+    "text, period",
+    [
+        ("2024", (D(2024, 1, 1), D(2024, 12, 31))),
+        ("2024-02", (D(2024, 2, 1), D(2024, 2, 29))),
+        ("2023-02", (D(2023, 2, 1), D(2023, 2, 28))),
+        ("2024-01 2024-03", (D(2024, 1, 1), D(2024, 3, 31))),
+        ("2024-01-15 2024-03-31", (D(2024, 1, 15), D(2024, 3, 31))),
+        ("2024-12-31", (D(2024, 12, 31), D(2024, 12, 31))),
+        # Mixed precisions: from the start of the first to the end of the last
+        ("2023 2024-02-10", (D(2023, 1, 1), D(2024, 2, 10))),
+        ("  2024-01   2024-01  ", (D(2024, 1, 1), D(2024, 1, 31))),
+    ],
+)
+def test_parse_period(text, period):
+    assert parse_period(text) == period
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["", "abcd", "2024-13", "2024-02-30", "24-01", "2024-03 2024-01", "2024-01-02 2024-01-01", "2024 2025 2026"],
+)
+def test_parse_period_invalid(text):
+    with pytest.raises(ValueError, match="Periodo non valido"):
+        parse_period(text)
+
+
+def test_month_range():
+    assert month_range("2024-12") == (D(2024, 12, 1), D(2024, 12, 31))
+
+
+def test_report_presets():
+    presets = {label: (start, end) for label, start, end in report_presets(D(2024, 2, 10))}
+    assert presets == {
+        "Mese corrente": (D(2024, 2, 1), D(2024, 2, 29)),
+        "Mese scorso": (D(2024, 1, 1), D(2024, 1, 31)),
+        "Trimestre": (D(2024, 1, 1), D(2024, 3, 31)),
+        "Anno in corso": (D(2024, 1, 1), D(2024, 2, 10)),
+        "Ultimi 12 mesi": (D(2023, 3, 1), D(2024, 2, 10)),
+    }
+    # Across the year: the last quarter and twelve months back from January
+    presets = {label: (start, end) for label, start, end in report_presets(D(2025, 1, 5))}
+    assert presets["Mese scorso"] == (D(2024, 12, 1), D(2024, 12, 31))
+    assert presets["Ultimi 12 mesi"] == (D(2024, 2, 1), D(2025, 1, 5))
+    assert report_presets(D(2024, 11, 30))[2][1:] == (D(2024, 10, 1), D(2024, 12, 31))
@@ -0,0 +1,40 @@
+import asyncio
+import itertools
+
+import loadtest
+import reports
+import utils
+
+USER_ID = 100000
+
+
+def chart_updates():
+    # An expense, its text report for the current month, then the charts
+    _, start_date, end_date = utils.report_presets()[0]
+    update_ids = itertools.count(1)
+    return loadtest.expense_session(update_ids, USER_ID) + [
+        loadtest.command_update(next(update_ids), USER_ID, "menu"),
+        loadtest.callback_update(next(update_ids), USER_ID, "goto_reports"),
+        loadtest.callback_update(next(update_ids), USER_ID, f"reports_{start_date}_{end_date}"),
+        loadtest.callback_update(next(update_ids), USER_ID, f"reportsimg_{start_date}_{end_date}"),
+    ]
+
+
+def test_charts_sent(backend, monkeypatch):
+    monkeypatch.setattr(reports, "render_chart", lambda kind, aggregates, currency: b"jpg")
+    application = asyncio.run(loadtest.replay(chart_updates()))
+
+    assert application.bot.request.calls["sendPhoto"] == 1
+    assert application.bot.request.texts[-1] == "Sto elaborando i dati, attendi."
+
+
+def test_chart_failure_reported(backend, monkeypatch, caplog):
+    def render_chart(kind, aggregates, currency):
+        raise RuntimeError("kaleido non risponde")
+
+    monkeypatch.setattr(reports, "render_chart", render_chart)
+    application = asyncio.run(loadtest.replay(chart_updates()))
+
+    assert not application.bot.request.calls["sendPhoto"]
+    assert application.bot.request.texts[-1] == "Non sono riuscito a generare i grafici, riprova più tardi."
+    assert any("kaleido non risponde" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,35 @@
+import asyncio
+import itertools
+
+import loadtest
+import main
+
+
+def search_updates(user_id):
+    update_ids = itertools.count(1)
+    return [
+        loadtest.text_update(next(update_ids), user_id, "12.50 kebab da ciccio"),
+        loadtest.callback_update(next(update_ids), user_id, "salva_transazione"),
+        loadtest.command_update(next(update_ids), user_id, "cerca kebab"),
+    ]
+
+
+def test_menu_after_search(backend):
+    # The results end the search: the menu buttons answer right away, the page buttons still work
+    updates = search_updates(100000) + [
+        loadtest.callback_update(100, 100000, "goto_categories"),
+        loadtest.callback_update(101, 100000, "cerca_0"),
+    ]
+    application = asyncio.run(loadtest.replay(updates))
+
+    texts = application.bot.request.texts
+    assert "kebab" in texts[-3] and "da ciccio" in texts[-3]
+    assert texts[-2].startswith("🏷️ CATEGORIE")
+    assert "da ciccio" in texts[-1]
+
+
+def test_search_mentions_archives(backend, monkeypatch):
+    monkeypatch.setattr(main, "archived_years", lambda: [2021, 2022])
+    application = asyncio.run(loadtest.replay(search_updates(100000)))
+
+    assert "anni archiviati (fino al 2022)" in application.bot.request.texts[-1]
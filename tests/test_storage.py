@@ -0,0 +1,60 @@
+import asyncio
+import itertools
+import logging
+import random
+
+import loadtest
+import utils
+
+
+def handler_errors(caplog):
+    # Exceptions in handlers are caught and logged by the Application, they don't reach the test
+    return [record.getMessage() for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_storage(backend, caplog):
+    # Tables and migrations, the save flow through the bot, then the reporting queries
+    users, sessions = 20, 3
+    commits = utils.DatabaseStats.commits
+    application = asyncio.run(loadtest.replay(loadtest.synthetic_updates(users, sessions)))
+    assert not handler_errors(caplog)
+
+    saved = utils.Transazione.select().count()
+    assert saved == users * sessions
+    _, by_month, _ = utils.analyze_transactions(user_id=100000, days=1)
+    assert sum(spending for _, spending in by_month) == sum(
+        t.importo for t in utils.Transazione.select().where(utils.Transazione.user_id == 100000)
+    )
+    total = utils.Transazione.select(utils.peewee.fn.SUM(utils.Transazione.importo)).scalar()
+    assert utils.Riepilogo.select(utils.peewee.fn.SUM(utils.Riepilogo.importo)).scalar() == total
+    assert len(utils.Migrazione.select()) == len(utils.MIGRATIONS)
+    # One transaction, so one commit, per update
+    stats = application.update_processor.stats()
+    assert utils.DatabaseStats.commits - commits <= stats["updates"] + len(utils.MIGRATIONS)
+    if backend == "sqlite":
+        # Every per-user query must go through an index, not read the whole table
+        scans = [(sql, plan) for sql, plan in utils.full_scans("transazioni") if "user_id" in sql]
+        assert not scans, "\n\n".join(f"{sql}\n{plan}" for sql, plan in scans)
+
+
+def test_flow(backend, caplog):
+    # Interleaved users through the ConversationHandler: expenses saved as they are, edited or with a
+    # category, then a report each, preset or typed period (a user stays on a report until conversation_timeout)
+    random.seed(0)
+    update_ids = itertools.count(1)
+    user_ids = [100000 + i for i in range(30)]
+    sessions = [loadtest.expense_session, loadtest.edit_session, loadtest.category_session, loadtest.batch_session]
+    updates = [
+        update for _ in range(4) for user_id in user_ids for update in random.choice(sessions)(update_ids, user_id)
+    ]
+    reports = [loadtest.report_session, loadtest.custom_report_session]
+    updates += [update for user_id in user_ids for update in random.choice(reports)(update_ids, user_id)]
+    asyncio.run(loadtest.replay(updates))
+    assert not handler_errors(caplog)
+
+    callbacks = [update["callback_query"]["data"] for update in updates if "callback_query" in update]
+    batches = [update["message"]["text"] for update in updates if "\n" in update.get("message", {}).get("text", "")]
+    saved = callbacks.count("salva_transazione") + sum(len(text.split("\n")) for text in batches)
+    assert utils.Transazione.select().count() == saved
+    total = utils.Transazione.select(utils.peewee.fn.SUM(utils.Transazione.importo)).scalar()
+    assert utils.Riepilogo.select(utils.peewee.fn.SUM(utils.Riepilogo.importo)).scalar() == total
@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from telegram.ext import MessageHandler, filters
+
+import loadtest
+import utils
+
+
+async def failing_handler(update, context):
+    utils.Transazione.create(
+        timestamp=int(time.time()),
+        date="2024-01-01",
+        user_id=update.effective_user.id,
+        importo=100,
+        descrizione="scritta a metà",
+    )
+    raise RuntimeError("handler fallito dopo una scrittura")
+
+
+def test_failed_update_is_rolled_back(backend, caplog):
+    updates = [
+        loadtest.text_update(1, 100000, "guasto"),
+        *loadtest.expense_session(iter(range(2, 4)), 100000),
+    ]
+
+    def on_build(application):
+        # Before the ConversationHandler, which then handles the update as usual
+        application.add_handler(MessageHandler(filters.Regex("^guasto$"), failing_handler), group=-2)
+
+    asyncio.run(loadtest.replay(updates, on_build=on_build))
+
+    assert any(record.exc_info and "handler fallito" in str(record.exc_info[1]) for record in caplog.records)
+    assert not utils.Transazione.select().where(utils.Transazione.descrizione == "scritta a metà").exists()
+    # The next update has a transaction of its own, committed
+    assert utils.Transazione.select().count() == 1
@@ -1,53 +1,351 @@
+import collections
+import contextlib
+import contextvars
 import datetime
+import decimal
+import functools
+import glob
 import logging
+import os
+import re
+import sqlite3
+import threading
+import time
 
-import pandas as pd
 import peewee
-import plotly.express as px
+import plotly.colors
 import plotly.graph_objects as go
 import plotly.io as pio
 import rapidfuzz
 from plotly.subplots import make_subplots
 from prettytable import PrettyTable
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import BaseUpdateProcessor
 
 import config
+import exchange
+import outbox
 
 DBPATH = "db/sqlite.db"
-db = peewee.SqliteDatabase(DBPATH)
+# The actual database is chosen by init_db (config.DB_BACKEND), models only see the proxy
+db = peewee.DatabaseProxy()
+
+
+class DatabaseStats:
+    # Process-wide counters, see UnitOfWork and query_report
+    statements = 0
+    commits = 0
+    # normalized statement -> QueryStats
+    queries = {}
+    lock = threading.Lock()
+
+
+class QueryStats:
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "sql", "params", "explained")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.sql = self.params = None  # the slowest execution, to EXPLAIN it
+        self.explained = False
+
+
+PLACEHOLDERS = re.compile(r"\((?:\?|%s)(?:, (?:\?|%s))*\)")
+ROW_LISTS = re.compile(r"\(\?\.\.\.\)(?:, \(\?\.\.\.\))+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    # Parameters are already placeholders; IN lists and multi-row VALUES collapse to one entry
+    return ROW_LISTS.sub("(?...), ...", PLACEHOLDERS.sub("(?...)", sql))
+
+
+class CountingCursor:
+    # Counts the rows a SELECT returns as they are fetched
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedMixin:
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        cursor = super().execute_sql(sql, params, *args, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        key = normalize_sql(sql)
+        with DatabaseStats.lock:
+            DatabaseStats.statements += 1
+            stats = DatabaseStats.queries.get(key) or DatabaseStats.queries.setdefault(key, QueryStats())
+            stats.count += 1
+            stats.total_ms += elapsed
+            if elapsed >= stats.max_ms:
+                stats.max_ms = elapsed
+                stats.sql, stats.params = sql, params
+            if cursor.rowcount > 0:
+                stats.rows += cursor.rowcount
+        if elapsed >= config.SLOW_QUERY_MS:
+            self.log_slow_query(sql, params, elapsed, stats)
+        if cursor.description is None:
+            return cursor
+        return CountingCursor(cursor, stats)
+
+    def query_plan(self, sql, params=None):
+        prefix = "EXPLAIN QUERY PLAN " if isinstance(self, peewee.SqliteDatabase) else "EXPLAIN "
+        # Not instrumented, it would count (and maybe log) itself
+        rows = super().execute_sql(prefix + sql, params).fetchall()
+        return "\n".join(str(row[-1]) for row in rows)
+
+    def log_slow_query(self, sql, params, elapsed, stats):
+        logger.warning(f"Query lenta ({elapsed:.0f} ms): {sql}")
+        # The plan of each statement only once, it doesn't change between executions
+        if stats.explained or not sql.lstrip().upper().startswith("SELECT"):
+            return
+        stats.explained = True
+        try:
+            logger.warning(f"Piano:\n{self.query_plan(sql, params)}")
+        except peewee.PeeweeException as e:
+            logger.warning(f"EXPLAIN fallito: {e!r}")
+
+    def commit(self):
+        DatabaseStats.commits += 1
+        return super().commit()
+
+
+class InstrumentedSqliteDatabase(InstrumentedMixin, peewee.SqliteDatabase):
+    pass
+
+
+def make_database(backend=None, **options):
+    backend = backend or config.DB_BACKEND
+    if backend == "sqlite":
+        path = options.pop("path", DBPATH)
+        pragmas = {"journal_mode": "wal", "synchronous": "normal", "foreign_keys": 1, **options.pop("pragmas", {})}
+        # uri: archives are ATTACHed as file:...?mode=ro
+        return InstrumentedSqliteDatabase(path, pragmas=pragmas, uri=True, **options)
+    if backend == "postgres":
+        # Optional dependency: psycopg2
+        from playhouse.pool import PooledPostgresqlDatabase
+
+        class InstrumentedPostgresqlDatabase(InstrumentedMixin, PooledPostgresqlDatabase):
+            pass
+
+        options.setdefault("max_connections", 8)
+        options.setdefault("stale_timeout", 300)
+        return InstrumentedPostgresqlDatabase(options.pop("database"), **options)
+    raise ValueError(f"DB_BACKEND non supportato: {backend}")
+
+
+def init_db(backend=None, **options):
+    options = options or dict(config.DB_OPTIONS)
+    db.initialize(make_database(backend, **options))
+
+
+def is_sqlite():
+    return isinstance(db.obj, peewee.SqliteDatabase)
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    # One connection and one transaction (so one commit/fsync) for a whole block of DB work
+    db.connect(reuse_if_open=True)
+    attach_archives()
+    try:
+        with db.atomic() as transaction:
+            yield transaction
+    finally:
+        # SQLite keeps its (cheap, thread-local) connection, pooled connections go back to the pool
+        if not is_sqlite():
+            db.close()
 
 
-class Transazione(peewee.Model):
-    timestamp = peewee.IntegerField()
-    date = peewee.DateField()
-    user_id = peewee.IntegerField()
-    importo = peewee.IntegerField()
-    descrizione = peewee.TextField(null=True)
-    categoria = peewee.TextField(null=True)
+def in_unit_of_work(function, *args, **kwargs):
+    # For asyncio.to_thread outside updates: the worker thread's queries get a unit_of_work of their own,
+    # so a pooled connection goes back to the pool instead of staying checked out by the thread
+    with unit_of_work():
+        return function(*args, **kwargs)
+
+
+# [transaction] of the update being processed, emptied when it ends: tasks started by its handlers
+# copy the context, and must not roll back whatever runs on the connection later. See rollback_update.
+_update_transaction = contextvars.ContextVar("update_transaction", default=())
+
+
+# [(function, args)] to call once the update being processed is committed: writes that can't be part of
+# its transaction, like the archive files' (see after_commit)
+_after_commit = contextvars.ContextVar("after_commit", default=None)
 
-    class Meta:
-        database = db
-        table_name = "transazioni"
-        primary_key = peewee.CompositeKey("user_id", "timestamp", "importo")
+
+def rollback_update():
+    # Undoes the writes of the update being processed, from the error handler: Application.process_update
+    # catches the handlers' exceptions, so they never reach UnitOfWork's transaction to roll it back.
+    # A no-op outside an update (jobs, background tasks).
+    for transaction in _update_transaction.get():
+        transaction.rollback()
+    pending = _after_commit.get()
+    if pending is not None:
+        pending.clear()
+
+
+def after_commit(function, *args):
+    # In an update, function(*args) runs after its commit and not at all if it's rolled back; right away
+    # outside one. function must be safe to repeat: a crash right after the commit skips it.
+    pending = _after_commit.get()
+    if pending is None:
+        function(*args)
+    else:
+        pending.append((function, args))
+
+
+class UnitOfWork(BaseUpdateProcessor):
+    """Runs all the database work of each update's handlers in a single unit_of_work."""
+
+    def __init__(self):
+        # One update at a time: they share the event loop thread's connection and transaction
+        super().__init__(max_concurrent_updates=1)
+        self.updates = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    async def do_process_update(self, update, coroutine):
+        before = DatabaseStats.statements
+        start = time.perf_counter()
+        # The handlers' replies go out when they are done, after the commit (see outbox.py)
+        async with outbox.collect():
+            pending = []
+            after_commit_token = _after_commit.set(pending)
+            try:
+                with unit_of_work() as transaction:
+                    current = [transaction]
+                    token = _update_transaction.set(current)
+                    try:
+                        await coroutine
+                    finally:
+                        current.clear()
+                        _update_transaction.reset(token)
+            finally:
+                _after_commit.reset(after_commit_token)
+            for function, args in pending:
+                function(*args)
+            elapsed = (time.perf_counter() - start) * 1000
+        statements = DatabaseStats.statements - before
+        self.updates += 1
+        self.statements += statements
+        self.max_statements = max(self.max_statements, statements)
+        self.total_ms += elapsed
+        self.max_ms = max(self.max_ms, elapsed)
+        logger.debug(f"Update {update.update_id}: {statements} query, {elapsed:.1f} ms.")
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "updates": self.updates,
+            "statements": self.statements,
+            "statements_per_update": self.statements / self.updates if self.updates else 0,
+            "max_statements": self.max_statements,
+            "commits": DatabaseStats.commits,
+            "ms_per_update": self.total_ms / self.updates if self.updates else 0,
+            "max_ms": self.max_ms,
+        }
+
+
+def query_report(limit=10, order="total_ms"):
+    # Text summary of the normalized statements with the highest total (or max) time
+    with DatabaseStats.lock:
+        queries = sorted(DatabaseStats.queries.items(), key=lambda q: getattr(q[1], order), reverse=True)
+    lines = [f"{DatabaseStats.statements} query, {len(queries)} distinte, {DatabaseStats.commits} commit"]
+    for sql, stats in queries[:limit]:
+        lines.append(
+            f"\n{stats.count}x  tot {stats.total_ms:.0f} ms  media {stats.total_ms / stats.count:.2f} ms  "
+            f"max {stats.max_ms:.1f} ms  righe {stats.rows}\n{sql[:200]}"
+        )
+    return "\n".join(lines)
+
+
+def full_scans(table):
+    # Recorded SELECTs whose plan reads the whole table instead of using an index (SQLite only)
+    with DatabaseStats.lock:
+        queries = [(key, stats.sql, stats.params) for key, stats in DatabaseStats.queries.items()]
+    scans = []
+    for key, sql, params in queries:
+        if not key.startswith("SELECT") or f'"{table}"' not in key:
+            continue
+        plan = db.obj.query_plan(sql, params)
+        # "SCAN t1" reads every row, "SCAN t1 USING INDEX ..." and "SEARCH ..." don't
+        if re.search(r"\bSCAN \w+$", plan, re.MULTILINE):
+            scans.append((key, plan))
+    return scans
 
 
 class Categoria(peewee.Model):
+    id = peewee.AutoField()
     user_id = peewee.IntegerField()
     name = peewee.TextField()
     parent = peewee.TextField(null=True)
     times_used = peewee.IntegerField(default=0)
+    hidden = peewee.BooleanField(default=False)  # not in the user's list, but past transactions still use it
 
     class Meta:
         database = db
         table_name = "categorie"
-        primary_key = peewee.CompositeKey("user_id", "name")
+        indexes = ((("user_id", "name"), True),)
+
+
+class Transazione(peewee.Model):
+    id = peewee.AutoField()  # the rowid, also the FTS5 content_rowid
+    timestamp = peewee.IntegerField()
+    date = peewee.DateField()
+    user_id = peewee.IntegerField()
+    importo = peewee.IntegerField()  # cents, see parse_importo/format_importo
+    descrizione = peewee.TextField(null=True)
+    valuta = peewee.TextField(null=True)  # ISO code (exchange.py), NULL: the user's currency
+    # NULL for no category ("Nessuna"), names through category_names()
+    categoria = peewee.ForeignKeyField(Categoria, null=True, column_name="categoria_id", index=False, lazy_load=False)
+
+    class Meta:
+        database = db
+        table_name = "transazioni"
+        # Every report and list is a date range scan of one user, duplicate checks are point lookups
+        indexes = ((("user_id", "date", "importo"), False),)
 
 
 class Setting(peewee.Model):
     user_id = peewee.IntegerField()
     setting1 = peewee.TextField(null=True)  # Valuta
     setting2 = peewee.TextField(null=True)  # TBD
-    setting3 = peewee.TextField(null=True)  # TBD
+    setting3 = peewee.TextField(null=True)  # Digest
     setting4 = peewee.TextField(null=True)  # TBD
     setting5 = peewee.TextField(null=True)  # TBD
 
@@ -57,31 +355,422 @@ class Setting(peewee.Model):
         primary_key = peewee.CompositeKey("user_id")
 
 
+class Riepilogo(peewee.Model):
+    # Monthly totals per category, kept in step with transazioni by add_to_rollup/refresh_rollup
+    user_id = peewee.IntegerField()
+    month = peewee.TextField()  # "YYYY-MM"
+    categoria_id = peewee.IntegerField()  # 0 for transactions without a category
+    # Amounts stay in their currency, "" for the user's own (transazioni.valuta NULL)
+    valuta = peewee.TextField(default="", constraints=[peewee.SQL("DEFAULT ''")])
+    importo = peewee.IntegerField(default=0)  # cents
+
+    class Meta:
+        database = db
+        table_name = "riepiloghi"
+        primary_key = peewee.CompositeKey("user_id", "month", "categoria_id", "valuta")
+
+
+class Budget(peewee.Model):
+    # Monthly spending limit of a category, in the user's currency (budget.py)
+    user_id = peewee.IntegerField()
+    categoria_id = peewee.IntegerField()
+    importo = peewee.IntegerField()  # cents
+
+    class Meta:
+        database = db
+        table_name = "budget"
+        primary_key = peewee.CompositeKey("user_id", "categoria_id")
+
+
+class Migrazione(peewee.Model):
+    version = peewee.IntegerField(primary_key=True)
+    applied = peewee.IntegerField()  # timestamp
+
+    class Meta:
+        database = db
+        table_name = "migrazioni"
+
+
 logger = logging.getLogger(__name__)
 
+init_db()
+
+
+# Closed years can be moved to read-only yearly archive files (archive.py, SQLite only), so the main
+# database and its indexes only hold recent transactions. Reads that may reach back into archived
+# years go through tier_models(); the monthly rollup (riepiloghi) is never archived.
+ARCHIVE_SCHEMA = "archivio_{}"
+
+_archived_years = None
+# The archive years ATTACHed to this thread's connection
+_attached = threading.local()
+
+
+def archive_path(year):
+    # Named after the main database, so sharded workers (one database each) don't share archives
+    name = os.path.splitext(os.path.basename(db.obj.database))[0]
+    return os.path.join(config.ARCHIVE_DIR, f"{name}-{year}.db")
+
+
+def archived_years(refresh=False):
+    global _archived_years
+    if _archived_years is None or refresh:
+        years = []
+        if config.ARCHIVE_DIR and is_sqlite():
+            pattern = re.compile(r"-(\d{4})\.db$")
+            years = sorted(int(pattern.search(path).group(1)) for path in glob.glob(archive_path("[0-9]" * 4)))
+        _archived_years = years
+    return _archived_years
+
+
+def attach_archives():
+    # SQLite can't ATTACH inside a transaction: unit_of_work attaches new archives before starting one
+    years = archived_years()
+    if not years or db.in_transaction():
+        return
+    conn = db.connection()
+    if getattr(_attached, "conn", None) is conn and _attached.years == years:
+        return
+    names = {row[1] for row in conn.execute("PRAGMA database_list")}
+    for year in years:
+        if ARCHIVE_SCHEMA.format(year) in names:
+            continue
+        try:
+            uri = f"file:{archive_path(year)}?mode=ro"
+            conn.execute("ATTACH DATABASE ? AS ?", (uri, ARCHIVE_SCHEMA.format(year)))
+        except sqlite3.OperationalError as e:
+            # SQLITE_MAX_ATTACHED (10 by default)
+            logger.error(f"Archivio {year} non collegato: {e!r}")
+            break
+    _attached.conn, _attached.years = conn, years
+
+
+def attached_years():
+    # Inside a transaction, archives created after it started aren't attached yet
+    if not archived_years():
+        return []
+    attach_archives()
+    names = {row[1] for row in db.connection().execute("PRAGMA database_list")}
+    return [year for year in archived_years() if ARCHIVE_SCHEMA.format(year) in names]
+
+
+@functools.lru_cache(maxsize=None)
+def archive_model(year):
+    # Transazione in the archive of year; no foreign key, categorie stays in the main database
+    class Meta:
+        schema = ARCHIVE_SCHEMA.format(year)
+        table_name = "transazioni"
+
+    categoria = peewee.IntegerField(null=True, column_name="categoria_id")
+    attrs = {"Meta": Meta, "categoria": categoria, "__module__": __name__}
+    return type(f"TransazioneArchivio{year}", (Transazione,), attrs)
+
+
+def tier_models(start_date=datetime.date.min, end_date=datetime.date.max):
+    # Transazione plus the archives holding years between start_date and end_date
+    years = [year for year in attached_years() if start_date.year <= year <= end_date.year]
+    return [Transazione] + [archive_model(year) for year in years]
+
+
+def migration_importo_cents():
+    # Amounts used to be stored as (truncated) euros
+    db.execute_sql("UPDATE transazioni SET importo = CAST(ROUND(importo * 100) AS INTEGER)")
+
+
+def month_expr(date):
+    # SQL "YYYY-MM" of a date column
+    if is_sqlite():
+        return peewee.fn.strftime("%Y-%m", date)
+    return peewee.fn.to_char(date, "YYYY-MM")
+
+
+def migration_rollup():
+    # Existing databases get the (user_id, date) index; the monthly totals are backfilled by
+    # migration_categoria_id, which rebuilds riepiloghi by category id
+    db.execute_sql("CREATE INDEX IF NOT EXISTS transazioni_user_id_date ON transazioni (user_id, date)")
+
+
+def migration_categoria_id():
+    # categorie gets a surrogate id and transazioni an integer categoria_id instead of the name.
+    # Tables created by this version already have both, only older databases are converted.
+    if "id" not in {c.name for c in db.get_columns("categorie")}:
+        db.execute_sql("CREATE TABLE categorie_old AS SELECT * FROM categorie")
+        db.drop_tables([Categoria])
+        Categoria.create_table()
+        db.execute_sql(
+            "INSERT INTO categorie (user_id, name, parent, times_used, hidden) "
+            "SELECT user_id, name, parent, times_used, FALSE FROM categorie_old"
+        )
+        db.execute_sql("DROP TABLE categorie_old")
+    if "categoria" in {c.name for c in db.get_columns("transazioni")}:
+        # Categories typed by hand (cambia_categoria) were never in categorie
+        db.execute_sql(
+            "INSERT INTO categorie (user_id, name, times_used, hidden) "
+            "SELECT DISTINCT t.user_id, t.categoria, 0, TRUE FROM transazioni t "
+            "WHERE t.categoria IS NOT NULL AND t.categoria <> 'Nessuna' AND NOT EXISTS "
+            "(SELECT 1 FROM categorie c WHERE c.user_id = t.user_id AND c.name = t.categoria)"
+        )
+        db.execute_sql("ALTER TABLE transazioni ADD COLUMN categoria_id INTEGER REFERENCES categorie (id)")
+        db.execute_sql(
+            "UPDATE transazioni SET categoria_id = "
+            "(SELECT c.id FROM categorie c WHERE c.user_id = transazioni.user_id AND c.name = transazioni.categoria)"
+        )
+        db.execute_sql("ALTER TABLE transazioni DROP COLUMN categoria")
+    db.drop_tables([Riepilogo])
+    Riepilogo.create_table()
+    month = month_expr(Transazione.date)
+    categoria = peewee.fn.COALESCE(Transazione.categoria, 0)
+    totals = Transazione.select(Transazione.user_id, month, categoria, peewee.fn.SUM(Transazione.importo)).group_by(
+        Transazione.user_id, month, categoria
+    )
+    fields = [Riepilogo.user_id, Riepilogo.month, Riepilogo.categoria_id, Riepilogo.importo]
+    Riepilogo.insert_from(totals, fields).execute()
+
+
+# External content FTS5 index of transazioni.descrizione (SQLite), kept in sync by the triggers.
+# user_id is indexed too, so a user's matches are found through the index and not filtered afterwards.
+SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS transazioni_fts USING fts5(descrizione, user_id, "
+    "content='transazioni', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS transazioni_fts_ai AFTER INSERT ON transazioni BEGIN "
+    "INSERT INTO transazioni_fts (rowid, descrizione, user_id) VALUES (new.rowid, new.descrizione, new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS transazioni_fts_ad AFTER DELETE ON transazioni BEGIN "
+    "INSERT INTO transazioni_fts (transazioni_fts, rowid, descrizione, user_id) "
+    "VALUES ('delete', old.rowid, old.descrizione, old.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS transazioni_fts_au AFTER UPDATE OF descrizione, user_id ON transazioni BEGIN "
+    "INSERT INTO transazioni_fts (transazioni_fts, rowid, descrizione, user_id) "
+    "VALUES ('delete', old.rowid, old.descrizione, old.user_id); "
+    "INSERT INTO transazioni_fts (rowid, descrizione, user_id) VALUES (new.rowid, new.descrizione, new.user_id); END",
+]
+
+
+def migration_search_index():
+    # /cerca: FTS5 on SQLite, a GIN expression index on PostgreSQL (see search_transactions)
+    if not is_sqlite():
+        db.execute_sql(
+            "CREATE INDEX IF NOT EXISTS transazioni_descrizione_fts ON transazioni "
+            "USING GIN (to_tsvector('simple', COALESCE(descrizione, '')))"
+        )
+        return
+    for sql in SEARCH_INDEX:
+        db.execute_sql(sql)
+    db.execute_sql("INSERT INTO transazioni_fts (transazioni_fts) VALUES ('rebuild')")
+
+
+def migration_surrogate_key():
+    # (user_id, timestamp, importo) was the primary key: two expenses of the same amount in the same
+    # second collided. Tables created by this version already have the id.
+    if "id" not in {c.name for c in db.get_columns("transazioni")}:
+        if is_sqlite():
+            # The id is the old rowid, so the FTS5 index still points at the right rows
+            db.execute_sql("CREATE TABLE transazioni_old AS SELECT rowid AS id, * FROM transazioni")
+            db.execute_sql("DROP TABLE transazioni")
+            Transazione.create_table()
+            db.execute_sql(
+                "INSERT INTO transazioni (id, timestamp, date, user_id, importo, descrizione, categoria_id) "
+                "SELECT id, timestamp, date, user_id, importo, descrizione, categoria_id FROM transazioni_old"
+            )
+            db.execute_sql("DROP TABLE transazioni_old")
+        else:
+            db.execute_sql("ALTER TABLE transazioni DROP CONSTRAINT transazioni_pkey")
+            db.execute_sql("ALTER TABLE transazioni ADD COLUMN id SERIAL PRIMARY KEY")
+    # Replaced by (user_id, date, importo), under the name create_table gives it
+    db.execute_sql("DROP INDEX IF EXISTS transazioni_user_id_date")
+    db.execute_sql("DROP INDEX IF EXISTS transazione_user_id_date")
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS transazione_user_id_date_importo ON transazioni (user_id, date, importo)"
+    )
+    if is_sqlite():
+        # The triggers went with the old table
+        for sql in SEARCH_INDEX:
+            db.execute_sql(sql)
+        db.execute_sql("INSERT INTO transazioni_fts (transazioni_fts) VALUES ('rebuild')")
+
+
+def migration_valuta():
+    # Amounts had no currency of their own: existing rows are in the user's currency (NULL, "" in
+    # riepiloghi). Tables created by this version already have the columns.
+    if "valuta" not in {c.name for c in db.get_columns("transazioni")}:
+        db.execute_sql("ALTER TABLE transazioni ADD COLUMN valuta TEXT")
+    if "valuta" not in {c.name for c in db.get_columns("riepiloghi")}:
+        # The currency joins the primary key, the table is rebuilt
+        db.execute_sql("CREATE TABLE riepiloghi_old AS SELECT * FROM riepiloghi")
+        db.drop_tables([Riepilogo])
+        Riepilogo.create_table()
+        db.execute_sql(
+            "INSERT INTO riepiloghi (user_id, month, categoria_id, valuta, importo) "
+            "SELECT user_id, month, categoria_id, '', importo FROM riepiloghi_old"
+        )
+        db.execute_sql("DROP TABLE riepiloghi_old")
+    # Archives are attached read-only, they get the column through a connection of their own
+    for year in archived_years():
+        with contextlib.closing(sqlite3.connect(archive_path(year), timeout=30)) as conn:
+            if "valuta" not in {row[1] for row in conn.execute("PRAGMA table_info(transazioni)")}:
+                with conn:
+                    conn.execute("ALTER TABLE transazioni ADD COLUMN valuta TEXT")
+
+
+# (version, function), append only
+MIGRATIONS = [
+    (1, migration_importo_cents),
+    (2, migration_rollup),
+    (3, migration_categoria_id),
+    (4, migration_search_index),
+    (5, migration_surrogate_key),
+    (6, migration_valuta),
+]
+
+
+def run_migrations():
+    Migrazione.create_table()
+    applied = {m.version for m in Migrazione.select()}
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Migrazione {version}: {migration.__name__}.")
+        with db.atomic():
+            migration()
+            Migrazione.create(version=version, applied=int(time.time()))
+
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def month_range(month):
+    # "YYYY-MM" -> (first day, last day)
+    start = datetime.datetime.strptime(month, "%Y-%m").date()
+    end = (start + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+    return start, end
+
+
+def previous_month(today=None):
+    today = today or datetime.date.today()
+    return (today.replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")
+
+
+def period_span(word):
+    # "2024" -> the whole year, "2024-03" -> the month, "2024-03-15" -> the day
+    if len(word) == 4:
+        year = int(word)
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    if len(word) == 7:
+        return month_range(word)
+    day = datetime.date.fromisoformat(word)
+    return day, day
+
+
+def parse_period(text):
+    # "2024", "2024-01 2024-03", "2024-01-15 2024-03-31" -> (start, end)
+    words = text.split()
+    try:
+        if len(words) not in (1, 2):
+            raise ValueError(text)
+        start_date, end_date = period_span(words[0])[0], period_span(words[-1])[1]
+    except ValueError as e:
+        raise ValueError(f"Periodo non valido: {text}") from e
+    if start_date > end_date:
+        raise ValueError(f"Periodo non valido: {text}")
+    return start_date, end_date
+
+
+def report_presets(today=None):
+    # (label, start, end) of the periods offered by the Reports menu
+    today = today or datetime.date.today()
+    current = today.strftime("%Y-%m")
+    quarter = today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1)
+    # First day of the month 11 months ago, so the current month makes 12
+    months = today.year * 12 + today.month - 12
+    twelve_months = datetime.date(months // 12, months % 12 + 1, 1)
+    return [
+        ("Mese corrente", *month_range(current)),
+        ("Mese scorso", *month_range(previous_month(today))),
+        ("Trimestre", quarter, month_range(f"{quarter.year}-{quarter.month + 2:02d}")[1]),
+        ("Anno in corso", today.replace(month=1, day=1), today),
+        ("Ultimi 12 mesi", twelve_months, today),
+    ]
+
+
+def parse_importo(text: str) -> int:
+    # "12", "12.5", "12,50" -> cents, without going through float
+    try:
+        cents = decimal.Decimal(text.strip().replace(",", ".")) * 100
+        return int(cents.quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+    except (decimal.InvalidOperation, ValueError) as e:
+        raise ValueError(f"Importo non valido: {text}") from e
+
+
+def parse_currency(word, valuta=None):
+    # ISO code of a currency typed next to an amount ("USD", "$"), if it has rates or is the user's
+    # own (valuta, the setting); lowercase words are descriptions ("5 bar")
+    if word not in exchange.SYMBOLS and not word.isupper():
+        return None
+    currency = exchange.iso(word)
+    if currency and (currency == exchange.report_currency(valuta) or exchange.known(currency)):
+        return currency
+    return None
+
+
+AMOUNT_AFFIXES = re.compile(r"^(\D*?)([-+]?[\d.,]+)(\D*)$")
+
+
+def parse_entry(text, valuta=None):
+    # "12.50 pranzo", "12.50 USD pranzo", "$12.50 pranzo", "12,50€" -> (cents, currency or None for
+    # the user's own, description or None)
+    words = text.split(maxsplit=1)
+    if not words:
+        raise ValueError("Importo mancante")
+    rest = words[1].strip() if len(words) > 1 else None
+    match = AMOUNT_AFFIXES.match(words[0])
+    if match is None:
+        raise ValueError(f"Importo non valido: {words[0]}")
+    prefix, amount, suffix = match.groups()
+    currency = None
+    if prefix or suffix:
+        if (prefix and suffix) or not (currency := parse_currency(prefix or suffix, valuta)):
+            raise ValueError(f"Importo non valido: {words[0]}")
+    elif rest:
+        first, _, description = rest.partition(" ")
+        if currency := parse_currency(first, valuta):
+            rest = description.strip() or None
+    return parse_importo(amount), currency, rest
+
+
+def format_importo(cents) -> str:
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
 
 def load_user_settings(context, user_id):
     logger.info("Conversation handler: load_user_settings.")
     query = Setting.select().where(Setting.user_id == user_id)
 
     # setting1 = valuta
-    # setting2 = TBD
-    # setting3 = TBD
+    # setting2 = report mode ("testo" or "grafico")
+    # setting3 = digest ("settimanale", "mensile" or "no", see digest.py)
     # setting4 = TBD
     # setting5 = TBD
 
     if not query:  # Defaults?
         context.user_data["valuta"] = config.DEFAULT_CURRENCY
+        context.user_data["report"] = config.DEFAULT_REPORT_MODE
+        context.user_data["digest"] = config.DIGEST_DEFAULT
     else:
         context.user_data["valuta"] = query[0].setting1
+        context.user_data["report"] = query[0].setting2 or config.DEFAULT_REPORT_MODE
+        context.user_data["digest"] = query[0].setting3 or config.DIGEST_DEFAULT
+
 
+def save_user_setting(user_id, **settings):
+    # Upsert only the given columns, so changing one setting doesn't reset the others
+    Setting.insert(user_id=user_id, **settings).on_conflict(
+        conflict_target=[Setting.user_id], update=settings
+    ).execute()
 
-def is_first_word_number(s: str) -> bool:
+
+def is_first_word_number(s: str, valuta=None) -> bool:
     try:
-        # Split the string into words
-        words = s.split()
-        # Try to convert the first word to a float
-        float(words[0])
+        # Try to convert the first word (with its currency, if any) to an amount
+        parse_entry(s.splitlines()[0], valuta)
         # If no exception is raised, the first word is a number
         return True
     except (ValueError, IndexError):
@@ -108,17 +797,29 @@ def make_editing_keyboard():
     return reply_markup
 
 
-def current_transaction(context, return_dict=False):
+class PendingTransaction:
+    # A transaction being entered or edited, kept in user_data until it's saved or cancelled.
+    # __slots__: a few of these per active user, no per-instance dict
+    __slots__ = ("importo", "categoria", "descrizione", "timestamp", "data", "valuta")
+
+    def __init__(self, importo, categoria=None, descrizione=None, timestamp=None, data=None, valuta=None):
+        self.importo = importo
+        self.categoria = categoria
+        self.descrizione = descrizione
+        self.timestamp = timestamp
+        self.data = data
+        self.valuta = valuta  # ISO code, None: the user's currency
+
+
+def current_transaction(context):
     transaction = context.user_data["transazione_corrente"]
-    valuta = context.user_data["valuta"]
-    if return_dict:
-        return transaction
-    datetime_str = datetime.date.strftime(transaction["data"], "%Y-%m-%d")
-    transazione = f"<b>Data:</> {datetime_str}\n<b>Importo:</b> {transaction['importo']} {valuta}\n"
-    if transaction["categoria"]:
-        transazione += f"<b>Categoria:</b> {transaction['categoria']}\n"
-    if transaction["descrizione"]:
-        transazione += f"<b>Descrizione:</b> {transaction['descrizione']}\n"
+    valuta = transaction.valuta or context.user_data["valuta"]
+    datetime_str = datetime.date.strftime(transaction.data, "%Y-%m-%d")
+    transazione = f"<b>Data:</> {datetime_str}\n<b>Importo:</b> {format_importo(transaction.importo)} {valuta}\n"
+    if transaction.categoria:
+        transazione += f"<b>Categoria:</b> {transaction.categoria}\n"
+    if transaction.descrizione:
+        transazione += f"<b>Descrizione:</b> {transaction.descrizione}\n"
     return transazione
 
 
@@ -138,69 +839,327 @@ def create_default_categories(user_id):
     ]
 
     for cat in default_cats:
-        Categoria.create(user_id=user_id, name=cat, parent=None)
+        add_category(user_id, cat)
     return [[cat, 0] for cat in default_cats]
 
 
 def get_categories(user_id):
     logger.info("Conversation handler: get_categories.")
-    query = Categoria.select().where(Categoria.user_id == user_id).order_by(Categoria.times_used.desc())
-    if not query:
+    if not category_names(user_id):
         return create_default_categories(user_id)
-    else:
-        return [[cat.name, cat.times_used] for cat in query]
+    query = (
+        Categoria.select()
+        .where(Categoria.user_id == user_id, Categoria.hidden == False)  # noqa: E712
+        .order_by(Categoria.times_used.desc())
+    )
+    return [[cat.name, cat.times_used] for cat in query]
 
 
-def try_categorize(user_id, description):
-    logger.info("Conversation handler: try_categorize.")
-    # get list of transaction, desc, cat from newer. first desc that matchs, return category
-    query = Transazione.select().where(Transazione.user_id == user_id).order_by(Transazione.timestamp.desc())
+# user_id -> {category id: name}, hidden categories included
+_category_names = {}
+
+
+def category_names(user_id):
+    if user_id not in _category_names:
+        query = Categoria.select(Categoria.id, Categoria.name).where(Categoria.user_id == user_id).tuples()
+        _category_names[user_id] = dict(query)
+    return _category_names[user_id]
+
+
+def category_name(user_id, categoria_id):
+    return category_names(user_id).get(categoria_id, "Nessuna")
+
+
+def category_id(user_id, name):
+    # None for "Nessuna"; a name typed by hand becomes a hidden category, so it can be referenced
+    if not name or name == "Nessuna":
+        return None
+    for categoria_id, category in category_names(user_id).items():
+        if category == name:
+            return categoria_id
+    categoria = Categoria.create(user_id=user_id, name=name, hidden=True)
+    category_names(user_id)[categoria.id] = name
+    return categoria.id
+
+
+def add_category(user_id, name):
+    # New category, or back in the list if it was hidden
+    Categoria.insert(user_id=user_id, name=name, hidden=False).on_conflict(
+        conflict_target=[Categoria.user_id, Categoria.name], update={Categoria.hidden: False}
+    ).execute()
+    _category_names.pop(user_id, None)
+
+
+def rename_category(user_id, old, new):
+    # The transactions follow the category; renaming onto an existing category merges the two.
+    # Returns True when transactions were moved (rollup and snapshots must be rebuilt).
+    ids = {name: categoria_id for categoria_id, name in category_names(user_id).items()}
+    _category_names.pop(user_id, None)
+    if old not in ids or old == new:
+        add_category(user_id, new)
+        return False
+    if new not in ids:
+        Categoria.update(name=new, hidden=False).where(Categoria.id == ids[old]).execute()
+        return False
+    moved = Categoria.get_by_id(ids[old]).times_used
+    Transazione.update(categoria=ids[new]).where(
+        Transazione.user_id == user_id, Transazione.categoria == ids[old]
+    ).execute()
+    # Not in this transaction: only once the merge (the old id's delete) is committed
+    after_commit(merge_archived_category, user_id, ids[old], ids[new])
+    Categoria.update(times_used=Categoria.times_used + moved, hidden=False).where(Categoria.id == ids[new]).execute()
+    months = Riepilogo.select(Riepilogo.month).where(
+        Riepilogo.user_id == user_id, Riepilogo.categoria_id.in_([ids[old], ids[new]])
+    )
+    refresh_rollup({(user_id, r.month) for r in months})
+    # The merged category keeps its own budget
+    Budget.delete().where(Budget.user_id == user_id, Budget.categoria_id == ids[old]).execute()
+    Categoria.delete().where(Categoria.id == ids[old]).execute()
+    return True
+
+
+def merge_archived_category(user_id, old_id, new_id):
+    # The archives are attached read-only: connections of their own, each committing by itself.
+    # Running it again changes nothing.
+    for year in archived_years():
+        try:
+            with contextlib.closing(sqlite3.connect(archive_path(year), timeout=30)) as conn, conn:
+                conn.execute(
+                    "UPDATE transazioni SET categoria_id = ? WHERE user_id = ? AND categoria_id = ?",
+                    (new_id, user_id, old_id),
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Archivio {year}: categoria {old_id} non spostata su {new_id}: {e!r}")
+
+
+def set_categories(user_id, lines):
+    # New list of categories: listed names keep their id and times_used, "Vecchio => Nuovo"
+    # renames, the others are hidden (not deleted, past transactions still use them).
+    # Returns True when transactions moved to another category.
+    listed, moved = set(), False
+    for line in lines:
+        old, arrow, new = (part.strip() for part in line.partition("=>"))
+        if arrow and old and new:
+            moved |= rename_category(user_id, old, new)
+            listed.add(new)
+        elif old:
+            add_category(user_id, old)
+            listed.add(old)
+    Categoria.update(hidden=True).where(Categoria.user_id == user_id, Categoria.name.not_in(listed)).execute()
+    _category_names.pop(user_id, None)
+    return moved
+
+
+def categorization_index(user_id):
+    # Distinct descriptions of the user, newest first, with their most recent category
+    query = (
+        Transazione.select(Transazione.descrizione, Transazione.categoria)
+        .where(Transazione.user_id == user_id, Transazione.descrizione.is_null(False))
+        .order_by(Transazione.timestamp.desc())
+        .tuples()
+    )
     lista_desc = {}
-    for q in query:
-        if q.descrizione:
-            lista_desc[q.descrizione] = q.categoria
-    for desc in lista_desc.keys():
-        similarity = rapidfuzz.fuzz.ratio(description, desc)
-        # print(f"{description} -> {desc} - {similarity}")
-        if similarity > 90:
-            return lista_desc[desc]
-    return "Nessuna"
-
-
-def analyze_transactions(user_id=None, start_date=None, end_date=None, days=120, month=None):
+    for descrizione, categoria_id in query:
+        lista_desc.setdefault(descrizione, categoria_id)
+    return list(lista_desc.keys()), [category_name(user_id, categoria_id) for categoria_id in lista_desc.values()]
+
+
+def try_categorize_many(user_id, descriptions):
+    logger.info("Conversation handler: try_categorize_many.")
+    # For every description, the category of the newest past description that matches
+    descs, categorie = categorization_index(user_id)
+    if not descs or not descriptions:
+        return ["Nessuna"] * len(descriptions)
+    # One similarity matrix (descriptions x past descriptions) instead of a python loop per pair
+    matches = rapidfuzz.process.cdist(descriptions, descs, scorer=rapidfuzz.fuzz.ratio, workers=-1) > 90
+    first_match = matches.argmax(axis=1)
+    return [categorie[first_match[i]] if matches[i].any() else "Nessuna" for i in range(len(descriptions))]
+
+
+def try_categorize(user_id, description):
+    return try_categorize_many(user_id, [description])[0]
+
+
+def parse_batch(text, valuta=None):
+    # One "importo [valuta] descrizione" per line -> [(cents, currency, descrizione)], [lines that don't parse]
+    entries, invalid = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            entries.append(parse_entry(line, valuta))
+        except ValueError:
+            invalid.append(line)
+    return entries, invalid
+
+
+def batch_table(batch, valuta):
+    t = PrettyTable()
+    t.field_names = ["#", valuta or "", "DESCRIZIONE", "CATEGORIA"]
+    home = exchange.report_currency(valuta)
+    for i, entry in enumerate(batch, 1):
+        descrizione, categoria = (entry.descrizione or "")[:15], (entry.categoria or "")[:10]
+        importo = format_importo(entry.importo)
+        if entry.valuta and entry.valuta != home:
+            importo = f"{importo} {entry.valuta}"
+        t.add_row([i, importo, descrizione, categoria])
+    if len(t._dividers) > 0:
+        t._dividers[-1] = True
+    totale = exchange.convert(
+        [entry.importo for entry in batch],
+        [entry.valuta or "" for entry in batch],
+        [entry.data for entry in batch],
+        home,
+    ).sum()
+    t.add_row(["", format_importo(int(totale)), "", "TOTAL"])
+    t.align = "l"
+    t.align[valuta or ""] = "r"
+    return t.get_string()
+
+
+def add_to_rollup(row):
+    # One upsert per saved transaction, instead of recomputing the month
+    Riepilogo.insert(
+        user_id=row["user_id"],
+        month=str(row["date"])[:7],
+        categoria_id=row["categoria_id"] or 0,
+        valuta=row.get("valuta") or "",
+        importo=row["importo"],
+    ).on_conflict(
+        conflict_target=[Riepilogo.user_id, Riepilogo.month, Riepilogo.categoria_id, Riepilogo.valuta],
+        update={Riepilogo.importo: Riepilogo.importo + peewee.EXCLUDED.importo},
+    ).execute()
+
+
+def refresh_rollup(keys):
+    # Recomputes the (user_id, "YYYY-MM") totals from transazioni: unlike add_to_rollup it can be
+    # repeated, e.g. for write-behind rows that may already have been inserted
+    for user_id, month in keys:
+        start_date, end_date = month_range(month)
+        # A late transaction dated in an archived year sits in the main database until the next archiving
+        totals = collections.Counter()
+        for model in tier_models(start_date, end_date):
+            categoria = peewee.fn.COALESCE(model.categoria, 0)
+            valuta = peewee.fn.COALESCE(model.valuta, "")
+            totals.update(
+                {
+                    (cat, valuta): importo
+                    for cat, valuta, importo in model.select(categoria, valuta, peewee.fn.SUM(model.importo))
+                    .where(model.user_id == user_id, model.date >= start_date, model.date <= end_date)
+                    .group_by(categoria, valuta)
+                    .tuples()
+                }
+            )
+        Riepilogo.delete().where(Riepilogo.user_id == user_id, Riepilogo.month == month).execute()
+        if totals:
+            Riepilogo.insert_many(
+                [(user_id, month, cat, valuta, importo) for (cat, valuta), importo in totals.items()],
+                fields=[
+                    Riepilogo.user_id,
+                    Riepilogo.month,
+                    Riepilogo.categoria_id,
+                    Riepilogo.valuta,
+                    Riepilogo.importo,
+                ],
+            ).execute()
+
+
+def _range_totals(user_id, start_date, end_date, valuta):
+    # (month, category id, cents in valuta) rows: whole months from the rollup, only the partial months
+    # at the edges are summed from transazioni, so a range of years costs about as much as a month.
+    # Months with amounts in other currencies are summed by day as well, every amount is converted
+    # with the rate of its day.
+    first_full = start_date if start_date.day == 1 else month_range(start_date.strftime("%Y-%m"))[1] + ONE_DAY
+    if end_date == month_range(end_date.strftime("%Y-%m"))[1]:
+        last_full = end_date
+    else:
+        last_full = end_date.replace(day=1) - ONE_DAY
+    if first_full > last_full:
+        edges = [(start_date, end_date, None)]
+        months = []
+    else:
+        edges = [(start_date, first_full - ONE_DAY, None), (last_full + ONE_DAY, end_date, None)]
+        months = (
+            Riepilogo.select(Riepilogo.month, Riepilogo.categoria_id, Riepilogo.valuta, Riepilogo.importo)
+            .where(
+                Riepilogo.user_id == user_id,
+                Riepilogo.month >= first_full.strftime("%Y-%m"),
+                Riepilogo.month <= last_full.strftime("%Y-%m"),
+            )
+            .tuples()
+        )
+    totals = []
+    foreign = collections.defaultdict(set)
+    for month, categoria_id, currency, importo in months:
+        if currency in ("", valuta):
+            totals.append((month, categoria_id or None, importo))
+        else:
+            foreign[month].add(currency)
+    edges += [(*month_range(month), currencies) for month, currencies in sorted(foreign.items())]
+    days = []
+    for edge_start, edge_end, currencies in edges:
+        if edge_start > edge_end:
+            continue
+        for model in tier_models(edge_start, edge_end):
+            query = (
+                model.select(model.date, model.categoria, model.valuta, peewee.fn.SUM(model.importo))
+                .where(model.user_id == user_id, model.date >= edge_start, model.date <= edge_end)
+                .group_by(model.date, model.categoria, model.valuta)
+            )
+            if currencies:
+                query = query.where(model.valuta.in_(sorted(currencies)))
+            days.extend(query.tuples())
+    if days:
+        dates, categorie, currencies, importi = zip(*days)
+        converted = exchange.convert(importi, currencies, dates, valuta)
+        totals += [
+            (date.strftime("%Y-%m"), categoria_id, int(importo))
+            for date, categoria_id, importo in zip(dates, categorie, converted)
+        ]
+    return totals
+
+
+def month_totals(user_id, month, valuta):
+    # {category id (0: none): cents in valuta, the user's currency setting} of a "YYYY-MM" month
+    start_date, end_date = month_range(month)
+    totals = collections.Counter()
+    for _, categoria_id, importo in _range_totals(user_id, start_date, end_date, exchange.report_currency(valuta)):
+        totals[categoria_id or 0] += importo
+    return totals
+
+
+def analyze_transactions(user_id=None, start_date=None, end_date=None, days=120, month=None, valuta=None):
+    # valuta: the user's currency setting, amounts in other currencies are converted to it
     days = days or 180
 
     end_date = end_date or datetime.date.today()
     start_date = start_date or end_date - datetime.timedelta(days)
     user_id = user_id or 456481297
     if month:
-        month = str(datetime.datetime.strptime(month, "%Y-%m").date().month)
-        transazioni = (
-            Transazione.select()
-            .where(Transazione.user_id == user_id, peewee.fn.strftime("%m", Transazione.date) == month)
-            .order_by(Transazione.date.desc())
-        )
+        start_date, end_date = month_range(month)
+    valuta = exchange.report_currency(valuta)
+    if config.SNAPSHOTS:
+        import snapshots
+
+        totals = snapshots.range_totals(user_id, start_date, end_date, valuta)
     else:
-        transazioni = (
-            Transazione.select()
-            .where(Transazione.user_id == user_id, Transazione.date >= start_date, Transazione.date <= end_date)
-            .order_by(Transazione.timestamp.desc())
-        )
+        # Sums (in cents) are computed by the database
+        totals = _range_totals(user_id, start_date, end_date, valuta)
 
-    if not transazioni:
+    if not totals:
         return None, None, None
 
     spending_by_cat = {}
     spending_by_month = {}
     spending_by_month_by_cat = {}
 
-    for t in transazioni:
-        spending_by_cat[t.categoria] = spending_by_cat.get(t.categoria, 0) + t.importo
-        spending_by_month[t.date.strftime("%Y-%m")] = spending_by_month.get(t.date.strftime("%Y-%m"), 0) + t.importo
-        spending_by_month_by_cat.setdefault(t.date.strftime("%Y-%m"), {})
-        spending_by_month_by_cat[t.date.strftime("%Y-%m")][t.categoria] = (
-            spending_by_month_by_cat[t.date.strftime("%Y-%m")].get(t.categoria, 0) + t.importo
-        )
+    for t_month, categoria_id, importo in totals:
+        # Uncategorized transactions are reported as "Nessuna", like try_categorize does
+        categoria = category_name(user_id, categoria_id)
+        spending_by_cat[categoria] = spending_by_cat.get(categoria, 0) + importo
+        spending_by_month[t_month] = spending_by_month.get(t_month, 0) + importo
+        spending_by_month_by_cat.setdefault(t_month, {})
+        spending_by_month_by_cat[t_month][categoria] = spending_by_month_by_cat[t_month].get(categoria, 0) + importo
 
     spending_by_cat = sorted(spending_by_cat.items(), key=lambda x: x[1], reverse=True)
     spending_by_month = sorted(spending_by_month.items(), key=lambda x: x[0], reverse=False)
@@ -465,149 +1424,228 @@ def insert_data():
 """
 
     categories = ["Cibo", "Spesa", "Affitto", "Bollette", "Trasporto", "Intrattenimento", "Salute", "Altro"]
-    cat_count = {}
+    cat_ids = {}
     for cat in categories:
-        cat_count[cat] = 0
-        # Categoria.create(user_id=456481297, name=cat, parent=None)
+        cat_ids[cat] = Categoria.create(user_id=456481297, name=cat, parent=None).id
     data = data.strip().split("\n")
     for d in data:
         d = d.split(",")
-        Transazione.create(timestamp=d[0], date=d[1], user_id=d[2], importo=d[3], descrizione=d[4], categoria=d[5])
-        cat_count[d[5]] += 1
-    for cat in categories:
-        Categoria.create(user_id=456481297, name=cat, parent=None, times_used=cat_count[cat])
+        Transazione.create(
+            timestamp=d[0],
+            date=d[1],
+            user_id=d[2],
+            importo=parse_importo(d[3]),
+            descrizione=d[4],
+            categoria=cat_ids[d[5]],
+        )
+        Categoria.update(times_used=Categoria.times_used + 1).where(Categoria.id == cat_ids[d[5]]).execute()
 
 
 def elenco_transazioni(context, user_id, month: str = None):
-    month = month or datetime.now().strftime("%Y-%m")
-    month = str(datetime.datetime.strptime(month, "%Y-%m").date().month)
-    transactions = (
-        Transazione.select()
-        .where(Transazione.user_id == user_id, peewee.fn.strftime("%m", Transazione.date) == month)
-        .order_by(Transazione.date.desc())
-    )
+    month = month or datetime.date.today().strftime("%Y-%m")
+    start_date, end_date = month_range(month)
+    transactions = [
+        t
+        for model in tier_models(start_date, end_date)
+        for t in model.select().where(model.user_id == user_id, model.date >= start_date, model.date <= end_date)
+    ]
     if not transactions:
         return None
+    transactions.sort(key=lambda t: t.date, reverse=True)
+    return transactions_table(context, user_id, transactions)
+
+
+# user_id -> deque of (fingerprint, timestamp) of the last transactions saved, least recently used first
+_recent = collections.OrderedDict()
+RECENT_USERS = 10000
+RECENT_PER_USER = 20
+
+
+def fingerprint(row):
+    description = " ".join((row["descrizione"] or "").lower().split())
+    return str(row["date"])[:10], row["importo"], row.get("valuta"), description
+
 
+def find_duplicate(row):
+    # Timestamp of a transaction with the same date, amount and description saved in the last
+    # DUPLICATE_WINDOW seconds, or None. Users seen since the start are checked in memory only,
+    # the others with one (user_id, date, importo) index lookup.
+    if not config.DUPLICATE_WINDOW:
+        return None
+    since = row["timestamp"] - config.DUPLICATE_WINDOW
+    key = fingerprint(row)
+    if row["user_id"] in _recent:
+        _recent.move_to_end(row["user_id"])
+        return next((t for f, t in reversed(_recent[row["user_id"]]) if f == key and t >= since), None)
+    candidates = Transazione.select(
+        Transazione.timestamp, Transazione.date, Transazione.importo, Transazione.descrizione, Transazione.valuta
+    ).where(
+        Transazione.user_id == row["user_id"],
+        Transazione.date == row["date"],
+        Transazione.importo == row["importo"],
+        Transazione.timestamp >= since,
+    )
+    return next((t.timestamp for t in candidates if fingerprint(t.__data__) == key), None)
+
+
+def forget_user(user_id):
+    # After a rollback: category ids and saves that may not be in the database anymore
+    _category_names.pop(user_id, None)
+    _recent.pop(user_id, None)
+
+
+def remember_transactions(rows):
+    # Called for every saved row, write-behind ones included (they aren't in the table yet)
+    for row in rows:
+        recent = _recent.get(row["user_id"])
+        if recent is None:
+            recent = _recent[row["user_id"]] = collections.deque(maxlen=RECENT_PER_USER)
+            while len(_recent) > RECENT_USERS:
+                _recent.popitem(last=False)
+        recent.append((fingerprint(row), row["timestamp"]))
+
+
+def search_terms(text):
+    # Words of a search, each matched as a prefix ("kebab cic" finds "Kebab da Ciccio")
+    return re.findall(r"\w+", text.lower())
+
+
+def search_transactions(user_id, text, page=0, page_size=None):
+    # (transactions, has_more) of one page of a user's transactions matching all the words of text,
+    # best matches first
+    page_size = page_size or config.SEARCH_PAGE_SIZE
+    terms = search_terms(text)
+    if not terms:
+        return [], False
+    if is_sqlite():
+        # bm25 weights: the user_id column is only a filter
+        prefixes = " ".join(f'"{term}"*' for term in terms)
+        match = f'user_id : "{user_id}" AND descrizione : ({prefixes})'
+        query = Transazione.raw(
+            "SELECT t.* FROM transazioni_fts JOIN transazioni t ON t.rowid = transazioni_fts.rowid "
+            "WHERE transazioni_fts MATCH ? ORDER BY bm25(transazioni_fts, 1.0, 0.0), t.date DESC LIMIT ? OFFSET ?",
+            match,
+            page_size + 1,
+            page * page_size,
+        )
+    else:
+        document = "to_tsvector('simple', COALESCE(descrizione, ''))"
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        query = Transazione.raw(
+            f"SELECT * FROM transazioni WHERE user_id = %s AND {document} @@ to_tsquery('simple', %s) "
+            f"ORDER BY ts_rank({document}, to_tsquery('simple', %s)) DESC, date DESC LIMIT %s OFFSET %s",
+            user_id,
+            tsquery,
+            tsquery,
+            page_size + 1,
+            page * page_size,
+        )
+    transactions = list(query)
+    return transactions[:page_size], len(transactions) > page_size
+
+
+def transactions_table(context, user_id, transactions, date_format="%m-%d", total=True):
     t = PrettyTable()
     load_user_settings(context, user_id)
     currency = context.user_data["valuta"]
 
     t.field_names = ["DATA", "DESCRIZIONE", currency, "CATEGORIA"]
-    total = 0
+    home = exchange.report_currency(currency)
     for x in transactions:
-        categoria = x.categoria[:10] if x.categoria else ""
+        categoria = category_name(user_id, x.categoria)[:10] if x.categoria else ""
         t.add_row(
             [
-                x.date.strftime("%m-%d"),
-                x.descrizione[:15],
-                f"{round(float(x.importo)*-1, 2)} {currency}",
+                x.date.strftime(date_format),
+                (x.descrizione or "")[:15],
+                f"{format_importo(-x.importo)} {x.valuta if x.valuta and x.valuta != home else currency}",
                 categoria,
             ]
         )
-        total += float(x.importo)
-
-    # tab.add_divider()
-    if len(t._dividers) > 0:
-        t._dividers[-1] = True
-    t.add_row(["", "", f"{round(total*-1, 2)} {currency}", "TOTAL"])
+    # The total in the user's currency, whatever the currencies of the rows
+    somma = exchange.convert(
+        [x.importo for x in transactions],
+        [x.valuta for x in transactions],
+        [x.date for x in transactions],
+        home,
+    ).sum()
+
+    if total:
+        # tab.add_divider()
+        if len(t._dividers) > 0:
+            t._dividers[-1] = True
+        t.add_row(["", "", f"{format_importo(-int(somma))} {currency}", "TOTAL"])
     t.align = "l"
     t.align[currency] = "r"
     t.align["Data"] = "l"
     return t.get_string()
 
 
-def plotly_by_cat(data, file_name="plot_by_cat.jpg"):
-    # Convert to DataFrame
-    df = pd.DataFrame(data, columns=["Category", "Spending"])
+SPARK_BLOCKS = " ▏▎▍▌▋▊▉█"
 
-    # Create a horizontal bar chart with pastel colors
-    fig = go.Figure(
-        data=[
-            go.Bar(
-                name="Spending",
-                y=df["Category"].str.upper(),
-                x=df["Spending"],
-                orientation="h",
-                marker_color=px.colors.qualitative.Bold,
-            )
-        ]
-    )
 
-    # Add annotations
-    for i, (category, spending) in enumerate(data):
-        fig.add_annotation(
-            dict(
-                font=dict(color="black", size=14),
-                x=spending,
-                y=category.upper(),
-                showarrow=False,
-                text=str(spending) + " EUR",
-                xanchor="left",
-                yanchor="middle",
-            )
-        )
+def sparkline_bar(value, maximum, width=10):
+    # Horizontal bar made of unicode eighth blocks, `width` characters at `maximum`
+    if maximum <= 0 or value <= 0:
+        return ""
+    eighths = round(value / maximum * width * 8)
+    return (SPARK_BLOCKS[-1] * (eighths // 8) + SPARK_BLOCKS[eighths % 8]).rstrip()
 
-    # Customize the chart
-    fig.update_layout(
-        title={
-            "text": "SPENDING BY CATEGORY",
-            "y": 0.9,
-            "x": 0.5,
-            "xanchor": "center",
-            "yanchor": "top",
-            "font": dict(size=24),
-        },
-        xaxis_title="",
-        yaxis_title="",
-        barmode="stack",
-        autosize=False,
-        width=800,
-        height=500,
-        margin=dict(l=50, r=50, b=50, t=100, pad=4),
-        template="simple_white",
-        # paper_bgcolor="LightSteelBlue",
-    )
 
-    # Save the plot
-    pio.write_image(fig, file_name)
+def _text_table(rows, valuta, label_width=14):
+    # rows: [(label, spending)], one line per row with value and bar
+    if not rows:
+        return ""
+    maximum = max(spending for _, spending in rows)
+    amount_width = max(len(format_importo(spending)) for _, spending in rows)
+    lines = [
+        f"{label[:label_width]:<{label_width}} {format_importo(spending):>{amount_width}} {valuta or ''} "
+        f"{sparkline_bar(spending, maximum)}"
+        for label, spending in rows
+    ]
+    return "\n".join(lines)
 
 
-def plotly_by_month(data, file_name="plot_by_cat.jpg"):
-    # Convert to DataFrame
-    df = pd.DataFrame(data, columns=["Month", "Spending"])
+def text_report_by_cat(data, valuta):
+    total = sum(spending for _, spending in data)
+    return f"SPESE PER CATEGORIA\n\n{_text_table(data, valuta)}\n\nTOTALE {format_importo(total)} {valuta or ''}"
 
-    # Extract month name from 'Month'
-    df["Month"] = pd.to_datetime(df["Month"]).dt.strftime("%B %Y")
 
-    # Create a vertical bar chart with pastel colors
-    fig = go.Figure(
-        data=[
-            go.Bar(
-                name="Spending", x=df["Month"], y=df["Spending"], marker_color=px.colors.qualitative.Bold
-            )  # Adjust bar width here
-        ]
-    )
+def text_report_by_month(data, valuta):
+    rows = [(datetime.datetime.strptime(month, "%Y-%m").strftime("%b %Y"), spending) for month, spending in data]
+    return f"SPESE PER MESE\n\n{_text_table(rows, valuta)}"
+
+
+def text_report_by_month_and_category(data, valuta):
+    sections = [
+        f"{datetime.datetime.strptime(month, '%Y-%m').strftime('%B %Y').upper()}\n"
+        f"{_text_table(list(categories.items()), valuta)}"
+        for month, categories in data
+    ]
+    return "SPESE PER MESE E CATEGORIA\n\n" + "\n\n".join(sections)
+
+
+def text_report(spending_by_cat, spending_by_month, spending_by_month_by_cat, valuta):
+    # Built only from the aggregates of analyze_transactions, no rendering involved
+    report = [text_report_by_cat(spending_by_cat, valuta)]
+    if len(spending_by_month) > 1:
+        report.append(text_report_by_month(spending_by_month, valuta))
+        report.append(text_report_by_month_and_category(spending_by_month_by_cat, valuta))
+    return "\n\n".join(report)
+
+
+# Chart colors and bar patterns, shared by every figure
+BAR_COLORS = plotly.colors.qualitative.Bold
+BAR_PATTERNS = ["", "/", "\\", "x", "-", "|", "+", "."]
 
-    # Add annotations
-    for i, row in df.iterrows():
-        fig.add_annotation(
-            dict(
-                font=dict(color="black", size=14),
-                x=row["Month"],
-                y=row["Spending"],
-                showarrow=False,
-                text=str(row["Spending"]) + " EUR",
-                xanchor="center",
-                yanchor="bottom",
-            )
-        )
 
-    # Customize the chart
-    fig.update_layout(
+@functools.lru_cache(maxsize=None)
+def _base_layout(title, title_y, width, height, margin_top):
+    # Built once per process: resolving the "simple_white" template and validating the layout is
+    # the most expensive part of creating a figure, so every report starts from a plain dict copy.
+    layout = go.Layout(
         title={
-            "text": "SPENDING BY MONTH",
-            "y": 0.95,
+            "text": title,
+            "y": title_y,
             "x": 0.5,
             "xanchor": "center",
             "yanchor": "top",
@@ -615,96 +1653,140 @@ def plotly_by_month(data, file_name="plot_by_cat.jpg"):
         },
         xaxis_title="",
         yaxis_title="",
-        width=800,
-        height=500,
-        margin=dict(l=50, r=50, b=50, t=50, pad=4),
-        template="simple_white",
+        autosize=False,
+        width=width,
+        height=height,
+        margin=dict(l=50, r=50, b=50, t=margin_top, pad=4),
+        template=pio.templates["simple_white"],
+        showlegend=False,
     )
-    # Save the plot
-    pio.write_image(fig, file_name)
-
-
-def plotly_by_month_and_category(data, file_name="plot_by_cat.jpg"):
-    # Convert to DataFrame
-    data_expanded = [(month, cat, spending) for month, categories in data for cat, spending in categories.items()]
-    df = pd.DataFrame(data_expanded, columns=["Month", "Category", "Spending"])
-
-    # Extract month name and year from 'Month'
-    df["Month"] = pd.to_datetime(df["Month"]).dt.strftime("%B %Y")
+    return layout.to_plotly_json()
 
-    # Convert 'Category' to uppercase
-    df["Category"] = df["Category"].str.upper()
 
-    # Create a color map for categories
-    categories = df["Category"].unique()
-    colors = px.colors.qualitative.Bold
-    color_map = {cat: colors[i % len(colors)] for i, cat in enumerate(categories)}
-
-    # Create a pattern map for categories
-    patterns = ["", "/", "\\", "x", "-", "|", "+", "."]
-    pattern_map = {cat: patterns[i % len(patterns)] for i, cat in enumerate(categories)}
-
-    # Create 2x2 subplots with increased vertical spacing
+@functools.lru_cache(maxsize=None)
+def _subplots_layout():
+    # make_subplots is slow (it builds and validates a full Figure), the 2x2 grid never changes
     fig = make_subplots(
         rows=2,
         cols=2,
         vertical_spacing=0.1,
         horizontal_spacing=0.2,
-        subplot_titles=[month.upper() for month in df["Month"].unique()],
+        subplot_titles=[" "] * 4,
     )
-
-    # Create a horizontal bar chart for each month
-    for i, month in enumerate(df["Month"].unique()):
-        df_month = df[df["Month"] == month]
-        for _, row in df_month.iterrows():
-            fig.add_trace(
-                go.Bar(
-                    name=row["Category"],
-                    x=[row["Spending"]],
-                    y=[row["Category"]],
-                    marker_color=color_map[row["Category"]],
-                    marker_pattern={"shape": pattern_map[row["Category"]]},
-                    orientation="h",
-                    showlegend=False,
-                ),  # Use color map
-                row=i // 2 + 1,
-                col=i % 2 + 1,
+    layout = fig.layout.to_plotly_json()
+    layout.pop("template", None)
+    return layout
+
+
+def _bar_trace(labels, values, orientation, font_size, colors, currency, patterns=None, axes=None):
+    # One trace per chart/subplot, labels are rendered by plotly itself from the trace data;
+    # currency: the ISO code the amounts are in
+    value_axis = "x" if orientation == "h" else "y"
+    trace = {
+        "type": "bar",
+        "orientation": orientation,
+        "x": values if orientation == "h" else labels,
+        "y": labels if orientation == "h" else values,
+        "marker": {"color": colors},
+        "texttemplate": "%{" + value_axis + ":.2f} " + currency,
+        "textposition": "outside",
+        "textfont": {"color": "black", "size": font_size},
+        "cliponaxis": False,
+        "showlegend": False,
+    }
+    if patterns:
+        trace["marker"]["pattern"] = {"shape": patterns}
+    if axes:
+        trace["xaxis"], trace["yaxis"] = axes
+    return trace
+
+
+def _new_layout(base):
+    # Shallow copy, plus copies of the keys that get customized per figure
+    layout = dict(base)
+    for key in ("annotations", "title"):
+        if key in layout:
+            layout[key] = [dict(a) for a in layout[key]] if isinstance(layout[key], list) else dict(layout[key])
+    return layout
+
+
+def _month_label(month):
+    return datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
+
+
+def figure_by_cat(data, currency):
+    categories = [category.upper() for category, _ in data]
+    spending = [spending / 100 for _, spending in data]
+    layout = _new_layout(_base_layout("SPENDING BY CATEGORY", 0.9, 800, 500, 100))
+    layout["barmode"] = "stack"
+    return {"data": [_bar_trace(categories, spending, "h", 14, BAR_COLORS, currency)], "layout": layout}
+
+
+def figure_by_month(data, currency):
+    months = [_month_label(month) for month, _ in data]
+    spending = [spending / 100 for _, spending in data]
+    layout = _new_layout(_base_layout("SPENDING BY MONTH", 0.95, 800, 500, 50))
+    return {"data": [_bar_trace(months, spending, "v", 14, BAR_COLORS, currency)], "layout": layout}
+
+
+def figure_by_month_and_category(data, currency):
+    # The grid has room for four months, keep the most recent ones
+    data = data[-4:]
+
+    # Color and pattern maps for categories, in order of appearance
+    style = {}
+    for _, categories in data:
+        for cat in categories:
+            style.setdefault(cat.upper(), len(style))
+
+    traces = []
+    layout = _new_layout(_base_layout("SPENDING BY MONTH AND CATEGORY", 0.98, 900, 1000, 100))
+    layout.update({k: v for k, v in _subplots_layout().items() if k.startswith(("xaxis", "yaxis"))})
+    layout["annotations"] = [dict(a) for a in _subplots_layout()["annotations"]]
+    for i, (month, categories) in enumerate(data):
+        labels = [cat.upper() for cat in categories]
+        axis = "" if i == 0 else str(i + 1)
+        traces.append(
+            _bar_trace(
+                labels,
+                [spending / 100 for spending in categories.values()],
+                "h",
+                12,
+                [BAR_COLORS[style[cat] % len(BAR_COLORS)] for cat in labels],
+                currency,
+                [BAR_PATTERNS[style[cat] % len(BAR_PATTERNS)] for cat in labels],
+                axes=("x" + axis, "y" + axis),
             )
+        )
+        layout["annotations"][i]["text"] = _month_label(month).upper()
+    for annotation in layout["annotations"][len(data) :]:
+        annotation["text"] = ""
 
-        # Add annotations with aligned labels
-        for _, row in df_month.iterrows():
-            fig.add_annotation(
-                dict(
-                    font=dict(color="black", size=12),
-                    x=row["Spending"],
-                    y=row["Category"],
-                    showarrow=False,
-                    text=str(row["Spending"]) + " EUR",
-                    xanchor="left",  # Align labels
-                    yanchor="middle",
-                ),
-                row=i // 2 + 1,
-                col=i % 2 + 1,
-            )
+    return {"data": traces, "layout": layout}
+
+
+def chart_renderer():
+    # config.CHART_RENDERER: "kaleido" (default, plotly + headless Chromium) or "matplotlib"
+    if config.CHART_RENDERER == "matplotlib":
+        import mpl_charts
+
+        return mpl_charts
+    return None
+
+
+def plotly_by_cat(data, currency, file_name="plot_by_cat.jpg"):
+    if renderer := chart_renderer():
+        return renderer.by_cat(data, currency, file_name)
+    pio.write_image(figure_by_cat(data, currency), file_name, validate=False)
+
+
+def plotly_by_month(data, currency, file_name="plot_by_cat.jpg"):
+    if renderer := chart_renderer():
+        return renderer.by_month(data, currency, file_name)
+    pio.write_image(figure_by_month(data, currency), file_name, validate=False)
 
-    # Customize the chart
-    fig.update_layout(
-        title={
-            "text": "SPENDING BY MONTH AND CATEGORY",
-            "y": 0.98,
-            "x": 0.5,
-            "xanchor": "center",
-            "yanchor": "top",
-            "font": dict(size=24),
-        },
-        xaxis_title="",
-        yaxis_title="",
-        height=1000,
-        width=900,
-        margin=dict(l=50, r=50, b=50, t=100, pad=4),
-        template="simple_white",
-        showlegend=False,  # Hide legend
-    )
 
-    # Save the plot
-    pio.write_image(fig, file_name)
+def plotly_by_month_and_category(data, currency, file_name="plot_by_cat.jpg"):
+    if renderer := chart_renderer():
+        return renderer.by_month_and_category(data, currency, file_name)
+    pio.write_image(figure_by_month_and_category(data, currency), file_name, validate=False)